@@ -8,353 +8,682 @@ import subprocess
 import os
 import re
 import json
-import tempfile
 import shutil
-from http.server import HTTPServer, SimpleHTTPRequestHandler
-from urllib.parse import parse_qs, urlparse
+from http.server import HTTPServer, ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import parse_qs, parse_qsl, quote, urlencode, urlparse
 import threading
 import time
+import signal
+import socket
+import sqlite3
+import zipfile
+import gzip
+import hashlib
+import http.client
+import importlib.util
+import multiprocessing
+import queue
+import uuid
+import mimetypes
+import email.utils
+import ipaddress
+import resource
+import select
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 DOWNLOAD_DIR = os.environ.get('DOWNLOAD_DIR', os.path.expanduser("~/Downloads/YouTube"))
 YT_DLP_PATH = os.environ.get('YT_DLP_PATH', os.path.expanduser("~/.local/bin/yt-dlp"))
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '2'))
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', '2'))
+JOB_HISTORY = int(os.environ.get('JOB_HISTORY', '500'))
+DOWNLOAD_TIMEOUT = int(os.environ.get('DOWNLOAD_TIMEOUT', '600'))
+DOWNLOAD_ENGINE = os.environ.get('DOWNLOAD_ENGINE', 'subprocess')
+EMBEDDED_WORKERS = int(os.environ.get('EMBEDDED_WORKERS', str(DOWNLOAD_WORKERS)))
+MAX_STREAMS = int(os.environ.get('MAX_STREAMS', '8'))
+UPLOAD_BACKEND = os.environ.get('UPLOAD_BACKEND', 'catbox')
+UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', str(UPLOAD_WORKERS)))
+UPLOAD_RETRIES = int(os.environ.get('UPLOAD_RETRIES', '3'))
+UPLOAD_BACKOFF = float(os.environ.get('UPLOAD_BACKOFF', '2'))
+UPLOAD_CHUNK_SIZE = 256 * 1024
+PIPELINE_UPLOADS = os.environ.get('PIPELINE_UPLOADS', '0') == '1'
+INFO_TIMEOUT = int(os.environ.get('INFO_TIMEOUT', '120'))
+INFO_CACHE_TTL = int(os.environ.get('INFO_CACHE_TTL', '1800'))
+INFO_CACHE_SIZE = int(os.environ.get('INFO_CACHE_SIZE', '500'))
+INFO_ERROR_TTL = int(os.environ.get('INFO_ERROR_TTL', '60'))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
+MAX_BATCH_ITEMS = int(os.environ.get('MAX_BATCH_ITEMS', '200'))
+BATCH_HISTORY = int(os.environ.get('BATCH_HISTORY', '100'))
+CATBOX_URL = os.environ.get('CATBOX_URL', 'https://catbox.moe/user/api.php')
+CATBOX_USERHASH = os.environ.get('CATBOX_USERHASH', '')
+CATBOX_STREAMING = os.environ.get('CATBOX_STREAMING', '0') == '1'
+STREAM_CHUNK_SIZE = 64 * 1024
+SERVER_MODE = os.environ.get('SERVER_MODE', 'threaded')
+MAX_CONNECTIONS = int(os.environ.get('MAX_CONNECTIONS', '256'))
+KEEPALIVE_TIMEOUT = float(os.environ.get('KEEPALIVE_TIMEOUT', '15'))
+TRUSTED_PROXIES = os.environ.get('TRUSTED_PROXIES', '')
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', '30'))
+CACHE_DB = os.environ.get('CACHE_DB', os.path.join(DOWNLOAD_DIR, '.cache.db'))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(20 * 1024 ** 3)))
+CACHE_MAX_AGE = int(os.environ.get('CACHE_MAX_AGE', str(7 * 24 * 3600)))
+JOB_DB = os.environ.get('JOB_DB', CACHE_DB)
+JOB_MAX_RESTARTS = int(os.environ.get('JOB_MAX_RESTARTS', '3'))
+ROLE = os.environ.get('ROLE', 'all')
+CLUSTER = os.environ.get('CLUSTER', '0') == '1' or ROLE != 'all'
+NODE_ID = os.environ.get('NODE_ID', socket.gethostname())
+JOB_LEASE = float(os.environ.get('JOB_LEASE', '60'))
+JOB_POLL_INTERVAL = 0.5
+FILE_RATE_LIMIT = int(os.environ.get('FILE_RATE_LIMIT', '0'))
+STORAGE_HIGH_WATERMARK = float(os.environ.get('STORAGE_HIGH_WATERMARK', '0.9'))
+STORAGE_LOW_WATERMARK = float(os.environ.get('STORAGE_LOW_WATERMARK', '0.75'))
+MIN_FREE_BYTES = int(os.environ.get('MIN_FREE_BYTES', str(1024 ** 3)))
+JANITOR_INTERVAL = float(os.environ.get('JANITOR_INTERVAL', '60'))
+ADMISSION_WAIT = float(os.environ.get('ADMISSION_WAIT', '300'))
+EVICT_BATCH = 16
+DOMAIN_CONCURRENCY = int(os.environ.get('DOMAIN_CONCURRENCY', str(DOWNLOAD_WORKERS)))
+DOMAIN_LIMITS = os.environ.get('DOMAIN_LIMITS', '')
+DOMAIN_RATE = float(os.environ.get('DOMAIN_RATE', '60'))
+DOMAIN_BURST = int(os.environ.get('DOMAIN_BURST', '10'))
+THROTTLE_PAUSE = float(os.environ.get('THROTTLE_PAUSE', '30'))
+FFMPEG_PATH = os.environ.get('FFMPEG_PATH', 'ffmpeg')
+# Cores we may actually run on, which a cpuset or affinity mask can make
+# fewer than the machine has
+CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+POSTPROCESS_WORKERS = int(os.environ.get('POSTPROCESS_WORKERS', str(CPU_COUNT)))
+AUDIO_FORMAT = os.environ.get('AUDIO_FORMAT', 'mp3')
+MAX_BODY_BYTES = int(os.environ.get('MAX_BODY_BYTES', str(256 * 1024)))
+BODY_TIMEOUT = float(os.environ.get('BODY_TIMEOUT', '10'))
+MAX_URL_LENGTH = int(os.environ.get('MAX_URL_LENGTH', '2048'))
+URL_POLICY = os.environ.get('URL_POLICY', 'public')
+HOST_CHECK_TTL = int(os.environ.get('HOST_CHECK_TTL', '60'))
+FRAGMENT_CONCURRENCY = int(os.environ.get('FRAGMENT_CONCURRENCY', '4'))
+DOWNLOAD_CONNECTIONS = int(os.environ.get('DOWNLOAD_CONNECTIONS', str(DOWNLOAD_WORKERS * FRAGMENT_CONCURRENCY)))
+JOB_MEMORY_LIMIT = int(os.environ.get('JOB_MEMORY_LIMIT', str(2 * 1024 ** 3)))
+JOB_CPU_SECONDS = int(os.environ.get('JOB_CPU_SECONDS', str(DOWNLOAD_TIMEOUT)))
+JOB_MAX_FILES = int(os.environ.get('JOB_MAX_FILES', '1024'))
+JOB_MAX_PROCESSES = int(os.environ.get('JOB_MAX_PROCESSES', '64'))
+JOB_CPUS = float(os.environ.get('JOB_CPUS', '2'))
+JOB_NICE = int(os.environ.get('JOB_NICE', '10'))
+JOB_IONICE = os.environ.get('JOB_IONICE', '7')
+JOB_CGROUPS = os.environ.get('JOB_CGROUPS', 'auto')
+INTERACTIVE_MAX_DURATION = int(os.environ.get('INTERACTIVE_MAX_DURATION', '600'))
+INTERACTIVE_MAX_BYTES = int(os.environ.get('INTERACTIVE_MAX_BYTES', str(500 * 1024 ** 2)))
+INTERACTIVE_WEIGHT = int(os.environ.get('INTERACTIVE_WEIGHT', '4'))
+BULK_WORKERS = int(os.environ.get('BULK_WORKERS', str(max(DOWNLOAD_WORKERS - 1, 1))))
+BANDWIDTH_LIMIT = int(os.environ.get('BANDWIDTH_LIMIT', '0'))
+BULK_BANDWIDTH_SHARE = float(os.environ.get('BULK_BANDWIDTH_SHARE', '0.5'))
 
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
-HTML_PAGE = '''<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>YT Downloader Pro</title>
-    <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700&display=swap" rel="stylesheet">
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        
-        body {
-            font-family: 'Inter', sans-serif;
-            background: linear-gradient(135deg, #0f0c29 0%, #302b63 50%, #24243e 100%);
-            min-height: 100vh;
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            padding: 20px;
-        }
-        
-        .container {
-            background: rgba(255, 255, 255, 0.05);
-            backdrop-filter: blur(20px);
-            border-radius: 24px;
-            padding: 50px;
-            max-width: 650px;
-            width: 100%;
-            box-shadow: 0 25px 50px rgba(0, 0, 0, 0.5);
-            border: 1px solid rgba(255, 255, 255, 0.1);
-        }
-        
-        .logo {
-            text-align: center;
-            font-size: 5em;
-            margin-bottom: 10px;
-            animation: pulse 2s infinite;
-        }
-        
-        @keyframes pulse {
-            0%, 100% { transform: scale(1); }
-            50% { transform: scale(1.05); }
-        }
-        
-        h1 {
-            color: #fff;
-            text-align: center;
-            margin-bottom: 8px;
-            font-size: 2.2em;
-            font-weight: 700;
-            background: linear-gradient(90deg, #ff6b6b, #ffd93d, #6bcb77, #4d96ff);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            background-size: 300% 300%;
-            animation: gradient 5s ease infinite;
-        }
-        
-        @keyframes gradient {
-            0% { background-position: 0% 50%; }
-            50% { background-position: 100% 50%; }
-            100% { background-position: 0% 50%; }
-        }
-        
-        .subtitle {
-            color: rgba(255, 255, 255, 0.6);
-            text-align: center;
-            margin-bottom: 35px;
-            font-size: 1em;
-        }
-        
-        .features {
-            display: flex;
-            justify-content: center;
-            gap: 20px;
-            margin-bottom: 30px;
-            flex-wrap: wrap;
-        }
-        
-        .feature {
-            background: rgba(255, 255, 255, 0.08);
-            padding: 10px 18px;
-            border-radius: 50px;
-            font-size: 12px;
-            color: rgba(255, 255, 255, 0.8);
-            border: 1px solid rgba(255, 255, 255, 0.1);
-        }
-        
-        .input-group {
-            margin-bottom: 25px;
-        }
-        
-        label {
-            color: rgba(255, 255, 255, 0.9);
-            display: block;
-            margin-bottom: 10px;
-            font-weight: 500;
-            font-size: 14px;
-        }
-        
-        input[type="text"] {
-            width: 100%;
-            padding: 18px 24px;
-            border: 2px solid rgba(255, 255, 255, 0.1);
-            border-radius: 14px;
-            background: rgba(255, 255, 255, 0.08);
-            font-size: 16px;
-            color: #fff;
-            outline: none;
-            transition: all 0.3s ease;
-        }
-        
-        input[type="text"]::placeholder {
-            color: rgba(255, 255, 255, 0.4);
-        }
-        
-        input[type="text"]:focus {
-            border-color: #ff6b6b;
-            box-shadow: 0 0 30px rgba(255, 107, 107, 0.2);
-        }
-        
-        .options-row {
-            display: flex;
-            gap: 15px;
-            margin-bottom: 25px;
-        }
-        
-        .option-group {
-            flex: 1;
-        }
-        
-        select {
-            width: 100%;
-            padding: 14px 18px;
-            border: 2px solid rgba(255, 255, 255, 0.1);
-            border-radius: 12px;
-            background: rgba(255, 255, 255, 0.08);
-            font-size: 14px;
-            color: #fff;
-            outline: none;
-            cursor: pointer;
-            transition: all 0.3s ease;
-        }
-        
-        select:focus {
-            border-color: #4d96ff;
-        }
-        
-        select option {
-            background: #1a1a2e;
-            color: #fff;
-        }
-        
-        .checkbox-group {
-            display: flex;
-            align-items: center;
-            gap: 12px;
-            margin-bottom: 25px;
-            padding: 16px 20px;
-            background: rgba(107, 203, 119, 0.1);
-            border-radius: 12px;
-            border: 1px solid rgba(107, 203, 119, 0.3);
-        }
-        
-        .checkbox-group input[type="checkbox"] {
-            width: 22px;
-            height: 22px;
-            accent-color: #6bcb77;
-            cursor: pointer;
-        }
-        
-        .checkbox-group label {
-            margin: 0;
-            color: #6bcb77;
-            cursor: pointer;
-        }
-        
-        .download-btn {
-            width: 100%;
-            padding: 20px;
-            background: linear-gradient(135deg, #ff6b6b 0%, #ff8e53 100%);
-            border: none;
-            border-radius: 14px;
-            color: #fff;
-            font-size: 18px;
-            font-weight: 600;
-            cursor: pointer;
-            transition: all 0.3s ease;
-            text-transform: uppercase;
-            letter-spacing: 2px;
-            position: relative;
-            overflow: hidden;
-        }
-        
-        .download-btn::before {
-            content: '';
-            position: absolute;
-            top: 0;
-            left: -100%;
-            width: 100%;
-            height: 100%;
-            background: linear-gradient(90deg, transparent, rgba(255,255,255,0.2), transparent);
-            transition: left 0.5s;
-        }
-        
-        .download-btn:hover::before {
-            left: 100%;
-        }
-        
-        .download-btn:hover {
-            transform: translateY(-3px);
-            box-shadow: 0 15px 40px rgba(255, 107, 107, 0.4);
-        }
-        
-        .download-btn:disabled {
-            opacity: 0.7;
-            cursor: not-allowed;
-            transform: none;
-        }
-        
-        .status {
-            margin-top: 30px;
-            padding: 25px;
-            border-radius: 16px;
-            background: rgba(0, 0, 0, 0.3);
-            color: #fff;
-            display: none;
-            font-size: 14px;
-            line-height: 1.6;
-        }
-        
-        .status.show {
-            display: block;
-            animation: fadeIn 0.3s ease;
-        }
-        
-        @keyframes fadeIn {
-            from { opacity: 0; transform: translateY(10px); }
-            to { opacity: 1; transform: translateY(0); }
-        }
-        
-        .status.success {
-            border: 1px solid rgba(107, 203, 119, 0.5);
-            background: rgba(107, 203, 119, 0.1);
-        }
-        
-        .status.error {
-            border: 1px solid rgba(255, 107, 107, 0.5);
-            background: rgba(255, 107, 107, 0.1);
-        }
-        
-        .status.loading {
-            border: 1px solid rgba(77, 150, 255, 0.5);
-            background: rgba(77, 150, 255, 0.1);
-        }
-        
-        .spinner {
-            display: inline-block;
-            width: 20px;
-            height: 20px;
-            border: 3px solid rgba(255,255,255,.3);
-            border-radius: 50%;
-            border-top-color: #fff;
-            animation: spin 1s ease-in-out infinite;
-            margin-right: 12px;
-            vertical-align: middle;
-        }
-        
-        @keyframes spin {
-            to { transform: rotate(360deg); }
-        }
-        
-        .link-box {
-            background: rgba(0, 0, 0, 0.4);
-            padding: 15px 20px;
-            border-radius: 10px;
-            margin-top: 15px;
-            word-break: break-all;
-            display: flex;
-            align-items: center;
-            gap: 10px;
-        }
-        
-        .link-box a {
-            color: #4d96ff;
-            text-decoration: none;
-            flex: 1;
+PAGE_CSS = '''* {
+    margin: 0;
+    padding: 0;
+    box-sizing: border-box;
+}
+
+body {
+    font-family: 'Inter', system-ui, -apple-system, 'Segoe UI', sans-serif;
+    background: linear-gradient(135deg, #0f0c29 0%, #302b63 50%, #24243e 100%);
+    min-height: 100vh;
+    display: flex;
+    justify-content: center;
+    align-items: center;
+    padding: 20px;
+}
+
+.container {
+    background: rgba(255, 255, 255, 0.05);
+    backdrop-filter: blur(20px);
+    border-radius: 24px;
+    padding: 50px;
+    max-width: 650px;
+    width: 100%;
+    box-shadow: 0 25px 50px rgba(0, 0, 0, 0.5);
+    border: 1px solid rgba(255, 255, 255, 0.1);
+}
+
+.logo {
+    text-align: center;
+    font-size: 5em;
+    margin-bottom: 10px;
+    animation: pulse 2s infinite;
+}
+
+@keyframes pulse {
+    0%, 100% { transform: scale(1); }
+    50% { transform: scale(1.05); }
+}
+
+h1 {
+    color: #fff;
+    text-align: center;
+    margin-bottom: 8px;
+    font-size: 2.2em;
+    font-weight: 700;
+    background: linear-gradient(90deg, #ff6b6b, #ffd93d, #6bcb77, #4d96ff);
+    -webkit-background-clip: text;
+    -webkit-text-fill-color: transparent;
+    background-size: 300% 300%;
+    animation: gradient 5s ease infinite;
+}
+
+@keyframes gradient {
+    0% { background-position: 0% 50%; }
+    50% { background-position: 100% 50%; }
+    100% { background-position: 0% 50%; }
+}
+
+.subtitle {
+    color: rgba(255, 255, 255, 0.6);
+    text-align: center;
+    margin-bottom: 35px;
+    font-size: 1em;
+}
+
+.features {
+    display: flex;
+    justify-content: center;
+    gap: 20px;
+    margin-bottom: 30px;
+    flex-wrap: wrap;
+}
+
+.feature {
+    background: rgba(255, 255, 255, 0.08);
+    padding: 10px 18px;
+    border-radius: 50px;
+    font-size: 12px;
+    color: rgba(255, 255, 255, 0.8);
+    border: 1px solid rgba(255, 255, 255, 0.1);
+}
+
+.input-group {
+    margin-bottom: 25px;
+}
+
+label {
+    color: rgba(255, 255, 255, 0.9);
+    display: block;
+    margin-bottom: 10px;
+    font-weight: 500;
+    font-size: 14px;
+}
+
+input[type="text"] {
+    width: 100%;
+    padding: 18px 24px;
+    border: 2px solid rgba(255, 255, 255, 0.1);
+    border-radius: 14px;
+    background: rgba(255, 255, 255, 0.08);
+    font-size: 16px;
+    color: #fff;
+    outline: none;
+    transition: all 0.3s ease;
+}
+
+input[type="text"]::placeholder {
+    color: rgba(255, 255, 255, 0.4);
+}
+
+input[type="text"]:focus {
+    border-color: #ff6b6b;
+    box-shadow: 0 0 30px rgba(255, 107, 107, 0.2);
+}
+
+.options-row {
+    display: flex;
+    gap: 15px;
+    margin-bottom: 25px;
+}
+
+.option-group {
+    flex: 1;
+}
+
+select {
+    width: 100%;
+    padding: 14px 18px;
+    border: 2px solid rgba(255, 255, 255, 0.1);
+    border-radius: 12px;
+    background: rgba(255, 255, 255, 0.08);
+    font-size: 14px;
+    color: #fff;
+    outline: none;
+    cursor: pointer;
+    transition: all 0.3s ease;
+}
+
+select:focus {
+    border-color: #4d96ff;
+}
+
+select option {
+    background: #1a1a2e;
+    color: #fff;
+}
+
+.checkbox-group {
+    display: flex;
+    align-items: center;
+    gap: 12px;
+    margin-bottom: 25px;
+    padding: 16px 20px;
+    background: rgba(107, 203, 119, 0.1);
+    border-radius: 12px;
+    border: 1px solid rgba(107, 203, 119, 0.3);
+}
+
+.checkbox-group input[type="checkbox"] {
+    width: 22px;
+    height: 22px;
+    accent-color: #6bcb77;
+    cursor: pointer;
+}
+
+.checkbox-group label {
+    margin: 0;
+    color: #6bcb77;
+    cursor: pointer;
+}
+
+.download-btn {
+    width: 100%;
+    padding: 20px;
+    background: linear-gradient(135deg, #ff6b6b 0%, #ff8e53 100%);
+    border: none;
+    border-radius: 14px;
+    color: #fff;
+    font-size: 18px;
+    font-weight: 600;
+    cursor: pointer;
+    transition: all 0.3s ease;
+    text-transform: uppercase;
+    letter-spacing: 2px;
+    position: relative;
+    overflow: hidden;
+}
+
+.download-btn::before {
+    content: '';
+    position: absolute;
+    top: 0;
+    left: -100%;
+    width: 100%;
+    height: 100%;
+    background: linear-gradient(90deg, transparent, rgba(255,255,255,0.2), transparent);
+    transition: left 0.5s;
+}
+
+.download-btn:hover::before {
+    left: 100%;
+}
+
+.download-btn:hover {
+    transform: translateY(-3px);
+    box-shadow: 0 15px 40px rgba(255, 107, 107, 0.4);
+}
+
+.download-btn:disabled {
+    opacity: 0.7;
+    cursor: not-allowed;
+    transform: none;
+}
+
+.status {
+    margin-top: 30px;
+    padding: 25px;
+    border-radius: 16px;
+    background: rgba(0, 0, 0, 0.3);
+    color: #fff;
+    display: none;
+    font-size: 14px;
+    line-height: 1.6;
+}
+
+.status.show {
+    display: block;
+    animation: fadeIn 0.3s ease;
+}
+
+@keyframes fadeIn {
+    from { opacity: 0; transform: translateY(10px); }
+    to { opacity: 1; transform: translateY(0); }
+}
+
+.status.success {
+    border: 1px solid rgba(107, 203, 119, 0.5);
+    background: rgba(107, 203, 119, 0.1);
+}
+
+.status.error {
+    border: 1px solid rgba(255, 107, 107, 0.5);
+    background: rgba(255, 107, 107, 0.1);
+}
+
+.status.loading {
+    border: 1px solid rgba(77, 150, 255, 0.5);
+    background: rgba(77, 150, 255, 0.1);
+}
+
+.spinner {
+    display: inline-block;
+    width: 20px;
+    height: 20px;
+    border: 3px solid rgba(255,255,255,.3);
+    border-radius: 50%;
+    border-top-color: #fff;
+    animation: spin 1s ease-in-out infinite;
+    margin-right: 12px;
+    vertical-align: middle;
+}
+
+@keyframes spin {
+    to { transform: rotate(360deg); }
+}
+
+.link-box {
+    background: rgba(0, 0, 0, 0.4);
+    padding: 15px 20px;
+    border-radius: 10px;
+    margin-top: 15px;
+    word-break: break-all;
+    display: flex;
+    align-items: center;
+    gap: 10px;
+}
+
+.link-box a {
+    color: #4d96ff;
+    text-decoration: none;
+    flex: 1;
+}
+
+.link-box a:hover {
+    text-decoration: underline;
+}
+
+.copy-btn {
+    background: #4d96ff;
+    border: none;
+    padding: 10px 16px;
+    border-radius: 8px;
+    color: #fff;
+    cursor: pointer;
+    font-size: 12px;
+    font-weight: 600;
+    transition: all 0.2s;
+}
+
+.copy-btn:hover {
+    background: #3a7bd5;
+}
+
+.progress-bar {
+    width: 100%;
+    height: 6px;
+    background: rgba(255, 255, 255, 0.1);
+    border-radius: 3px;
+    margin-top: 15px;
+    overflow: hidden;
+}
+
+.progress-fill {
+    height: 100%;
+    background: linear-gradient(90deg, #ff6b6b, #ffd93d);
+    border-radius: 3px;
+    width: 0%;
+    transition: width 0.3s ease;
+}
+
+.footer {
+    text-align: center;
+    margin-top: 30px;
+    color: rgba(255, 255, 255, 0.4);
+    font-size: 12px;
+}
+'''
+
+PAGE_JS = r'''const btn = document.getElementById('downloadBtn');
+const status = document.getElementById('status');
+
+btn.addEventListener('click', async () => {
+    const url = document.getElementById('url').value.trim();
+    const format = document.getElementById('format').value;
+    const quality = document.getElementById('quality').value;
+    const shareLink = document.getElementById('shareLink').checked;
+
+    if (!url) {
+        showStatus('error', '❌ Please enter a URL');
+        return;
+    }
+
+    const urls = url.split(/\s+/);
+    if (urls.length > 1 || /[?&]list=|\/playlist|\/sets\//.test(url)) {
+        await runBatch(urls, format, quality, shareLink);
+        return;
+    }
+
+    btn.disabled = true;
+    btn.innerHTML = '<span class="spinner"></span> Processing...';
+    showStatus('loading', '<span class="spinner"></span> Starting download...');
+    setProgress(10);
+
+    try {
+        const response = await fetch('/download', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({url, format, quality, shareLink})
+        });
+
+        const queued = await response.json();
+        if (!queued.success) {
+            showStatus('error', `❌ Error: ${escapeHtml(queued.error)}`);
+        } else {
+            const job = await waitForJob(queued.jobId);
+            showResult(job.result);
         }
-        
-        .link-box a:hover {
-            text-decoration: underline;
+    } catch (err) {
+        showStatus('error', `❌ Connection error: ${escapeHtml(err.message)}`);
+    }
+
+    btn.disabled = false;
+    btn.innerHTML = '🚀 Download Now';
+});
+
+async function runBatch(urls, format, quality, shareLink) {
+    btn.disabled = true;
+    btn.innerHTML = '<span class="spinner"></span> Processing...';
+    showStatus('loading', '<span class="spinner"></span> Reading list...');
+    setProgress(5);
+
+    try {
+        const body = urls.length > 1 ? {urls} : {url: urls[0]};
+        const response = await fetch('/batch', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({...body, format, quality, shareLink})
+        });
+        const queued = await response.json();
+
+        if (!queued.success) {
+            showStatus('error', `❌ Error: ${escapeHtml(queued.error)}`);
+        } else {
+            const zipLink = `<div class="link-box">
+                <a href="${safeUrl(queued.zipUrl)}">📦 Download all as ZIP</a>
+            </div>`;
+            while (true) {
+                const batch = await (await fetch(queued.statusUrl)).json();
+                const finished = (batch.counts.done || 0) + (batch.counts.failed || 0);
+                setProgress(5 + 95 * finished / batch.total);
+                if (batch.done) {
+                    const failed = batch.counts.failed ? ` (${batch.counts.failed} failed)` : '';
+                    showStatus('success', `✅ <strong>${batch.counts.done || 0} of ${batch.total} downloaded${failed}</strong>${zipLink}`);
+                    break;
+                }
+                showStatus('loading', `<span class="spinner"></span> ${finished} of ${batch.total} done...${zipLink}`);
+                await new Promise(resolve => setTimeout(resolve, 2000));
+            }
         }
-        
-        .copy-btn {
-            background: #4d96ff;
-            border: none;
-            padding: 10px 16px;
-            border-radius: 8px;
-            color: #fff;
-            cursor: pointer;
-            font-size: 12px;
-            font-weight: 600;
-            transition: all 0.2s;
+    } catch (err) {
+        showStatus('error', `❌ Connection error: ${escapeHtml(err.message)}`);
+    }
+
+    btn.disabled = false;
+    btn.innerHTML = '🚀 Download Now';
+}
+
+function waitForJob(jobId) {
+    if (!window.EventSource) {
+        return pollJob(jobId);
+    }
+    return new Promise((resolve, reject) => {
+        const events = new EventSource(`/jobs/${jobId}/events`);
+        events.addEventListener('progress', (e) => showProgress(JSON.parse(e.data)));
+        events.addEventListener('done', (e) => {
+            events.close();
+            resolve(JSON.parse(e.data));
+        });
+        events.onerror = () => {
+            events.close();
+            pollJob(jobId).then(resolve, reject);
+        };
+    });
+}
+
+async function pollJob(jobId) {
+    while (true) {
+        const response = await fetch(`/jobs/${jobId}`);
+        const job = await response.json();
+        if (job.status === 'done' || job.status === 'failed') {
+            return job;
         }
-        
-        .copy-btn:hover {
-            background: #3a7bd5;
+        showProgress(job);
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
+function formatBytes(bytes) {
+    const units = ['B', 'KB', 'MB', 'GB'];
+    let i = 0;
+    while (bytes >= 1024 && i < units.length - 1) {
+        bytes /= 1024;
+        i++;
+    }
+    return `${bytes.toFixed(i ? 1 : 0)} ${units[i]}`;
+}
+
+function showProgress(job) {
+    const p = job.progress || {};
+    let text = 'Waiting in queue...';
+    let percent = 5;
+
+    if (p.phase === 'download') {
+        text = 'Downloading...';
+        if (p.percent != null) {
+            text = `Downloading... ${p.percent.toFixed(0)}%`;
+            percent = 5 + p.percent * 0.75;
         }
-        
-        .progress-bar {
-            width: 100%;
-            height: 6px;
-            background: rgba(255, 255, 255, 0.1);
-            border-radius: 3px;
-            margin-top: 15px;
-            overflow: hidden;
+        if (p.speed) text += ` • ${formatBytes(p.speed)}/s`;
+        if (p.eta != null) text += ` • ${Math.round(p.eta)}s left`;
+    } else if (p.phase === 'extract') {
+        text = 'Fetching video info...';
+    } else if (p.phase === 'storage') {
+        text = 'Waiting for disk space...';
+    } else if (p.phase === 'merge') {
+        text = 'Processing video...';
+        percent = 85;
+    } else if (p.phase === 'upload') {
+        text = 'Uploading to cloud...';
+        percent = 85;
+        if (p.percent != null) {
+            text = `Uploading to cloud... ${p.percent.toFixed(0)}%`;
+            percent = 85 + p.percent * 0.15;
         }
-        
-        .progress-fill {
-            height: 100%;
-            background: linear-gradient(90deg, #ff6b6b, #ffd93d);
-            border-radius: 3px;
-            width: 0%;
-            transition: width 0.3s ease;
+        if (p.speed) text += ` • ${formatBytes(p.speed)}/s`;
+    }
+
+    showStatus('loading', `<span class="spinner"></span> ${text}`);
+    setProgress(percent);
+}
+
+function showResult(data) {
+    if (data.success) {
+        let html = `✅ <strong>Download Complete!</strong><br><br>`;
+        html += `📁 File: <strong>${escapeHtml(data.filename)}</strong><br>`;
+        html += `💾 Saved to: ${escapeHtml(data.path)}`;
+        if (data.fileUrl) {
+            html += `<br>⬇️ <a href="${safeUrl(data.fileUrl)}" style="color: #00d2ff;">Download to this device</a>`;
         }
-        
-        .footer {
-            text-align: center;
-            margin-top: 30px;
-            color: rgba(255, 255, 255, 0.4);
-            font-size: 12px;
+
+        if (data.shareUrl) {
+            html += `<div class="link-box">
+                <a href="${safeUrl(data.shareUrl)}" target="_blank" rel="noopener">${escapeHtml(data.shareUrl)}</a>
+                <button class="copy-btn" data-url="${escapeHtml(data.shareUrl)}">📋 Copy</button>
+            </div>`;
         }
-    </style>
+
+        showStatus('success', html);
+        setProgress(100);
+    } else {
+        showStatus('error', `❌ Error: ${escapeHtml(data.error)}`);
+    }
+}
+
+function setProgress(percent) {
+    document.getElementById('progress').style.width = `${percent}%`;
+}
+
+function showStatus(type, html) {
+    const width = document.getElementById('progress').style.width;
+    status.className = `status show ${type}`;
+    status.innerHTML = html + '<div class="progress-bar"><div class="progress-fill" id="progress"></div></div>';
+    setProgress(parseFloat(width) || 0);
+}
+
+// Server-supplied text goes through these before it reaches innerHTML
+function escapeHtml(text) {
+    return String(text ?? '').replace(/[&<>"']/g, (c) => ({
+        '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+    })[c]);
+}
+
+function safeUrl(url) {
+    const text = String(url ?? '');
+    return /^(https?:\/\/|\/)/i.test(text) ? escapeHtml(text) : '#';
+}
+
+status.addEventListener('click', (e) => {
+    const button = e.target.closest('.copy-btn');
+    if (!button) return;
+    navigator.clipboard.writeText(button.dataset.url);
+    button.textContent = '✓ Copied!';
+    setTimeout(() => button.textContent = '📋 Copy', 2000);
+});
+
+document.getElementById('url').addEventListener('keypress', (e) => {
+    if (e.key === 'Enter') btn.click();
+});
+
+// Hide quality for audio
+document.getElementById('format').addEventListener('change', (e) => {
+    document.getElementById('quality').parentElement.style.display = 
+        e.target.value === 'audio' ? 'none' : 'block';
+});
+'''
+
+# {css_url} and {js_url} are filled in with the versioned asset paths
+HTML_PAGE = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>YT Downloader Pro</title>
+    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
+    <!-- Loads without blocking the first paint; text shows in a system font until then -->
+    <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700&display=swap" rel="stylesheet"
+          media="print" onload="this.media='all'">
+    <link href="{css_url}" rel="stylesheet">
+    <script src="{js_url}" defer></script>
 </head>
 <body>
     <div class="container">
@@ -413,212 +742,4746 @@ HTML_PAGE = '''<!DOCTYPE html>
             Powered by yt-dlp • Made with ❤️
         </div>
     </div>
-    
-    <script>
-        const btn = document.getElementById('downloadBtn');
-        const status = document.getElementById('status');
-        const progress = document.getElementById('progress');
-        
-        btn.addEventListener('click', async () => {
-            const url = document.getElementById('url').value.trim();
-            const format = document.getElementById('format').value;
-            const quality = document.getElementById('quality').value;
-            const shareLink = document.getElementById('shareLink').checked;
-            
-            if (!url) {
-                showStatus('error', '❌ Please enter a URL');
-                return;
-            }
-            
-            btn.disabled = true;
-            btn.innerHTML = '<span class="spinner"></span> Processing...';
-            showStatus('loading', '<span class="spinner"></span> Starting download...');
-            progress.style.width = '10%';
-            
-            try {
-                const response = await fetch('/download', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({url, format, quality, shareLink})
-                });
-                
-                const data = await response.json();
-                progress.style.width = '100%';
-                
-                if (data.success) {
-                    let html = `✅ <strong>Download Complete!</strong><br><br>`;
-                    html += `📁 File: <strong>${data.filename}</strong><br>`;
-                    html += `💾 Saved to: ${data.path}`;
-                    
-                    if (data.shareUrl) {
-                        html += `<div class="link-box">
-                            <a href="${data.shareUrl}" target="_blank">${data.shareUrl}</a>
-                            <button class="copy-btn" onclick="copyLink('${data.shareUrl}')">📋 Copy</button>
-                        </div>`;
-                    }
-                    
-                    showStatus('success', html);
-                } else {
-                    showStatus('error', `❌ Error: ${data.error}`);
-                }
-            } catch (err) {
-                showStatus('error', `❌ Connection error: ${err.message}`);
-            }
-            
-            btn.disabled = false;
-            btn.innerHTML = '🚀 Download Now';
-        });
-        
-        function showStatus(type, html) {
-            status.className = `status show ${type}`;
-            status.innerHTML = html + '<div class="progress-bar"><div class="progress-fill" id="progress"></div></div>';
-        }
-        
-        function copyLink(url) {
-            navigator.clipboard.writeText(url);
-            event.target.textContent = '✓ Copied!';
-            setTimeout(() => event.target.textContent = '📋 Copy', 2000);
-        }
-        
-        document.getElementById('url').addEventListener('keypress', (e) => {
-            if (e.key === 'Enter') btn.click();
-        });
-        
-        // Hide quality for audio
-        document.getElementById('format').addEventListener('change', (e) => {
-            document.getElementById('quality').parentElement.style.display = 
-                e.target.value === 'audio' ? 'none' : 'block';
-        });
-    </script>
 </body>
 </html>
 '''
 
-class DownloadHandler(SimpleHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/' or self.path == '/index.html':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(HTML_PAGE.encode())
-        elif self.path == '/health':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"status": "ok"}).encode())
-        else:
-            self.send_error(404)
+# Optional (pip install brotli); every browser also takes gzip
+brotli = importlib.import_module('brotli') if importlib.util.find_spec('brotli') else None
+
+def accepted_encodings(header):
+    """Content codings an Accept-Encoding header allows, i.e. those without q=0."""
+    codings = set()
+    for item in (header or '').split(','):
+        coding, _, params = item.partition(';')
+        q = params.strip()[2:] if params.strip().startswith('q=') else '1'
+        try:
+            if float(q) > 0:
+                codings.add(coding.strip().lower())
+        except ValueError:
+            pass
+    return codings
+
+class StaticAsset:
+    """
+    A fixed response body, encoded and compressed once at startup. Each
+    encoding gets its own strong ETag, as the bytes on the wire differ.
+    """
     
-    def do_POST(self):
-        if self.path == '/download':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode())
-            
-            url = data.get('url', '')
-            format_type = data.get('format', 'video')
-            quality = data.get('quality', '720')
-            share_link = data.get('shareLink', False)
-            
-            result = self.download_and_share(url, format_type, quality, share_link)
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(result).encode())
-        else:
-            self.send_error(404)
+    def __init__(self, body, content_type, cache_control):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.mtime = time.time()
+        self.version = hashlib.sha256(body).hexdigest()[:16]
+        self.bodies = {'identity': body, 'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli:
+            self.bodies['br'] = brotli.compress(body, quality=11)
+        self.etags = {coding: f'"{self.version}"' if coding == 'identity' else f'"{self.version}-{coding}"'
+                      for coding in self.bodies}
     
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
+    def negotiate(self, accept_encoding):
+        """The smallest encoding the client accepts."""
+        accepted = accepted_encodings(accept_encoding)
+        for coding in ('br', 'gzip'):
+            if coding in self.bodies and (coding in accepted or '*' in accepted):
+                return coding
+        return 'identity'
+
+def build_static():
+    """
+    The page and its assets as `('/' page, {path: asset})`. Asset paths carry
+    their content hash, so they can be cached for good; the page itself is
+    revalidated on every load and points at the current ones.
+    """
+    immutable = 'public, max-age=31536000, immutable'
+    css = StaticAsset(PAGE_CSS.encode(), 'text/css; charset=utf-8', immutable)
+    js = StaticAsset(PAGE_JS.encode(), 'text/javascript; charset=utf-8', immutable)
+    assets = {f'/static/app.{css.version}.css': css, f'/static/app.{js.version}.js': js}
+    page = HTML_PAGE.format(css_url=f'/static/app.{css.version}.css', js_url=f'/static/app.{js.version}.js')
+    return StaticAsset(page.encode(), 'text/html; charset=utf-8', 'no-cache'), assets
+
+INDEX_PAGE, STATIC_ASSETS = build_static()
+
+class Metric:
+    """
+    One Prometheus metric family. Values are kept per label combination;
+    `collect`, if given, is called at scrape time and returns
+    `[(labels, value), ...]` instead.
+    """
     
-    def download_and_share(self, url, format_type, quality, share_link):
-        try:
-            # Build yt-dlp command
-            cmd = [YT_DLP_PATH]
-            
-            if format_type == 'audio':
-                cmd.extend(['-x', '--audio-format', 'mp3'])
-                output_template = os.path.join(DOWNLOAD_DIR, '%(title)s.%(ext)s')
-            elif format_type == 'best':
-                cmd.extend(['-f', 'bestvideo+bestaudio/best'])
-                output_template = os.path.join(DOWNLOAD_DIR, '%(title)s.%(ext)s')
-            else:
-                if quality == 'best':
-                    cmd.extend(['-f', 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'])
-                else:
-                    cmd.extend(['-f', f'bestvideo[height<={quality}][ext=mp4]+bestaudio[ext=m4a]/best[height<={quality}][ext=mp4]/best'])
-                output_template = os.path.join(DOWNLOAD_DIR, '%(title)s.%(ext)s')
-            
-            cmd.extend([
-                '--merge-output-format', 'mp4',
-                '-o', output_template,
-                '--no-playlist',
-                '--print', 'after_move:filepath',
-                url
-            ])
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
-            
-            if result.returncode != 0:
-                return {'success': False, 'error': result.stderr or 'Download failed'}
-            
-            filepath = result.stdout.strip().split('\n')[-1]
-            filename = os.path.basename(filepath)
-            
-            share_url = None
-            if share_link and os.path.exists(filepath):
-                share_url = self.upload_to_catbox(filepath)
-            
-            return {
-                'success': True,
-                'filename': filename,
-                'path': DOWNLOAD_DIR,
-                'shareUrl': share_url
-            }
-            
-        except subprocess.TimeoutExpired:
-            return {'success': False, 'error': 'Download timed out (10 min limit)'}
-        except Exception as e:
-            return {'success': False, 'error': str(e)}
+    kind = 'untyped'
     
-    def upload_to_catbox(self, filepath):
-        try:
-            result = subprocess.run([
-                'curl', '-sS',
-                '-F', 'reqtype=fileupload',
-                '-F', f'fileToUpload=@{filepath}',
-                'https://catbox.moe/user/api.php'
-            ], capture_output=True, text=True, timeout=600)
-            
-            if result.returncode == 0 and result.stdout.startswith('http'):
-                return result.stdout.strip()
-            return None
-        except:
-            return None
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self.lock = threading.Lock()
+        self.values = {}
+        metrics.append(self)
     
-    def log_message(self, format, *args):
-        print(f"[{self.log_date_time_string()}] {format % args}")
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+    
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+    
+    def samples(self):
+        if self.collect:
+            return [('', self._key(labels), value) for labels, value in self.collect()]
+        with self.lock:
+            return [('', key, value) for key, value in self.values.items()]
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, value in self.samples():
+            pairs = list(zip(self.labels, key))
+            if suffix.startswith('_bucket'):
+                pairs.append(('le', suffix[len('_bucket'):]))
+                suffix = '_bucket'
+            label_text = ','.join(f'{k}="{escape_label(v)}"' for k, v in pairs)
+            lines.append(f'{self.name}{suffix}{{{label_text}}} {value}' if pairs
+                         else f'{self.name}{suffix} {value}')
+        return '\n'.join(lines)
 
-def run_server(port=8888):
-    server = HTTPServer(('0.0.0.0', port), DownloadHandler)
-    print(f"""
-╔══════════════════════════════════════════════════════════════╗
-║                  🎬 YT Downloader Pro                        ║
-╠══════════════════════════════════════════════════════════════╣
-║  Server running at: http://localhost:{port}                   ║
-║  Downloads folder:  {DOWNLOAD_DIR}         ║
-║                                                              ║
-║  Press Ctrl+C to stop                                        ║
-╚══════════════════════════════════════════════════════════════╝
-""")
-    server.serve_forever()
+class Counter(Metric):
+    kind = 'counter'
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+class Histogram(Metric):
+    kind = 'histogram'
+    
+    def __init__(self, name, help, labels=(), buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            # Cumulative bucket counts, then the sum and count of observations
+            state = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+    
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, n in zip(self.buckets, counts):
+                    samples.append((f'_bucket{bound}', key, n))
+                samples.append(('_bucket+Inf', key, count))
+                samples.append(('_sum', key, round(total, 6)))
+                samples.append(('_count', key, count))
+        return samples
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = []
+
+# Kept in order of how they are most often read: what is queued and running,
+# how long each phase takes, what goes wrong, and then the traffic itself
+QUEUE_DEPTH = Gauge('ytdl_queue_depth', 'Jobs waiting for a worker', ('queue',), collect=lambda: [
+    ({'queue': 'download'}, job_manager.download_queue.qsize()),
+    ({'queue': 'upload'}, job_manager.upload_queue.qsize()),
+    ({'queue': 'postprocess'}, postprocessor.stats()['waiting'])])
+JOBS_BY_STATUS = Gauge('ytdl_jobs', 'Jobs in memory by status', ('status',),
+                       collect=lambda: job_manager.status_counts())
+WORKERS_BUSY = Gauge('ytdl_workers_busy', 'Download and upload workers running a job',
+                     collect=lambda: [({}, job_manager.busy)])
+JOBS_TOTAL = Counter('ytdl_jobs_total', 'Finished jobs', ('site', 'status'))
+JOB_SECONDS = Histogram('ytdl_job_seconds', 'Time from submission to completion', ('status', 'priority'))
+PHASE_SECONDS = Histogram('ytdl_job_phase_seconds', 'Time jobs spend in each phase', ('phase',))
+ERRORS_TOTAL = Counter('ytdl_errors_total', 'Failed downloads and uploads by cause', ('category',))
+SPAWNS_TOTAL = Counter('ytdl_process_spawns_total', 'yt-dlp and ffmpeg processes started', ('kind',))
+DOWNLOAD_CONNECTIONS_USED = Gauge('ytdl_download_connections', 'Connections to media servers held by downloads',
+                                  collect=lambda: [({}, connection_budget.stats()['used'])])
+POSTPROCESS_CPU_SECONDS = Counter('ytdl_postprocess_cpu_seconds_total',
+                                  'CPU time ffmpeg spent remuxing (copy) or transcoding', ('mode',))
+DOWNLOAD_BYTES = Counter('ytdl_download_bytes_total', 'Bytes downloaded', ('site',))
+DOWNLOAD_SECONDS = Counter('ytdl_download_seconds_total',
+                           'Seconds spent downloading; bytes over seconds gives throughput', ('site',))
+UPLOAD_BYTES = Counter('ytdl_upload_bytes_total', 'File bytes sent to the share backend, retries included')
+CACHE_REQUESTS = Counter('ytdl_cache_requests_total', 'Download and info cache lookups', ('cache', 'result'))
+CACHE_HIT_RATIO = Gauge('ytdl_cache_hit_ratio', 'Share of download cache lookups that were hits',
+                        collect=lambda: [({}, cache_hit_ratio())])
+STORAGE_BYTES = Gauge('ytdl_storage_bytes', 'Download storage', ('kind',), collect=lambda: [
+    ({'kind': kind}, value) for kind, value in storage_bytes().items()])
+SITE_CONCURRENCY = Gauge('ytdl_site_concurrency', 'Current adaptive concurrency cap per site', ('site',),
+                         collect=lambda: [({'site': site}, state['concurrency']) for site, state in
+                                          job_manager.download_queue.stats()['sites'].items()])
+HTTP_REQUESTS = Counter('ytdl_http_requests_total', 'HTTP responses sent', ('method', 'code'))
+
+def cache_hit_ratio():
+    hits = CACHE_REQUESTS.get(cache='download', result='hit')
+    total = hits + CACHE_REQUESTS.get(cache='download', result='miss')
+    return round(hits / total, 4) if total else 0
+
+def storage_bytes():
+    stats = storage.stats()
+    return {'budget': stats['budgetBytes'], 'used': stats['usedBytes'],
+            'reserved': stats['reservedBytes'], 'free': stats['freeBytes']}
+
+# yt-dlp errors that mean the site wants us to slow down
+THROTTLE_PATTERN = re.compile(r'HTTP Error (429|403)|Too Many Requests|rate[- ]limit', re.IGNORECASE)
+
+# First match wins, so the specific causes come before the generic ones
+ERROR_CATEGORIES = [
+    ('cancelled', re.compile(r'^Cancelled$')),
+    ('timeout', re.compile(r'timed out', re.IGNORECASE)),
+    ('throttled', THROTTLE_PATTERN),
+    ('storage', re.compile(r'storage|No space left', re.IGNORECASE)),
+    ('unsupported', re.compile(r'Unsupported URL|is not a valid URL', re.IGNORECASE)),
+    ('unavailable', re.compile(r'unavailable|private video|has been removed|does not exist', re.IGNORECASE)),
+    ('geo', re.compile(r'not available (in|from) your (country|location)|geo.?restrict', re.IGNORECASE)),
+    ('auth', re.compile(r'sign in|log ?in|confirm your age|members.only|cookies', re.IGNORECASE)),
+    ('ffmpeg', re.compile(r'ffmpeg|ffprobe|postprocess', re.IGNORECASE)),
+    ('network', re.compile(r'unable to download|connection|network|resolve|SSL|HTTP Error', re.IGNORECASE)),
+]
+
+def error_category(error):
+    """Bucket a yt-dlp error message (its stderr tail) for ytdl_errors_total."""
+    for category, pattern in ERROR_CATEGORIES:
+        if pattern.search(error or ''):
+            return category
+    return 'other'
+
+def render_metrics():
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+# (extractor, domains, regex) triples used to turn the many URL spellings of
+# one video into the same cache key without asking yt-dlp. The URL's host must
+# be one of the domains or under one; the regex matches its path and query
+VIDEO_ID_PATTERNS = [
+    ('youtube', ('youtube.com',), re.compile(r'/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/|v/)([\w-]{11})')),
+    ('youtube', ('youtu.be',), re.compile(r'/([\w-]{11})')),
+    ('vimeo', ('vimeo.com',), re.compile(r'/(?:video/)?(\d+)')),
+    ('tiktok', ('tiktok.com',), re.compile(r'/@[^/]+/video/(\d+)')),
+    ('twitter', ('twitter.com', 'x.com'), re.compile(r'/[^/]+/status/(\d+)')),
+    ('instagram', ('instagram.com',), re.compile(r'/(?:p|reels?|tv)/([\w-]+)')),
+    ('dailymotion', ('dailymotion.com',), re.compile(r'/video/([a-z0-9]+)')),
+]
+
+TRACKING_PARAMS = {'si', 'feature', 'fbclid', 'gclid', 'igshid', 'igsh', 'ref', 'pp'}
+
+def video_key(url):
+    """Canonical identity of the video behind a URL, e.g. 'youtube:dQw4w9WgXcQ'."""
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or '').rstrip('.')
+    target = f'{parsed.path}?{parsed.query}' if parsed.query else parsed.path
+    for extractor, domains, pattern in VIDEO_ID_PATTERNS:
+        if host not in domains and not host.endswith(tuple('.' + domain for domain in domains)):
+            continue
+        match = pattern.match(target)
+        if match:
+            return f'{extractor}:{match.group(1)}'
+    
+    # Unknown site: fall back to the URL minus the noise that varies per share
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    params = sorted((k, v) for k, v in parse_qsl(parsed.query)
+                    if k not in TRACKING_PARAMS and not k.startswith('utm_'))
+    return f"url:{host}{parsed.path.rstrip('/')}?{urlencode(params)}"
+
+def site_of(url):
+    """What a URL is downloaded from, for per-site limits: an extractor name or a host."""
+    kind, _, rest = video_key(url).partition(':')
+    if kind != 'url':
+        return kind
+    return re.split(r'[/?]', rest, 1)[0] or 'unknown'
+
+def is_private_address(text):
+    address = ipaddress.ip_address(text.split('%')[0])
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return not address.is_global
+
+# What resolving each host showed, so busy hosts are not looked up per request
+host_checks = OrderedDict()
+host_checks_lock = threading.Lock()
+
+def resolves_private(host):
+    """
+    True if any address `host` resolves to is private, loopback, link-local
+    or reserved. Names that do not resolve pass: yt-dlp fails on them anyway.
+    """
+    now = time.monotonic()
+    with host_checks_lock:
+        checked = host_checks.get(host)
+        if checked and checked[1] > now:
+            return checked[0]
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)}
+    except (OSError, UnicodeError):
+        addresses = set()
+    private = any(is_private_address(address) for address in addresses)
+    with host_checks_lock:
+        host_checks[host] = (private, now + HOST_CHECK_TTL)
+        host_checks.move_to_end(host)
+        while len(host_checks) > 10000:
+            host_checks.popitem(last=False)
+    return private
+
+def check_url(url):
+    """
+    Why yt-dlp could not possibly download `url`, or None if it might. Costs
+    microseconds, or one DNS lookup per host every HOST_CHECK_TTL seconds,
+    so bad URLs never reach a worker or a process. Hosts on private networks,
+    by address or by what their name resolves to, are refused: the generic
+    extractor would fetch them for anyone who asks. With URL_POLICY=known
+    the URL must also match a site-specific extractor.
+    """
+    if not isinstance(url, str) or not url.strip():
+        return 'Missing url'
+    url = url.strip()
+    if len(url) > MAX_URL_LENGTH:
+        return f'URL longer than {MAX_URL_LENGTH} characters'
+    if any(c.isspace() or ord(c) < 32 for c in url):
+        return 'Invalid URL'
+    try:
+        parsed = urlparse(url)
+        host = parsed.hostname
+        parsed.port
+    except ValueError:
+        return 'Invalid URL'
+    if parsed.scheme not in ('http', 'https') or not host:
+        return 'Only http and https URLs are supported'
+    if host == 'localhost' or host.endswith(('.localhost', '.local', '.internal')):
+        return 'URL points to a private network'
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        if not re.fullmatch(r'[\w-]+(\.[\w-]+)*\.?', host):
+            return 'Invalid URL'
+        if resolves_private(host.rstrip('.')):
+            return 'URL points to a private network'
+    else:
+        if is_private_address(host):
+            return 'URL points to a private network'
+    if extractor_table is not None and extractor_table.match(url, host) is None:
+        return f'Unsupported URL: {url}'
+    return None
+
+def check_options(format_type, quality, priority=None):
+    """Why a format/quality pair (and priority, if given) is not one we offer, or None."""
+    if format_type not in ('video', 'audio', 'best'):
+        return 'format must be video, audio or best'
+    # isdigit() takes digits such as '²' that int() does not
+    if not isinstance(quality, str) or not (quality == 'best' or re.fullmatch(r'[0-9]{1,4}', quality)):
+        return 'quality must be best or a height such as 720'
+    if priority is not None and priority not in PRIORITIES:
+        return 'priority must be interactive or bulk'
+    return None
+
+# How an extractor's URL pattern spells its host, e.g. https?://(?:www\.)?youtube\.com/
+# or https?://(?:[^/]+\.)?(?:twitter\.com|x\.com)/. Patterns spelled any other way
+# are not indexed by domain and are tried for every URL
+URL_SCHEME = re.compile(r'(?:\(\?P<\w+>)*(?:https?\??:|\(\?:https\?:\)\?)//')
+DOMAIN_LABEL = r'[a-z0-9](?:[a-z0-9]|\\?-)*'
+PATTERN_DOMAIN = re.compile(rf'{DOMAIN_LABEL}(?:\\\.{DOMAIN_LABEL})+', re.IGNORECASE)
+PATTERN_SUBDOMAIN = re.compile(r'\(\?:(?:[^()]|\([^()]*\))*\\\.\)[?*]|(?:\[[^\]]+\]|\\w)[+*]\\\.')
+PATTERN_GROUP = re.compile(r'\((?:\?:|\?P<\w+>)?')
+HOST_ENDS = ('/', ':', '$', '(?:/', '(?:$', '(?:[/', '(?:[?', '(?:[#', '[/', '[?', '[#')
+
+class ExtractorTable:
+    """
+    URL patterns of the site-specific extractors, compiled once at startup
+    and indexed by the domain each names, so a lookup only tries the few
+    patterns for the URL's domain plus those that name none. Taken from the
+    yt_dlp module, which therefore has to be installed.
+    """
+    
+    def __init__(self, entries):
+        self.by_domain = {}
+        self.unindexed = []
+        for name, source in entries:
+            entry = (name, re.compile(source))
+            domains = self._domains(source)
+            if not domains:
+                self.unindexed.append(entry)
+            for domain in domains:
+                self.by_domain.setdefault(domain, []).append(entry)
+        self.size = len(entries)
+
+    @classmethod
+    def _domains(cls, source):
+        """Domains a pattern can match, or an empty set if that cannot be told for sure."""
+        flags = re.match(r'\(\?([aiLmsux]+)\)', source)
+        if flags:
+            source = source[flags.end():]
+            if 'x' in flags.group(1):
+                source = re.sub(r'\s+', '', source)
+        scheme = URL_SCHEME.match(source)
+        if not scheme or '//' in source[scheme.end():]:
+            return set()
+        domains = set()
+        end = cls._host(source, scheme.end(), domains)
+        if end is None or not source.startswith(HOST_ENDS, end):
+            return set()
+        return {cls._domain(domain.replace('\\', '')) for domain in domains}
+
+    @classmethod
+    def _host(cls, source, pos, domains):
+        """Read a host spelled from `pos` into `domains`; where it ends, or None if unreadable."""
+        prefix = PATTERN_SUBDOMAIN.match(source, pos)
+        while prefix:
+            pos = prefix.end()
+            prefix = PATTERN_SUBDOMAIN.match(source, pos)
+        domain = PATTERN_DOMAIN.match(source, pos)
+        if domain:
+            domains.add(domain.group())
+            return domain.end()
+        group = PATTERN_GROUP.match(source, pos)
+        if not group:
+            return None
+        pos = cls._host(source, group.end(), domains)
+        while pos is not None and source.startswith('|', pos):
+            pos = cls._host(source, pos + 1, domains)
+        if pos is None or not source.startswith(')', pos) or source.startswith(('?', '*', '+', '{'), pos + 1):
+            return None
+        return pos + 1
+
+    @staticmethod
+    def _domain(host):
+        return '.'.join(host.lower().rstrip('.').split('.')[-2:])
+    
+    @classmethod
+    def build(cls):
+        from yt_dlp.extractor import gen_extractor_classes
+        entries = []
+        for ie in gen_extractor_classes():
+            patterns = getattr(ie, '_VALID_URL', None)
+            if not patterns or ie.ie_key() == 'Generic':
+                continue
+            for source in [patterns] if isinstance(patterns, str) else patterns:
+                entries.append((ie.ie_key(), source))
+        return cls(entries)
+    
+    def match(self, url, host):
+        """Name of the first extractor whose pattern matches `url`, or None."""
+        for name, pattern in self.by_domain.get(self._domain(host), []) + self.unindexed:
+            if pattern.match(url):
+                return name
+        return None
+
+def make_extractor_table(policy):
+    if policy == 'public':
+        return None
+    if policy != 'known':
+        raise SystemExit(f"Unknown URL_POLICY {policy!r}, expected 'public' or 'known'")
+    # The few sites in VIDEO_ID_PATTERNS would quietly turn away everything else
+    if importlib.util.find_spec('yt_dlp') is None:
+        raise SystemExit("URL_POLICY=known needs the yt_dlp module for its extractor URL patterns "
+                         "(pip install yt-dlp), or use URL_POLICY=public")
+    started = time.monotonic()
+    table = ExtractorTable.build()
+    print(f"🔎 Compiled {table.size} extractor URL patterns in {time.monotonic() - started:.2f}s")
+    return table
+
+extractor_table = make_extractor_table(URL_POLICY)
+
+def cache_key(url, format_type, quality, single_file=False):
+    # Quality only changes the output for video downloads. Single-file
+    # (pipelined) downloads pick different formats, so they are cached apart
+    if single_file:
+        format_type += ':single'
+    return (video_key(url), format_type, quality if format_type.startswith('video') else '-')
+
+def file_id(key):
+    """Stable id for the file a cache key points at, used in /files URLs."""
+    return hashlib.sha256('\0'.join(key).encode()).hexdigest()[:24]
+
+def file_fields(key):
+    fid = file_id(key)
+    return {'fileId': fid, 'fileUrl': f'/files/{fid}'}
+
+def safe_filename(name):
+    return re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', name).strip(' .') or 'download'
+
+def storage_tag(format_type, quality, single_file=False):
+    """What sets a request's file apart from others of the same video, e.g. video-720 or audio."""
+    if single_file:
+        format_type += '-single'
+    return f'{format_type}-{quality}' if format_type.startswith('video') else format_type
+
+def storage_path(info, tag):
+    """
+    Where a download of `info` is stored, without its extension: sharded by
+    site and video ID as <extractor>/<id[:2]>/<id>.<tag>, so videos sharing a
+    title never overwrite each other and no directory grows without bound.
+    None if the info has no ID.
+    """
+    if not info or not info.get('id'):
+        return None
+    extractor = safe_filename(info.get('extractor_key') or info.get('extractor') or 'Generic')
+    vid = safe_filename(str(info['id']))[:100]
+    return os.path.join(DOWNLOAD_DIR, extractor, vid[:2], f'{vid}.{tag}')
+
+def output_template(info, tag, part=''):
+    """yt-dlp output template for storage_path(); without a probe, yt-dlp fills in the same fields."""
+    path = storage_path(info, tag)
+    if path is None:
+        return os.path.join(DOWNLOAD_DIR, '%(extractor_key)s', '%(id).2s', f'%(id)s.{tag}{part}.%(ext)s')
+    return path.replace('%', '%%') + part + '.%(ext)s'
+
+def download_name(filepath, title=None):
+    """Name a download is offered under: its title, rather than the ID it is stored by."""
+    if not title:
+        return os.path.basename(filepath)
+    return safe_filename(title + os.path.splitext(filepath)[1])
+
+class DownloadCache:
+    """
+    Persistent index of finished downloads, stored in SQLite next to the
+    files so it survives restarts. It maps each cache key (and file id) to
+    the file's path, size and title, so a file is found by key rather than
+    by looking through DOWNLOAD_DIR. Entries expire `max_age` seconds after
+    their last use; StorageManager decides when to evict the rest.
+    """
+    
+    def __init__(self, path, max_age=CACHE_MAX_AGE):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                video_key TEXT NOT NULL,
+                format TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                filepath TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                share_url TEXT,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                file_id TEXT,
+                title TEXT,
+                PRIMARY KEY (video_key, format, quality)
+            )
+        """)
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(downloads)')]
+        if 'file_id' not in columns:
+            # Caches created before /files existed
+            self.db.execute('ALTER TABLE downloads ADD COLUMN file_id TEXT')
+            for key in self.db.execute('SELECT video_key, format, quality FROM downloads').fetchall():
+                self.db.execute('UPDATE downloads SET file_id = ? '
+                                'WHERE video_key = ? AND format = ? AND quality = ?', (file_id(key), *key))
+        if 'title' not in columns:
+            # Files of older caches are named after their title already
+            self.db.execute('ALTER TABLE downloads ADD COLUMN title TEXT')
+        self.db.execute('CREATE INDEX IF NOT EXISTS downloads_lru ON downloads (last_access)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS downloads_file ON downloads (file_id)')
+    
+    def lookup(self, key):
+        """Return the cached entry for `key`, or None if missing or gone from disk."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT filepath, size, share_url, title FROM downloads '
+                'WHERE video_key = ? AND format = ? AND quality = ?', key).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row[0]):
+                self._delete(key)
+                return None
+            self.db.execute(
+                'UPDATE downloads SET last_access = ? '
+                'WHERE video_key = ? AND format = ? AND quality = ?', (time.time(), *key))
+        return {'filepath': row[0], 'size': row[1], 'shareUrl': row[2], 'title': row[3]}
+    
+    def find_file(self, fid):
+        """`{'filepath', 'title'}` of the cached file with id `fid`, or None; counts as a use for eviction."""
+        with self.lock:
+            row = self.db.execute('SELECT filepath, title FROM downloads WHERE file_id = ?', (fid,)).fetchone()
+            if row is None or not os.path.exists(row[0]):
+                return None
+            self.db.execute('UPDATE downloads SET last_access = ? WHERE file_id = ?', (time.time(), fid))
+        return {'filepath': row[0], 'title': row[1]}
+    
+    def store(self, key, filepath, share_url=None, title=None):
+        now = time.time()
+        with self.lock:
+            # Files of the old title-named layout are not unique, so a new
+            # download may have overwritten the file another entry pointed at
+            self.db.execute('DELETE FROM downloads WHERE filepath = ?', (filepath,))
+            self.db.execute(
+                'INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (*key, filepath, os.path.getsize(filepath), share_url, now, now, file_id(key), title))
+    
+    def set_share_url(self, key, share_url):
+        with self.lock:
+            self.db.execute(
+                'UPDATE downloads SET share_url = ? '
+                'WHERE video_key = ? AND format = ? AND quality = ?', (share_url, *key))
+    
+    def stats(self):
+        with self.lock:
+            count, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM downloads').fetchone()
+        return {'entries': count, 'bytes': size}
+    
+    def contains(self, key):
+        """Whether `key` is cached, without counting as a use."""
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM downloads WHERE video_key = ? AND format = ? AND quality = ?',
+                                   key).fetchone() is not None
+    
+    def has_file(self, filepath):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM downloads WHERE filepath = ?', (filepath,)).fetchone() is not None
+    
+    def evict_expired(self, limit):
+        """Evict up to `limit` entries unused for `max_age`; returns `(count, bytes freed)`."""
+        return self._evict('WHERE last_access < ?', (time.time() - self.max_age,), limit)
+    
+    def evict_lru(self, limit):
+        """Evict the `limit` least recently used entries; returns `(count, bytes freed)`."""
+        return self._evict('', (), limit)
+    
+    def _evict(self, where, params, limit):
+        with self.lock:
+            rows = self.db.execute(
+                f'SELECT video_key, format, quality, filepath, size FROM downloads {where} '
+                'ORDER BY last_access LIMIT ?', (*params, limit)).fetchall()
+            for *key, filepath, size in rows:
+                self._delete(tuple(key))
+        # Unlinking a large file can take a while; lookups need not wait for it
+        for *key, filepath, size in rows:
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+        return len(rows), sum(row[-1] for row in rows)
+    
+    def _delete(self, key):
+        self.db.execute('DELETE FROM downloads WHERE video_key = ? AND format = ? AND quality = ?', key)
+
+download_cache = DownloadCache(CACHE_DB)
+
+# Leftovers of interrupted yt-dlp runs: partial downloads, fragment state,
+# per-format files awaiting a merge, and our own side files
+PARTIAL_FILE = re.compile(r'(\.part(-Frag\d+)?|\.ytdl|\.temp\.\w+|\.f\d+\.\w+|\.title)$')
+
+class StorageManager:
+    """
+    Keeps DOWNLOAD_DIR within its byte budget and the disk from filling up.
+    A janitor thread evicts cached files least-recently-used first once
+    usage crosses the high watermark, a small batch at a time so lookups
+    are never held up, until it is back under the low watermark. It also
+    deletes partial files that aborted downloads left behind: the whole
+    tree is walked once after a start, and from then on only the top level
+    and the directories downloads have written to lately. Downloads
+    reserve their estimated size before starting and wait for the janitor
+    to make room when there is none.
+    """
+    
+    def __init__(self, cache, directory, budget=CACHE_MAX_BYTES, high=STORAGE_HIGH_WATERMARK,
+                 low=STORAGE_LOW_WATERMARK, min_free=MIN_FREE_BYTES):
+        self.cache = cache
+        self.directory = directory
+        self.budget = budget
+        self.high = high
+        self.low = low
+        self.min_free = min_free
+        self.cond = threading.Condition()
+        self.reserved = 0
+        self.waiting = 0
+        self.wakeup = threading.Event()
+        self.evicted = 0
+        self.swept = 0
+        # Directories downloads write to, by when they last did
+        self.recent_dirs = {}
+        self.dirs_lock = threading.Lock()
+        self.walked = False
+    
+    def start(self):
+        self.wakeup.set()
+        threading.Thread(target=self._run, name='storage-janitor', daemon=True).start()
+    
+    def wake(self):
+        self.wakeup.set()
+    
+    def _usage(self, pending):
+        """Bytes counted against the budget and bytes left on disk, with `pending` more written."""
+        used = self.cache.stats()['bytes'] + pending
+        free = shutil.disk_usage(self.directory).free - pending
+        return used, free
+    
+    def _run(self):
+        while True:
+            self.wakeup.wait(JANITOR_INTERVAL)
+            self.wakeup.clear()
+            try:
+                self.sweep()
+                self.collect()
+            except Exception as e:
+                print(f"⚠️  Storage janitor: {e}")
+    
+    def collect(self):
+        """Evict expired entries, then LRU ones if over the high watermark, down to the low one."""
+        while self._evicted(self.cache.evict_expired(EVICT_BATCH)):
+            pass
+        with self.cond:
+            pending = self.reserved + self.waiting
+        used, free = self._usage(pending)
+        if used <= self.budget * self.high and free >= self.min_free:
+            return
+        print(f"🧹 Storage at {used / 1024 ** 3:.1f} GiB with {max(free, 0) / 1024 ** 3:.1f} GiB free, evicting")
+        while used > self.budget * self.low or free < self.min_free:
+            if not self._evicted(self.cache.evict_lru(EVICT_BATCH)):
+                break
+            used, free = self._usage(pending)
+    
+    def _evicted(self, result):
+        count, _ = result
+        if count:
+            self.evicted += count
+            with self.cond:
+                self.cond.notify_all()
+        return count
+    
+    def note_dir(self, path):
+        """Record that a download writes into directory `path`, for the next sweeps."""
+        with self.dirs_lock:
+            self.recent_dirs[path] = time.time()
+    
+    def sweep(self):
+        """Delete partial files older than any download could still be running."""
+        cutoff = time.time() - DOWNLOAD_TIMEOUT - 60
+        with self.dirs_lock:
+            directories = [self.directory, *self.recent_dirs]
+            # A directory is swept once more after its last download could have ended
+            for path, written in list(self.recent_dirs.items()):
+                if written < cutoff:
+                    del self.recent_dirs[path]
+        if not self.walked:
+            self.walked = True
+            directories = []
+            for path, subdirs, _ in os.walk(self.directory):
+                # Hidden ones hold our own files, such as probed info JSON
+                subdirs[:] = [name for name in subdirs if not name.startswith('.')]
+                directories.append(path)
+        for directory in directories:
+            self._sweep_dir(directory, cutoff)
+    
+    def _sweep_dir(self, directory, cutoff):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+        for entry in entries:
+            if not (entry.is_file() and PARTIAL_FILE.search(entry.name)):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff and not self.cache.has_file(entry.path):
+                    os.remove(entry.path)
+                    self.swept += 1
+            except OSError:
+                pass
+    
+    def admit(self, size, progress=None):
+        """
+        Reserve room for a download of about `size` bytes (None if unknown),
+        waiting up to ADMISSION_WAIT seconds for the janitor to free some.
+        Returns `(reservation, error)`; pass the reservation to release().
+        """
+        size = size or 0
+        if size > self.budget * self.high:
+            return 0, (f'Download too large: about {size / 1024 ** 2:.0f} MiB, '
+                       f'storage budget is {self.budget / 1024 ** 2:.0f} MiB')
+        deadline = time.monotonic() + ADMISSION_WAIT
+        with self.cond:
+            self.waiting += size
+            try:
+                while True:
+                    used, free = self._usage(self.reserved + size)
+                    if used <= self.budget * self.high and free >= self.min_free:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return 0, 'Not enough storage space, try again later'
+                    if progress:
+                        progress({'phase': 'storage'})
+                    self.wake()
+                    self.cond.wait(min(remaining, 5))
+                self.reserved += size
+            finally:
+                self.waiting -= size
+        return size, None
+    
+    def release(self, reservation):
+        with self.cond:
+            self.reserved -= reservation
+            self.cond.notify_all()
+        self.wake()
+    
+    def stats(self):
+        with self.cond:
+            reserved = self.reserved
+        used, free = self._usage(0)
+        return {
+            'budgetBytes': self.budget,
+            'usedBytes': used,
+            'reservedBytes': reserved,
+            'freeBytes': free,
+            'evicted': self.evicted,
+            'swept': self.swept
+        }
+
+storage = StorageManager(download_cache, DOWNLOAD_DIR)
+
+class SingleFlight:
+    """
+    Collapses concurrent calls that share a key into one execution: the
+    first caller runs the function and everyone who arrives while it is
+    running waits for, and gets, the same return value.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+    
+    def do(self, key, fn):
+        """Return `(result, shared)`, where `shared` is True for callers that piggybacked."""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        
+        if not leader:
+            call['done'].wait()
+        else:
+            try:
+                call['result'] = fn()
+            except Exception as e:
+                call['error'] = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call['done'].set()
+        
+        if call['error'] is not None:
+            raise call['error']
+        return call['result'], not leader
+
+download_flights = SingleFlight()
+upload_flights = SingleFlight()
+
+def estimate_size(info, format_type, quality):
+    """Rough byte size of what a request would download, from probe metadata."""
+    duration = info.get('duration') or 0
+    
+    def size(f):
+        if f.get('filesize') or f.get('filesize_approx'):
+            return f.get('filesize') or f.get('filesize_approx')
+        # Bitrates are in kbit/s
+        return (f.get('tbr') or 0) * 125 * duration or None
+    
+    formats = info.get('formats') or []
+    audio = [size(f) for f in formats if f.get('vcodec') == 'none' and f.get('acodec') != 'none']
+    best_audio = max((s for s in audio if s), default=0)
+    if format_type == 'audio':
+        return best_audio or None
+    
+    limit = None if format_type == 'best' or quality == 'best' else int(quality)
+    video = [size(f) for f in formats
+             if f.get('vcodec') not in (None, 'none') and (limit is None or (f.get('height') or 0) <= limit)]
+    best_video = max((s for s in video if s), default=0)
+    return (best_video + best_audio) or None
+
+# Job priority classes, the first one favoured
+PRIORITIES = ('interactive', 'bulk')
+
+def job_priority(info, format_type, quality):
+    """Priority class of a download by its probe: 'bulk' if long or large, else 'interactive'."""
+    size = estimate_size(info, format_type, quality) or 0
+    if (info.get('duration') or 0) > INTERACTIVE_MAX_DURATION or size > INTERACTIVE_MAX_BYTES:
+        return 'bulk'
+    return 'interactive'
+
+def summarize_info(info):
+    """The parts of a yt-dlp info dict that /info clients care about."""
+    heights = sorted({f['height'] for f in info.get('formats') or [] if f.get('height')})
+    return {
+        'id': info.get('id'),
+        'extractor': info.get('extractor_key') or info.get('extractor'),
+        'title': info.get('title'),
+        'uploader': info.get('uploader'),
+        'duration': info.get('duration'),
+        'thumbnail': info.get('thumbnail'),
+        'heights': heights,
+        'estimatedSize': {
+            **{str(h): estimate_size(info, 'video', str(h)) for h in heights},
+            'best': estimate_size(info, 'best', 'best'),
+            'audio': estimate_size(info, 'audio', 'best')
+        }
+    }
+
+class InfoCache:
+    """
+    Time-limited cache of yt-dlp extraction results. Each info dict is also
+    written to disk so downloads that follow a probe can hand it to yt-dlp
+    with --load-info-json and skip extracting the page a second time. The
+    TTL stays well under the lifetime of the signed media URLs inside.
+    Failed probes are remembered for a shorter while, so a bad URL asked for
+    again and again does not start yt-dlp each time.
+    """
+    
+    def __init__(self, directory, ttl=INFO_CACHE_TTL, max_entries=INFO_CACHE_SIZE, error_ttl=INFO_ERROR_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # video key -> (error, expiry)
+        self.failures = OrderedDict()
+        self.flights = SingleFlight()
+        os.makedirs(directory, exist_ok=True)
+    
+    def purge(self):
+        """Remove every entry, including info files left behind by a previous run."""
+        with self.lock:
+            self.entries.clear()
+            self.failures.clear()
+            for name in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, name))
+    
+    def _fresh(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry['expires'] < time.time():
+            self._drop(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+    
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        try:
+            os.remove(entry['path'])
+        except OSError:
+            pass
+    
+    def get(self, url):
+        """Return `(info, cached)`, probing with yt-dlp on a miss; raises on failure."""
+        key = video_key(url)
+        with self.lock:
+            entry = self._fresh(key)
+            failure = self.failures.get(key)
+            if failure and failure[1] < time.time():
+                del self.failures[key]
+                failure = None
+        CACHE_REQUESTS.inc(cache='info', result='hit' if entry or failure else 'miss')
+        if entry:
+            return entry['info'], True
+        if failure:
+            raise RuntimeError(failure[0])
+        
+        (info, error), _ = self.flights.do(key, lambda: download_engine.extract_info(url))
+        if error:
+            if self.error_ttl > 0:
+                with self.lock:
+                    self.failures[key] = (error, time.time() + self.error_ttl)
+                    self.failures.move_to_end(key)
+                    while len(self.failures) > self.max_entries:
+                        self.failures.popitem(last=False)
+            raise RuntimeError(error)
+        self.store(key, info)
+        return info, False
+    
+    def peek(self, url):
+        """Cached info for `url`, or None; never probes."""
+        with self.lock:
+            entry = self._fresh(video_key(url))
+        return entry['info'] if entry else None
+    
+    def info_path(self, url):
+        """Path of a fresh info JSON for `url` usable with --load-info-json, or None."""
+        with self.lock:
+            entry = self._fresh(video_key(url))
+        return entry['path'] if entry else None
+    
+    def store(self, key, info):
+        path = os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.info.json')
+        with open(path, 'w') as f:
+            json.dump(info, f)
+        with self.lock:
+            self.entries[key] = {'info': info, 'path': path, 'expires': time.time() + self.ttl}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+
+# Replicas share DOWNLOAD_DIR but each purges its own info files on start
+info_cache = InfoCache(os.path.join(DOWNLOAD_DIR, f'.info-{NODE_ID}' if CLUSTER else '.info'))
+
+def download_video(url, format_type, quality, progress=None, defer=False, processes=None, priority='interactive'):
+    """
+    Fetch a single URL with yt-dlp and report where the file ended up.
+    Previously downloaded videos are served from the cache without running
+    yt-dlp at all; their result carries the cached share URL, if any.
+    `progress` is called with a progress dict as yt-dlp reports it. With
+    `defer`, a download still to be merged or converted returns as soon as
+    it is fetched, with the Future of the final result under 'pending'.
+    yt-dlp and ffmpeg run as `processes`, the job's JobProcesses, and
+    yt-dlp gets the bandwidth of a `priority` class download.
+    """
+    key = cache_key(url, format_type, quality)
+    cached = download_cache.lookup(key)
+    CACHE_REQUESTS.inc(cache='download', result='hit' if cached else 'miss')
+    if cached:
+        return {
+            'success': True,
+            'filename': download_name(cached['filepath'], cached['title']),
+            'filepath': cached['filepath'],
+            'path': DOWNLOAD_DIR,
+            'shareUrl': cached['shareUrl'],
+            **file_fields(key),
+            'cached': True,
+            'coalesced': False
+        }
+    
+    # Identical requests racing each other share one yt-dlp run, which also
+    # keeps them from writing to the same output path at once
+    result, shared = download_flights.do(
+        key, lambda: _fetch(url, format_type, quality, key, progress, processes, priority))
+    if 'pending' in result and not defer:
+        result = result['pending'].result()
+    return dict(result, coalesced=shared)
+
+# yt-dlp progress lines we ask for with --progress-template; fields that are
+# unknown at the time come through as "NA"
+PROGRESS_TEMPLATES = [
+    'download:[progress:download] %(progress.downloaded_bytes)s %(progress.total_bytes)s '
+    '%(progress.total_bytes_estimate)s %(progress.speed)s %(progress.eta)s',
+    'postprocess:[progress:postprocess] %(progress.status)s %(progress.postprocessor)s',
+]
+RESULT_PREFIX = '[result] '
+
+def _number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def parse_progress(line):
+    """Turn one templated yt-dlp progress line into a progress dict, or None."""
+    if line.startswith('[progress:download] '):
+        fields = line.split()[1:]
+        if len(fields) != 5:
+            return None
+        downloaded, total, estimate, speed, eta = (_number(f) for f in fields)
+        total = total or estimate
+        return {
+            'phase': 'download',
+            'downloadedBytes': downloaded,
+            'totalBytes': total,
+            'percent': round(downloaded * 100 / total, 1) if downloaded and total else None,
+            'speed': speed,
+            'eta': eta
+        }
+    if line.startswith('[progress:postprocess] '):
+        fields = line.split()
+        return {
+            'phase': 'merge',
+            'postprocessor': fields[2] if len(fields) > 2 else None
+        }
+    return None
+
+def download_spec(format_type, quality, info=None):
+    """What yt-dlp should fetch for a request, whichever engine ends up running it."""
+    spec = {
+        'format': None,
+        'audio_format': None,
+        'merge_output_format': 'mp4',
+        'outtmpl': output_template(info, storage_tag(format_type, quality))
+    }
+    if format_type == 'audio':
+        spec['audio_format'] = AUDIO_FORMAT
+    elif format_type == 'best':
+        spec['format'] = 'bestvideo+bestaudio/best'
+    elif quality == 'best':
+        spec['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+    else:
+        spec['format'] = f'bestvideo[height<={quality}][ext=mp4]+bestaudio[ext=m4a]/best[height<={quality}][ext=mp4]/best'
+    return spec
+
+def timeout_error():
+    limit = f'{DOWNLOAD_TIMEOUT // 60} min' if DOWNLOAD_TIMEOUT % 60 == 0 else f'{DOWNLOAD_TIMEOUT}s'
+    return f'Download timed out ({limit} limit)'
+
+def probe(url):
+    """
+    `(info, error)` for `url`; the download then reuses the probe. A URL
+    that cannot be extracted would fail the download the same way.
+    """
+    try:
+        info, _ = info_cache.get(url)
+    except Exception as e:
+        return None, str(e)
+    return info, None
+
+def _fetch(url, format_type, quality, key, progress=None, processes=None, priority='interactive'):
+    processes = processes or JobProcesses()
+    if progress:
+        progress({'phase': 'extract'})
+    info, error = probe(url)
+    if error:
+        return {'success': False, 'error': error}
+    plan = plan_streams(info, format_type, quality) if postprocessor.enabled else None
+    size = estimate_size(info, format_type, quality)
+    title = info.get('title')
+    # A merge or conversion briefly needs room for its input and its output
+    reservation, error = storage.admit(size * 2 if size and plan else size, progress)
+    if error:
+        return {'success': False, 'error': error}
+    handed_over = False
+    stored = storage_path(info, storage_tag(format_type, quality))
+    if stored:
+        storage.note_dir(os.path.dirname(stored))
+    rate = bandwidth_budget.acquire(priority)
+    try:
+        # Hand yt-dlp the probe above instead of extracting the page again
+        info_json = info_cache.info_path(url)
+        if plan:
+            paths, error = fetch_streams(url, plan, info_json, progress, processes, rate)
+            if error:
+                return {'success': False, 'error': error}
+            if progress:
+                progress({'phase': 'merge', 'postprocessor': 'waiting'})
+            pending = postprocessor.submit(_postprocess, plan, paths, key, reservation, progress, processes)
+            handed_over = True
+            return {'success': True, 'pending': pending}
+        
+        spec = download_spec(format_type, quality, info)
+        spec['info_json'] = info_json
+        spec['rate'] = rate
+        filepath, error = fetch(url, spec, FRAGMENT_CONCURRENCY, progress, processes)
+        if error:
+            return {'success': False, 'error': error}
+        
+        if not filepath or not os.path.exists(filepath):
+            return {'success': False, 'error': 'Download finished but the output file is missing'}
+        storage.note_dir(os.path.dirname(filepath))
+        download_cache.store(key, filepath, title=title)
+        return fetched(key, filepath, title)
+        
+    except Exception as e:
+        return {'success': False, 'error': str(e)}
+    finally:
+        bandwidth_budget.release(priority, rate)
+        if not handed_over:
+            storage.release(reservation)
+
+def fetched(key, filepath, title=None):
+    """Result of a download that just finished as `filepath`."""
+    return {
+        'success': True,
+        'filename': download_name(filepath, title),
+        'filepath': filepath,
+        'path': DOWNLOAD_DIR,
+        'shareUrl': None,
+        **file_fields(key),
+        'cached': False
+    }
+
+# Codecs an MP4 file takes as they are, by codec string prefix
+MP4_VIDEO_CODECS = ('avc1', 'avc3', 'h264', 'hev1', 'hvc1', 'av01', 'vp09', 'vp9')
+MP4_AUDIO_CODECS = ('mp4a', 'aac', 'mp3', 'opus', 'flac', 'alac', 'ac-3', 'ec-3')
+# How ffmpeg produces each AUDIO_FORMAT, and the source codecs it can just copy
+AUDIO_TARGETS = {
+    'mp3': {'encoder': ['libmp3lame', '-q:a', '5'], 'muxer': 'mp3', 'copy': ('mp3',)},
+    'm4a': {'encoder': ['aac', '-b:a', '192k'], 'muxer': 'ipod', 'copy': ('mp4a', 'aac')},
+}
+
+def codec_in(codec, prefixes):
+    return bool(codec) and codec.lower().startswith(prefixes)
+
+def plan_streams(info, format_type, quality):
+    """
+    How to fetch a request as separate streams and finish it with ffmpeg:
+    the video and audio formats (the same ones download_spec() asks yt-dlp
+    for), what to do with the audio, copy or an encoder, and where the
+    streams are saved. Returns None when there is nothing to merge or
+    convert, or the formats are unknown, and yt-dlp handles the request on
+    its own.
+    """
+    formats = info.get('formats') or []
+    # Each stream is saved under yt-dlp's own name for a part of a merge, so the janitor knows it
+    outtmpl = output_template(info, storage_tag(format_type, quality), '.f%(format_id)s')
+    # yt-dlp lists formats worst first
+    audio = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    if format_type == 'audio':
+        target = AUDIO_TARGETS.get(AUDIO_FORMAT)
+        if target is None or not audio:
+            return None
+        # A source already in the target codec is worth more than a few kbit/s
+        same = [f for f in audio if codec_in(f.get('acodec'), target['copy'])]
+        source = (same or audio)[-1]
+        return {'video': None, 'audio': source, 'ext': AUDIO_FORMAT, 'muxer': target['muxer'],
+                'audio_codec': ['copy'] if same else target['encoder'], 'outtmpl': outtmpl,
+                'title': info.get('title')}
+    
+    limit = None if format_type == 'best' or quality == 'best' else int(quality)
+    any_ext = format_type == 'best'
+    video = [f for f in formats if f.get('vcodec') not in (None, 'none') and f.get('acodec') == 'none'
+             and (limit is None or (f.get('height') or 0) <= limit) and (any_ext or f.get('ext') == 'mp4')]
+    audio = [f for f in audio if any_ext or f.get('ext') == 'm4a']
+    if not video or not audio or not codec_in(video[-1].get('vcodec'), MP4_VIDEO_CODECS):
+        return None
+    copy = codec_in(audio[-1].get('acodec'), MP4_AUDIO_CODECS)
+    return {'video': video[-1], 'audio': audio[-1], 'ext': 'mp4', 'muxer': 'mp4',
+            'audio_codec': ['copy'] if copy else ['aac', '-b:a', '192k'], 'outtmpl': outtmpl,
+            'title': info.get('title')}
+
+class ConnectionBudget:
+    """
+    Cap on the connections all downloads together hold to media servers.
+    A download asks for as many as it could use and gets what is free, but
+    no more than an even share with the downloads already holding some and
+    never less than one, waiting only when none are free. Parallel fragment
+    fetching inside a job therefore shrinks as more jobs run, instead of
+    the jobs together oversubscribing the link.
+    """
+    
+    def __init__(self, total=DOWNLOAD_CONNECTIONS):
+        self.total = max(total, 1)
+        self.used = 0
+        self.holders = 0
+        self.cond = threading.Condition()
+    
+    def acquire(self, wanted):
+        with self.cond:
+            self.cond.wait_for(lambda: self.used < self.total)
+            share = max(self.total // (self.holders + 1), 1)
+            granted = max(min(wanted, self.total - self.used, share), 1)
+            self.used += granted
+            self.holders += 1
+            return granted
+    
+    def release(self, granted):
+        with self.cond:
+            self.used -= granted
+            self.holders -= 1
+            self.cond.notify_all()
+    
+    def stats(self):
+        with self.cond:
+            return {'total': self.total, 'used': self.used, 'downloads': self.holders}
+
+connection_budget = ConnectionBudget()
+
+class BandwidthBudget:
+    """
+    Split of BANDWIDTH_LIMIT bytes/s between running downloads, handed to
+    yt-dlp as --limit-rate when a download starts. A rate cannot change
+    while yt-dlp runs, so a download taking idle bandwidth would leave
+    nothing for the next one; each gets a fixed slice instead, sized so
+    that the slices add up to no more than the budget however the workers
+    are busy. Bulk downloads share BULK_BANDWIDTH_SHARE of the budget over
+    the BULK_WORKERS they may use; interactive ones get what that leaves
+    per worker.
+    """
+    
+    def __init__(self, total=BANDWIDTH_LIMIT, bulk_share=BULK_BANDWIDTH_SHARE, bulk_slots=BULK_WORKERS,
+                 slots=DOWNLOAD_WORKERS):
+        if total and not 0 < bulk_share < 1:
+            raise SystemExit(f"BULK_BANDWIDTH_SHARE must be between 0 and 1, not {bulk_share}")
+        self.total = total
+        slots = max(slots, 1)
+        bulk_slots = min(max(bulk_slots, 1), slots)
+        self.rates = {'bulk': total * bulk_share / bulk_slots, 'interactive': total / slots}
+        if bulk_slots < slots:
+            # With every bulk slot taken, the other workers still fit
+            self.rates['interactive'] = min(self.rates['interactive'],
+                                            (total - bulk_slots * self.rates['bulk']) / (slots - bulk_slots))
+        self.holders = dict.fromkeys(PRIORITIES, 0)
+        self.granted = 0
+        self.lock = threading.Lock()
+    
+    def acquire(self, priority):
+        """Rate in bytes/s for a download of class `priority`, or None without a budget."""
+        if not self.total:
+            return None
+        with self.lock:
+            # Short only with more downloads than workers; crawl rather than go unlimited
+            rate = max(min(self.rates[priority], self.total - self.granted), 1)
+            self.holders[priority] += 1
+            self.granted += rate
+            return rate
+    
+    def release(self, priority, rate):
+        if self.total:
+            with self.lock:
+                self.holders[priority] -= 1
+                self.granted -= rate
+    
+    def stats(self):
+        with self.lock:
+            return {'total': self.total, 'granted': round(self.granted),
+                    'rates': {priority: round(rate) for priority, rate in self.rates.items()},
+                    'downloads': dict(self.holders)}
+
+bandwidth_budget = BandwidthBudget()
+
+def fragmented(fmt):
+    """Whether a format comes in fragments (DASH, HLS...) that can be fetched in parallel; True if unknown."""
+    return fmt is None or (fmt.get('protocol') or 'https') not in ('http', 'https')
+
+def fetch(url, spec, wanted, progress=None, processes=None):
+    """download_engine.download() with as many parallel fragments as the connection budget allows."""
+    granted = connection_budget.acquire(wanted)
+    try:
+        return download_engine.download(url, dict(spec, fragments=granted), progress, processes)
+    finally:
+        connection_budget.release(granted)
+
+def combine_progress(progress, streams):
+    """
+    Progress callback factory for `streams` downloads running side by side:
+    each one's updates are summed with the latest of the others, so the job
+    reports a single download.
+    """
+    latest = {}
+    lock = threading.Lock()
+    
+    def for_stream(stream):
+        def report(update):
+            if update.get('phase') != 'download':
+                progress(update)
+                return
+            with lock:
+                latest[stream] = update
+                updates = list(latest.values())
+            downloaded = sum(u.get('downloadedBytes') or 0 for u in updates)
+            totals = [u.get('totalBytes') for u in updates]
+            total = sum(totals) if all(totals) and len(updates) == streams else None
+            speeds = [u['speed'] for u in updates if u.get('speed')]
+            etas = [u['eta'] for u in updates if u.get('eta') is not None]
+            progress({
+                'phase': 'download',
+                'downloadedBytes': downloaded,
+                'totalBytes': total,
+                'percent': round(downloaded * 100 / total, 1) if downloaded and total else None,
+                'speed': sum(speeds) if speeds else None,
+                'eta': max(etas) if etas else None
+            })
+        return report
+    return for_stream
+
+def split_rate(rate, formats):
+    """
+    Share `rate` between formats fetched side by side, by bitrate where
+    known so that they finish together, else evenly.
+    """
+    for field in ('tbr', 'filesize', 'filesize_approx'):
+        weights = [f.get(field) or 0 for f in formats]
+        if all(weights):
+            return [rate * weight / sum(weights) for weight in weights]
+    return [rate / len(formats)] * len(formats)
+
+def fetch_streams(url, plan, info_json, progress=None, processes=None, rate=None):
+    """
+    Download the streams of `plan` side by side, each as it is, at `rate`
+    bytes/s together if given; returns `(paths, error)`.
+    """
+    streams = [stream for stream in ('video', 'audio') if plan[stream]]
+    reporter = combine_progress(progress, len(streams)) if progress else None
+    rates = dict(zip(streams, split_rate(rate, [plan[stream] for stream in streams]))) if rate else {}
+    results = {}
+    
+    def run(stream):
+        fmt = plan[stream]
+        spec = {
+            'format': fmt['format_id'],
+            'audio_format': None,
+            'merge_output_format': 'mp4',
+            'outtmpl': plan['outtmpl'],
+            'info_json': info_json,
+            'rate': rates.get(stream)
+        }
+        try:
+            results[stream] = fetch(url, spec, FRAGMENT_CONCURRENCY if fragmented(fmt) else 1,
+                                    reporter(stream) if reporter else None, processes)
+        except Exception as e:
+            results[stream] = None, str(e)
+    
+    helpers = [threading.Thread(target=run, args=(stream,), name=f'fetch-{stream}', daemon=True)
+               for stream in streams[1:]]
+    for helper in helpers:
+        helper.start()
+    run(streams[0])
+    for helper in helpers:
+        helper.join()
+    
+    errors = [results[stream][1] for stream in streams if results[stream][1]]
+    if errors:
+        return None, errors[0]
+    return [results[stream][0] for stream in streams], None
+
+class JobCgroups:
+    """
+    cgroup v2 limits on the processes of each job taken together: memory,
+    CPU share and number of processes, plus a way to kill all of them even
+    if one left its session. Only used where this process may manage its
+    own cgroup, e.g. a systemd unit with Delegate=yes: the server moves into
+    a leaf of that cgroup and every job gets a sibling of it.
+    """
+    
+    CONTROLLERS = ('memory', 'cpu', 'pids')
+    
+    def __init__(self, root, controllers):
+        self.root = root
+        self.controllers = controllers
+    
+    @classmethod
+    def setup(cls, mode=JOB_CGROUPS):
+        """JobCgroups under this process's cgroup, or None where that cannot be used."""
+        if mode == 'off':
+            return None
+        if mode != 'auto':
+            raise SystemExit(f"Unknown JOB_CGROUPS {mode!r}, expected 'auto' or 'off'")
+        try:
+            with open('/proc/self/cgroup') as f:
+                paths = [line[3:].strip() for line in f if line.startswith('0::')]
+        except OSError:
+            return None
+        # Without a unified hierarchy, or without the right to change it, rlimits have to do
+        root = '/sys/fs/cgroup' + paths[0] if paths else None
+        if root is None or not os.access(os.path.join(root, 'cgroup.subtree_control'), os.W_OK):
+            return None
+        try:
+            with open(os.path.join(root, 'cgroup.controllers')) as f:
+                controllers = [c for c in f.read().split() if c in cls.CONTROLLERS]
+            if not controllers:
+                return None
+            # A cgroup that hands controllers to its children cannot hold processes itself
+            os.makedirs(os.path.join(root, 'server'), exist_ok=True)
+            cls._write(os.path.join(root, 'server', 'cgroup.procs'), os.getpid())
+            cls._write(os.path.join(root, 'cgroup.subtree_control'), ' '.join('+' + c for c in controllers))
+        except OSError as e:
+            print(f"⚠️  Per-job cgroups unavailable ({e}), limiting jobs with rlimits only")
+            return None
+        cgroups = cls(root, controllers)
+        # Jobs of a previous run whose processes outlived it
+        for name in os.listdir(root):
+            if name.startswith('job-'):
+                cgroups.remove(os.path.join(root, name))
+        print(f"🧱 Per-job cgroups under {root} ({', '.join(controllers)})")
+        return cgroups
+    
+    @staticmethod
+    def _write(path, value):
+        with open(path, 'w') as f:
+            f.write(str(value))
+    
+    def create(self, name):
+        """Make the cgroup for job `name` and return its path, or None."""
+        path = os.path.join(self.root, f'job-{name}')
+        limits = []
+        if 'memory' in self.controllers and JOB_MEMORY_LIMIT > 0:
+            limits.append(('memory.max', JOB_MEMORY_LIMIT))
+        if 'cpu' in self.controllers and JOB_CPUS > 0:
+            limits.append(('cpu.max', f'{int(JOB_CPUS * 100000)} 100000'))
+        if 'pids' in self.controllers and JOB_MAX_PROCESSES > 0:
+            limits.append(('pids.max', JOB_MAX_PROCESSES))
+        try:
+            os.mkdir(path)
+            for limit, value in limits:
+                self._write(os.path.join(path, limit), value)
+        except OSError as e:
+            print(f"⚠️  Could not set up cgroup {path}: {e}")
+            self.remove(path)
+            return None
+        return path
+    
+    @staticmethod
+    def enter_prefix(path):
+        """
+        Command to start a child behind so that it moves into the cgroup at
+        `path` before it execs, and so before it can start anything of its
+        own. If the move fails, the child exits instead.
+        """
+        return ['sh', '-c', 'echo $$ > "$0/cgroup.procs" && exec "$@"', path]
+    
+    def kill(self, path):
+        """SIGKILL every process in the cgroup."""
+        try:
+            self._write(os.path.join(path, 'cgroup.kill'), 1)
+        except OSError:
+            pass
+    
+    def remove(self, path):
+        """Kill what is left in the cgroup and delete it; returns its peak memory in bytes, 0 if unknown."""
+        try:
+            with open(os.path.join(path, 'memory.peak')) as f:
+                peak = int(f.read())
+        except (OSError, ValueError):
+            peak = 0
+        self.kill(path)
+        # Killed processes leave the cgroup asynchronously
+        for _ in range(20):
+            try:
+                os.rmdir(path)
+                break
+            except FileNotFoundError:
+                break
+            except OSError:
+                time.sleep(0.05)
+        return peak
+
+# Set up by run_server(): setting up moves this process to another cgroup
+# and removes leftover job cgroups, which importing the module must not do
+job_cgroups = None
+
+# Limits every child process gets: writable memory (not address space, which
+# JS runtimes reserve far beyond what they use), CPU seconds and open files
+PROCESS_RLIMITS = [
+    (resource.RLIMIT_DATA, JOB_MEMORY_LIMIT),
+    (resource.RLIMIT_CPU, JOB_CPU_SECONDS),
+    (resource.RLIMIT_NOFILE, JOB_MAX_FILES),
+]
+
+# prlimit(1) options for PROCESS_RLIMITS
+PRLIMIT_OPTIONS = {resource.RLIMIT_DATA: 'data', resource.RLIMIT_CPU: 'cpu', resource.RLIMIT_NOFILE: 'nofile'}
+
+def process_limits(cpu=True):
+    """
+    PROCESS_RLIMITS that are set, lowered to the hard limits children
+    inherit from this process (they could not raise them). A long-lived
+    process skips the CPU limit with `cpu=False`.
+    """
+    limits = []
+    for limit, value in PROCESS_RLIMITS:
+        if value <= 0 or (limit == resource.RLIMIT_CPU and not cpu):
+            continue
+        _, hard = resource.getrlimit(limit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        limits.append((limit, value))
+    return limits
+
+def limit_prefix():
+    """
+    prlimit and nice commands to start children behind, so PROCESS_RLIMITS
+    and JOB_NICE hold from the child's first instruction on; whatever it
+    starts inherits them. A preexec_fn would do the same but is not safe in
+    a process with threads.
+    """
+    prefix = []
+    limits = process_limits()
+    if limits:
+        if not shutil.which('prlimit'):
+            raise SystemExit("prlimit (util-linux) is needed to apply JOB_MEMORY_LIMIT, JOB_CPU_SECONDS and "
+                             "JOB_MAX_FILES; install it or set them to 0")
+        prefix += ['prlimit', *(f'--{PRLIMIT_OPTIONS[limit]}={value}' for limit, value in limits), '--']
+    if JOB_NICE and shutil.which('nice'):
+        prefix += ['nice', '-n', str(JOB_NICE)]
+    return prefix
+
+LIMIT_PREFIX = limit_prefix()
+
+def limit_self(cpu=True):
+    """Apply PROCESS_RLIMITS and JOB_NICE to this process, for a worker process as it starts."""
+    for limit, value in process_limits(cpu):
+        try:
+            resource.setrlimit(limit, (value, value))
+        except (OSError, ValueError):
+            pass
+    if JOB_NICE:
+        try:
+            os.nice(JOB_NICE)
+        except OSError:
+            pass
+
+def ionice_prefix():
+    """ionice command to start children behind, so their disk I/O yields to the server's."""
+    if not JOB_IONICE or not shutil.which('ionice'):
+        return []
+    # -t: run the command anyway where the I/O scheduler ignores priorities
+    if JOB_IONICE == 'idle':
+        return ['ionice', '-t', '-c', '3']
+    return ['ionice', '-t', '-c', '2', '-n', JOB_IONICE]
+
+IONICE_PREFIX = ionice_prefix()
+
+def tree_rss(pid):
+    """Resident memory of `pid` and everything it started, in bytes; 0 once it is gone."""
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+            # Children are listed under the thread that started them
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children') as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            pass
+    return total
+
+class JobCancelled(Exception):
+    """A process was to be started for a job that has been cancelled."""
+
+CANCELLED_RESULT = {'success': False, 'error': 'Cancelled', 'cancelled': True}
+
+class JobProcesses:
+    """
+    The child processes (yt-dlp, ffmpeg) run for one job, or for one request
+    outside the job queue. Each starts in a session of its own, behind
+    LIMIT_PREFIX and IONICE_PREFIX and, where available, in a cgroup
+    limiting the job's processes as a whole, all in place before it execs. A timeout or cancel() kills a process
+    together with everything it started. Peak memory and CPU time of the
+    processes are kept for the job's result: memory as the cgroup saw it,
+    or else sampled from /proc twice a second, since ru_maxrss of a child
+    counts the server's own memory it was forked with.
+    """
+    
+    def __init__(self, name=None):
+        self.name = name or uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.running = set()
+        self.timed_out = set()
+        self.cancelled = False
+        self.cgroup = None
+        self.spawned = 0
+        # Latest sample per running process, summed for the peak
+        self.rss = {}
+        self.peak_rss = 0
+        self.cpu = 0.0
+    
+    def spawn(self, cmd, timeout=None, **kwargs):
+        """
+        Popen `cmd`, killed after `timeout` seconds if given. Raises
+        JobCancelled once the job is cancelled.
+        """
+        with self.lock:
+            if self.cancelled:
+                raise JobCancelled('Cancelled')
+            if job_cgroups and self.cgroup is None:
+                self.cgroup = job_cgroups.create(self.name)
+            prefix = JobCgroups.enter_prefix(self.cgroup) if self.cgroup else []
+            # Every wrapper execs the next, so proc.pid ends up as cmd itself
+            proc = subprocess.Popen(prefix + LIMIT_PREFIX + IONICE_PREFIX + list(cmd),
+                                    start_new_session=True, **kwargs)
+            self.running.add(proc)
+            self.spawned += 1
+        deadline = time.monotonic() + timeout if timeout else None
+        threading.Thread(target=self._watch, args=(proc, deadline), name='job-process', daemon=True).start()
+        return proc
+    
+    def _watch(self, proc, deadline):
+        """
+        Sample the memory of `proc` and its children twice a second until it
+        exits, killing them at `deadline` if given.
+        """
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        try:
+            while True:
+                rss = tree_rss(proc.pid)
+                with self.lock:
+                    if proc not in self.running:
+                        # Reaped, and the sample may be of another process by now
+                        return
+                    self.rss[proc] = rss
+                    self.peak_rss = max(self.peak_rss, sum(self.rss.values()))
+                    expired = deadline is not None and time.monotonic() >= deadline
+                    if expired:
+                        self.timed_out.add(proc)
+                if expired:
+                    self.kill(proc)
+                    return
+                pause = 0.5 if deadline is None else min(0.5, max(deadline - time.monotonic(), 0))
+                if pidfd is None:
+                    time.sleep(pause)
+                elif select.select([pidfd], [], [], pause)[0]:
+                    # The pidfd turns readable as soon as the process exits
+                    return
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+            with self.lock:
+                self.rss.pop(proc, None)
+    
+    def kill(self, proc):
+        """Kill `proc` and everything it started, unless it has been reaped already."""
+        if proc.returncode is None:
+            self._kill_group(proc.pid)
+    
+    @staticmethod
+    def _kill_group(pid):
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    
+    def wait(self, proc):
+        """
+        Reap `proc` and return `(returncode, rusage)`, with a None returncode
+        if it was killed for running past its timeout.
+        """
+        # wait4() instead of wait(), for the CPU time the process used
+        _, status, usage = os.wait4(proc.pid, 0)
+        # Whatever it started and left behind goes with it
+        self._kill_group(proc.pid)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        with self.lock:
+            self.running.discard(proc)
+            timed_out = proc in self.timed_out
+            self.timed_out.discard(proc)
+            self.cpu += usage.ru_utime + usage.ru_stime
+            cgroup = None
+            if not self.running:
+                cgroup, self.cgroup = self.cgroup, None
+        if cgroup:
+            # Exact, and for all of the job's processes at once
+            peak = job_cgroups.remove(cgroup)
+            with self.lock:
+                self.peak_rss = max(self.peak_rss, peak)
+        return (None if timed_out else proc.returncode), usage
+    
+    def run(self, cmd, timeout):
+        """Run `cmd` to the end and return `(returncode, stdout, stderr)`, returncode None on timeout."""
+        proc = self.spawn(cmd, timeout, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, text=True, errors='replace')
+        stderr = []
+        reader = threading.Thread(target=lambda: stderr.append(proc.stderr.read()), daemon=True)
+        reader.start()
+        with proc.stdout, proc.stderr:
+            stdout = proc.stdout.read()
+            reader.join()
+        returncode, _ = self.wait(proc)
+        return returncode, stdout, stderr[0]
+    
+    def cancel(self):
+        """Kill the running processes and refuse to start any more."""
+        with self.lock:
+            self.cancelled = True
+            running = list(self.running)
+            cgroup = self.cgroup
+        for proc in running:
+            self.kill(proc)
+        if cgroup:
+            job_cgroups.kill(cgroup)
+    
+    def usage(self):
+        with self.lock:
+            return {'peakRssBytes': self.peak_rss, 'cpuSeconds': round(self.cpu, 3)}
+
+def ffmpeg_command(plan, inputs, output):
+    cmd = [FFMPEG_PATH, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y']
+    for path in inputs:
+        cmd.extend(['-i', path])
+    if plan['video']:
+        cmd.extend(['-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy'])
+    else:
+        cmd.extend(['-map', '0:a:0', '-vn'])
+    # One thread per ffmpeg, so the pool size is the number of cores used
+    cmd.extend(['-c:a', *plan['audio_codec'], '-threads', '1', '-f', plan['muxer'], output])
+    return cmd
+
+def run_ffmpeg(cmd, processes=None):
+    """
+    Run ffmpeg as one of `processes` and return `(returncode, cpu seconds,
+    errors)`, with a None returncode on timeout.
+    """
+    processes = processes or JobProcesses()
+    SPAWNS_TOTAL.inc(kind='ffmpeg')
+    proc = processes.spawn(cmd, DOWNLOAD_TIMEOUT, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, text=True, errors='replace')
+    with proc.stderr:
+        # -loglevel error keeps this short
+        errors = proc.stderr.read().strip()
+    returncode, usage = processes.wait(proc)
+    return returncode, usage.ru_utime + usage.ru_stime, errors
+
+def _postprocess(plan, paths, key, reservation, progress=None, processes=None):
+    """Merge or convert fetched streams into the final file; runs on the postprocessor pool."""
+    output = re.sub(r'\.f[^.]+\.\w+$', '', paths[0]) + '.' + plan['ext']
+    mode = 'copy' if plan['audio_codec'] == ['copy'] else 'transcode'
+    if progress:
+        progress({'phase': 'merge', 'postprocessor': 'remux' if mode == 'copy' else 'transcode'})
+    try:
+        returncode, cpu, errors = run_ffmpeg(ffmpeg_command(plan, paths, output + '.part'), processes)
+        POSTPROCESS_CPU_SECONDS.inc(cpu, mode=mode)
+        if returncode is None:
+            return {'success': False, 'error': 'ffmpeg timed out'}
+        if returncode != 0:
+            return {'success': False, 'error': f'ffmpeg failed: {errors or f"exit code {returncode}"}'}
+        os.replace(output + '.part', output)
+        download_cache.store(key, output, title=plan['title'])
+        return dict(fetched(key, output, plan['title']), postprocess={'mode': mode, 'cpuSeconds': round(cpu, 3)})
+    except Exception as e:
+        return {'success': False, 'error': f'ffmpeg failed: {e}'}
+    finally:
+        for path in paths + [output + '.part']:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        storage.release(reservation)
+
+class Postprocessor:
+    """
+    Pool for the CPU-bound end of a download, run by ffmpeg outside yt-dlp:
+    merging separately fetched video and audio, or converting audio. At
+    most `workers` ffmpeg processes run at once, by default one per core,
+    and download workers hand their job over instead of waiting, so
+    network-bound downloads never queue behind CPU work. Disabled (and
+    yt-dlp post-processes as before) with no workers or no ffmpeg.
+    """
+    
+    def __init__(self, workers=POSTPROCESS_WORKERS):
+        self.workers = workers
+        self.enabled = workers > 0 and shutil.which(FFMPEG_PATH) is not None
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='postprocess') if self.enabled else None
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+    
+    def submit(self, fn, *args):
+        """Run `fn(*args)` on the pool and return its Future."""
+        with self.lock:
+            self.waiting += 1
+        return self.pool.submit(self._run, fn, *args)
+    
+    def _run(self, fn, *args):
+        with self.lock:
+            self.waiting -= 1
+            self.running += 1
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+    
+    def stats(self):
+        with self.lock:
+            return {'enabled': self.enabled, 'workers': self.workers,
+                    'running': self.running, 'waiting': self.waiting}
+
+postprocessor = Postprocessor()
+
+def run_ytdlp(cmd, progress=None, processes=None):
+    """
+    Run yt-dlp as one of `processes`, reading its output line by line as it
+    is produced instead of buffering it all until exit. Progress lines go
+    to the `progress` callback; only the tail of the error output is kept.
+    Returns `(returncode, filepath, errors)`, with a None returncode on
+    timeout.
+    """
+    processes = processes or JobProcesses()
+    SPAWNS_TOTAL.inc(kind='download')
+    proc = processes.spawn(cmd, DOWNLOAD_TIMEOUT, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, text=True, errors='replace', bufsize=1)
+    
+    errors = deque(maxlen=20)
+    filepath = None
+    
+    def read(stream, keep):
+        nonlocal filepath
+        for line in stream:
+            line = line.rstrip('\n')
+            update = parse_progress(line)
+            if update is not None:
+                if progress:
+                    progress(update)
+            elif line.startswith(RESULT_PREFIX):
+                filepath = line[len(RESULT_PREFIX):]
+            elif keep and line.strip():
+                errors.append(line)
+    
+    # yt-dlp may put progress on either stream depending on its options
+    stderr_reader = threading.Thread(target=read, args=(proc.stderr, True), daemon=True)
+    stderr_reader.start()
+    with proc.stdout, proc.stderr:
+        read(proc.stdout, False)
+        stderr_reader.join()
+    returncode, _ = processes.wait(proc)
+    return returncode, filepath, '\n'.join(errors)
+
+def ytdlp_source(url, spec=None):
+    """yt-dlp arguments naming what to download: a probed info JSON if we have one, else the URL."""
+    info_json = spec.get('info_json') if spec else info_cache.info_path(url)
+    return ['--load-info-json', info_json] if info_json else [url]
+
+class SubprocessEngine:
+    """Runs every download as a fresh yt-dlp process."""
+    
+    name = 'subprocess'
+    
+    def command(self, url, spec):
+        cmd = [YT_DLP_PATH]
+        if spec.get('fragments', 1) > 1:
+            cmd.extend(['--concurrent-fragments', str(spec['fragments'])])
+        if spec.get('rate'):
+            cmd.extend(['--limit-rate', str(int(spec['rate']))])
+        if spec['audio_format']:
+            cmd.extend(['-x', '--audio-format', spec['audio_format']])
+        if spec['format']:
+            cmd.extend(['-f', spec['format']])
+        cmd.extend([
+            '--merge-output-format', spec['merge_output_format'],
+            '-o', spec['outtmpl'],
+            '--no-playlist',
+            # Resume .part files left by a run that died, e.g. before a restart
+            '--continue',
+            '--print', f'after_move:{RESULT_PREFIX}%(filepath)s',
+            # --print implies --quiet, so progress has to be asked for
+            '--progress', '--newline',
+        ])
+        for template in PROGRESS_TEMPLATES:
+            cmd.extend(['--progress-template', template])
+        cmd.extend(ytdlp_source(url, spec))
+        return cmd
+    
+    def extract_info(self, url, flat_playlist=False):
+        """
+        Return `(info dict, error)` without downloading anything. With
+        `flat_playlist`, playlists are expanded into bare entries instead of
+        being treated as their current video.
+        """
+        playlist = ['--flat-playlist', '--yes-playlist'] if flat_playlist else ['--no-playlist']
+        SPAWNS_TOTAL.inc(kind='extract')
+        # Probes are shared between requests, so they are nobody's job to cancel
+        returncode, stdout, stderr = JobProcesses().run([YT_DLP_PATH, '-J', *playlist, url], INFO_TIMEOUT)
+        if returncode is None:
+            return None, 'Timed out fetching video info'
+        if returncode != 0:
+            return None, stderr.strip() or 'Could not fetch video info'
+        return json.loads(stdout), None
+    
+    def download(self, url, spec, progress=None, processes=None):
+        """Return `(filepath, error)`; exactly one of them is None."""
+        returncode, filepath, errors = run_ytdlp(self.command(url, spec), progress, processes)
+        if returncode is None:
+            return None, timeout_error()
+        if returncode != 0 or not filepath:
+            return None, errors or 'Download failed'
+        return filepath, None
+
+def _embedded_params(spec):
+    """YoutubeDL options equivalent to SubprocessEngine.command()."""
+    params = {
+        'outtmpl': {'default': spec['outtmpl']},
+        'merge_output_format': spec['merge_output_format'],
+        'noplaylist': True,
+        'continuedl': True,
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+        'concurrent_fragment_downloads': spec.get('fragments', 1),
+    }
+    if spec['format']:
+        params['format'] = spec['format']
+    if spec.get('rate'):
+        params['ratelimit'] = int(spec['rate'])
+    if spec['audio_format']:
+        params.setdefault('format', 'bestaudio/best')
+        params['postprocessors'] = [{'key': 'FFmpegExtractAudio', 'preferredcodec': spec['audio_format']}]
+    if shutil.which('node'):
+        # The CLI picks this up from the yt-dlp config file, the API does not
+        params['js_runtimes'] = {'node': {}}
+    return params
+
+# Options that differ from one download to the next. YoutubeDL reads them
+# at call time, so they are set on a shared instance rather than keying it
+EMBEDDED_CALL_PARAMS = ('outtmpl', 'ratelimit', 'concurrent_fragment_downloads')
+# YoutubeDL instances a worker keeps, least recently used dropped first
+EMBEDDED_INSTANCES = 8
+
+def _embedded_worker_main(conn):
+    """
+    Body of an embedded engine worker process: imports yt-dlp once and keeps
+    a YoutubeDL instance per distinct option set, so extractors and HTTP
+    sessions stay warm from one job to the next.
+    """
+    # It serves job after job, so CPU time adds up across them
+    limit_self(cpu=False)
+    import yt_dlp
+    
+    instances = OrderedDict()
+    state = {'filepath': None, 'last_progress': 0}
+    
+    def on_progress(d):
+        now = time.monotonic()
+        if d['status'] != 'downloading' or now - state['last_progress'] < 0.25:
+            return
+        state['last_progress'] = now
+        downloaded = d.get('downloaded_bytes')
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        conn.send(('progress', {
+            'phase': 'download',
+            'downloadedBytes': downloaded,
+            'totalBytes': total,
+            'percent': round(downloaded * 100 / total, 1) if downloaded and total else None,
+            'speed': d.get('speed'),
+            'eta': d.get('eta')
+        }))
+    
+    def on_postprocess(d):
+        if d['status'] == 'started':
+            conn.send(('progress', {'phase': 'merge', 'postprocessor': d.get('postprocessor')}))
+    
+    def on_moved(filepath):
+        state['filepath'] = filepath
+    
+    while True:
+        try:
+            task, target, params = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        
+        call_params = {name: params.pop(name, None) for name in EMBEDDED_CALL_PARAMS}
+        key = json.dumps(params, sort_keys=True)
+        if key in instances:
+            instances.move_to_end(key)
+        else:
+            instances[key] = yt_dlp.YoutubeDL(dict(
+                params,
+                progress_hooks=[on_progress],
+                postprocessor_hooks=[on_postprocess],
+                post_hooks=[on_moved]))
+            while len(instances) > EMBEDDED_INSTANCES:
+                instances.popitem(last=False)[1].close()
+        ydl = instances[key]
+        for name, value in call_params.items():
+            if name == 'outtmpl':
+                # Keep the templates YoutubeDL filled in for other file types
+                if value:
+                    ydl.params['outtmpl']['default'] = value['default']
+            elif value is None:
+                ydl.params.pop(name, None)
+            else:
+                ydl.params[name] = value
+        
+        state['filepath'] = None
+        try:
+            if task == 'info':
+                info = ydl.sanitize_info(ydl.extract_info(target, download=False))
+                conn.send(('done', info, None))
+                continue
+            if task == 'download_info':
+                ydl.download_with_info_file(target)
+            else:
+                ydl.download([target])
+            conn.send(('done', state['filepath'], None if state['filepath'] else 'Download failed'))
+        except Exception as e:
+            conn.send(('done', None, str(e)))
+
+class EmbeddedWorker:
+    """Handle on one long-lived embedded engine process."""
+    
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_embedded_worker_main, args=(child_conn,),
+                                       name='yt-dlp-embedded', daemon=True)
+        self.process.start()
+        SPAWNS_TOTAL.inc(kind='embedded_worker')
+        child_conn.close()
+    
+    def run(self, task, target, params, progress, timeout, timeout_message, processes=None):
+        """
+        Run one task ('download', 'download_info' or 'info') and return
+        `(result, error)`; cancelling `processes` stops it.
+        """
+        self.conn.send((task, target, params))
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            cancelled = processes is not None and processes.cancelled
+            if remaining <= 0 or cancelled:
+                # A YoutubeDL call cannot be interrupted, only its process
+                self.process.kill()
+                self.process.join()
+                return None, 'Cancelled' if cancelled else timeout_message
+            # Wake up now and then to notice a cancel
+            if not self.conn.poll(min(remaining, 0.5)):
+                continue
+            try:
+                kind, *payload = self.conn.recv()
+            except EOFError:
+                return None, f'yt-dlp worker died (exit code {self.process.exitcode})'
+            if kind == 'progress':
+                if progress:
+                    progress(payload[0])
+            else:
+                return payload
+    
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+class EmbeddedEngine:
+    """
+    Drives yt-dlp through its YoutubeDL Python API inside a pool of
+    long-lived worker processes, instead of paying interpreter start-up and
+    yt-dlp import on every download. Workers start on first use and are
+    replaced if they die or time out.
+    """
+    
+    name = 'embedded'
+    
+    def __init__(self, size=EMBEDDED_WORKERS):
+        self.size = size
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = False
+        # Forking a process full of threads is unsafe, start workers clean
+        self.context = multiprocessing.get_context('spawn')
+    
+    def _start(self):
+        with self.lock:
+            if not self.started:
+                for _ in range(self.size):
+                    self.idle.put(EmbeddedWorker(self.context))
+                self.started = True
+    
+    def download(self, url, spec, progress=None, processes=None):
+        """Return `(filepath, error)`; exactly one of them is None."""
+        if spec.get('info_json'):
+            return self._run('download_info', spec['info_json'], _embedded_params(spec), progress,
+                             DOWNLOAD_TIMEOUT, timeout_error(), processes)
+        return self._run('download', url, _embedded_params(spec), progress,
+                         DOWNLOAD_TIMEOUT, timeout_error(), processes)
+    
+    def extract_info(self, url, flat_playlist=False):
+        """Return `(info dict, error)` without downloading anything."""
+        params = {'quiet': True, 'no_warnings': True, 'noplaylist': not flat_playlist}
+        if flat_playlist:
+            params['extract_flat'] = 'in_playlist'
+
+        return self._run('info', url, params, None, INFO_TIMEOUT, 'Timed out fetching video info')
+    
+    def _run(self, *task):
+        self._start()
+        worker = self.idle.get()
+        try:
+            return worker.run(*task)
+        finally:
+            if not worker.alive:
+                worker = EmbeddedWorker(self.context)
+            self.idle.put(worker)
+
+def make_engine(name):
+    if name == 'embedded':
+        if importlib.util.find_spec('yt_dlp') is None:
+            print("⚠️  DOWNLOAD_ENGINE=embedded needs the yt_dlp module (pip install yt-dlp), "
+                  "falling back to the subprocess engine")
+            return SubprocessEngine()
+        return EmbeddedEngine()
+    if name != 'subprocess':
+        raise SystemExit(f"Unknown DOWNLOAD_ENGINE {name!r}, expected 'subprocess' or 'embedded'")
+    return SubprocessEngine()
+
+download_engine = make_engine(DOWNLOAD_ENGINE)
+
+class UploadError(Exception):
+    """An upload attempt failed; `retry` says whether trying again may help."""
+    
+    def __init__(self, message, retry=True):
+        super().__init__(message)
+        self.retry = retry
+
+class ConnectionPool:
+    """
+    Keeps idle HTTP(S) connections per host so consecutive uploads reuse the
+    same TCP connection and TLS session instead of handshaking every time.
+    """
+    
+    def __init__(self, max_idle=4, idle_timeout=30, timeout=60):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+    
+    def get(self, scheme, host, port):
+        key = (scheme, host, port)
+        now = time.monotonic()
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn
+                conn.close()
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        conn = cls(host, port, timeout=self.timeout)
+        conn.pool_key = key
+        return conn
+    
+    def put(self, conn):
+        with self.lock:
+            idle = self.idle.setdefault(conn.pool_key, [])
+            if len(idle) < self.max_idle:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+def read_chunks(filepath):
+    with open(filepath, 'rb') as f:
+        yield from iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b'')
+
+class UploadBackend:
+    """
+    Base class for share-link upload targets. Subclasses set `name` and
+    implement `upload_once()`; retries, backoff and the per-backend
+    concurrency limit live here. Backends that can take a body whose size
+    is not known yet set `supports_streaming`, which lets uploads start
+    while the download is still running.
+    """
+    
+    name = None
+    supports_streaming = False
+    
+    def __init__(self, concurrency=UPLOAD_CONCURRENCY, retries=UPLOAD_RETRIES, pool=None):
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.retries = retries
+        self.pool = pool or ConnectionPool()
+    
+    def upload(self, filepath, progress=None, filename=None):
+        """Upload `filepath` (as `filename`, if given) and return its public URL, or raise UploadError."""
+        filename = filename or os.path.basename(filepath)
+        with self.slots:
+            for attempt in range(self.retries + 1):
+                try:
+                    return self.upload_once(filename, read_chunks(filepath), os.path.getsize(filepath), progress)
+                except (UploadError, OSError, http.client.HTTPException) as e:
+                    if attempt == self.retries or not getattr(e, 'retry', True):
+                        raise UploadError(f'{self.name} upload failed: {e}', retry=False)
+                    delay = UPLOAD_BACKOFF * 2 ** attempt
+                    print(f"⚠️  {self.name} upload of {filename} failed ({e}), "
+                          f"retrying in {delay:g}s")
+                    time.sleep(delay)
+    
+    def upload_stream(self, filename, chunks, progress=None):
+        """
+        Upload a body that is still being produced. A stream cannot be
+        replayed, so there are no retries here; callers fall back to
+        upload() once the file is complete.
+        """
+        with self.slots:
+            try:
+                return self.upload_once(filename, chunks, None, progress)
+            except (OSError, http.client.HTTPException) as e:
+                raise UploadError(f'{self.name} upload failed: {e}')
+    
+    def upload_once(self, filename, chunks, size, progress=None):
+        """Send `chunks` (`size` bytes, or None if unknown) once and return the URL."""
+        raise NotImplementedError
+    
+    def post_multipart(self, url, fields, file_field, filename, chunks, size=None, progress=None):
+        """
+        POST `fields` plus the file as multipart/form-data, sending the file
+        chunk by chunk as `chunks` yields it. With `size` unknown the request
+        goes out with chunked transfer encoding. Returns (status, body text).
+        """
+        boundary = uuid.uuid4().hex
+        head = b''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            for name, value in fields.items())
+        filename = filename.replace('"', '')
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                 f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n').encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        
+        parsed = urlparse(url)
+        conn = self.pool.get(parsed.scheme, parsed.hostname, parsed.port)
+        try:
+            conn.putrequest('POST', parsed.path or '/', skip_accept_encoding=True)
+            conn.putheader('Content-Type', f'multipart/form-data; boundary={boundary}')
+            if size is None:
+                conn.putheader('Transfer-Encoding', 'chunked')
+            else:
+                conn.putheader('Content-Length', str(len(head) + size + len(tail)))
+            conn.putheader('User-Agent', 'yt-downloader-pro')
+            conn.endheaders()
+            
+            def send(data):
+                if size is None:
+                    conn.send(b'%X\r\n%s\r\n' % (len(data), data))
+                else:
+                    conn.send(data)
+            
+            send(head)
+            sent = 0
+            started = time.monotonic()
+            for chunk in chunks:
+                send(chunk)
+                sent += len(chunk)
+                if progress:
+                    elapsed = time.monotonic() - started
+                    progress({
+                        'phase': 'upload',
+                        'uploadedBytes': sent,
+                        'totalBytes': size,
+                        'percent': round(sent * 100 / size, 1) if size else None,
+                        'speed': sent / elapsed if elapsed else None
+                    })
+            send(tail)
+            if size is None:
+                conn.send(b'0\r\n\r\n')
+            UPLOAD_BYTES.inc(sent)
+            
+            response = conn.getresponse()
+            body = response.read().decode(errors='replace')
+        except Exception:
+            conn.close()
+            raise
+        
+        if response.will_close:
+            conn.close()
+        else:
+            self.pool.put(conn)
+        return response.status, body
+
+class CatboxBackend(UploadBackend):
+    """catbox.moe anonymous (or CATBOX_USERHASH) file upload."""
+    
+    name = 'catbox'
+    # Chunked request bodies are not documented for the catbox API, so
+    # streamed uploads are opt-in
+    supports_streaming = CATBOX_STREAMING
+    
+    def __init__(self, endpoint=CATBOX_URL, **kwargs):
+        super().__init__(**kwargs)
+        self.endpoint = endpoint
+    
+    def upload_once(self, filename, chunks, size, progress=None):
+        fields = {'reqtype': 'fileupload'}
+        if CATBOX_USERHASH:
+            fields['userhash'] = CATBOX_USERHASH
+        status, body = self.post_multipart(self.endpoint, fields, 'fileToUpload', filename, chunks, size, progress)
+        if status == 200 and body.startswith('http'):
+            return body.strip()
+        # Rate limiting and server errors are worth another try, the rest is not
+        raise UploadError(f'HTTP {status}: {body.strip()[:200]}', retry=status == 429 or status >= 500)
+
+UPLOAD_BACKENDS = {
+    'catbox': CatboxBackend,
+}
+
+def make_upload_backend(name):
+    if name not in UPLOAD_BACKENDS:
+        raise SystemExit(f"Unknown UPLOAD_BACKEND {name!r}, expected one of {', '.join(UPLOAD_BACKENDS)}")
+    return UPLOAD_BACKENDS[name]()
+
+upload_backend = make_upload_backend(UPLOAD_BACKEND)
+
+def upload_file(filepath, progress=None, filename=None):
+    """Upload to the configured backend; returns the share URL or None."""
+    try:
+        return upload_backend.upload(filepath, progress, filename)
+    except UploadError as e:
+        print(f"❌ {e}")
+        return None
+
+def share_file(url, format_type, quality, filepath, progress=None, single_file=False, filename=None):
+    """Upload a downloaded file once, however many requests are waiting for it."""
+    share_url, _ = upload_flights.do(filepath, lambda: upload_file(filepath, progress, filename))
+    if share_url:
+        download_cache.set_share_url(cache_key(url, format_type, quality, single_file), share_url)
+    return share_url
+
+def stream_format(format_type, quality):
+    """
+    Format selector for /stream. Output goes to stdout, so only formats that
+    are a single file already qualify: no merging and no audio conversion.
+    """
+    if format_type == 'audio':
+        return 'bestaudio[ext=m4a]/bestaudio'
+    if format_type == 'best' or quality == 'best':
+        return 'best[ext=mp4]/best'
+    return f'best[height<={quality}][ext=mp4]/best[height<={quality}]/best'
+
+def sniff_media_type(data):
+    """Guess (content type, extension) from the first bytes of a stream."""
+    if data[4:8] == b'ftyp':
+        if data[8:11] == b'M4A':
+            return 'audio/mp4', 'm4a'
+        return 'video/mp4', 'mp4'
+    if data.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'video/webm', 'webm'
+    if data.startswith(b'ID3') or data[:2] == b'\xff\xfb':
+        return 'audio/mpeg', 'mp3'
+    if data.startswith(b'OggS'):
+        return 'audio/ogg', 'ogg'
+    return 'application/octet-stream', 'bin'
+
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+class GrowingFile:
+    """A file written by one thread while another reads it as it grows."""
+    
+    def __init__(self, path):
+        self.path = path
+        self.out = open(path, 'wb')
+        self.size = 0
+        self.closed = False
+        self.error = None
+        self.changed = threading.Condition()
+    
+    def write(self, data):
+        self.out.write(data)
+        self.out.flush()
+        with self.changed:
+            self.size += len(data)
+            self.changed.notify_all()
+    
+    def close(self, error=None):
+        """Finish the file; with `error` set, readers fail instead of seeing its end."""
+        failure = None
+        try:
+            self.out.close()
+        except OSError as e:
+            # Only a clean finish needs to hear about it; a failed one already has
+            if error is None:
+                failure = e
+                error = str(e)
+        with self.changed:
+            self.closed = True
+            self.error = error
+            self.changed.notify_all()
+        if failure:
+            raise failure
+    
+    def chunks(self):
+        """Yield the contents as they are written, until the writer closes the file."""
+        with open(self.path, 'rb') as f:
+            read = 0
+            while True:
+                with self.changed:
+                    self.changed.wait_for(lambda: self.size > read or self.closed)
+                    if self.error:
+                        raise UploadError(self.error, retry=False)
+                    if self.size == read:
+                        return
+                data = f.read(min(self.size - read, UPLOAD_CHUNK_SIZE))
+                read += len(data)
+                yield data
+
+def pipelined_download_and_share(url, format_type, quality, progress=None, processes=None,
+                                 priority='interactive'):
+    """
+    Download and upload at the same time: yt-dlp writes a single-file format
+    to stdout, the bytes are appended to a file in DOWNLOAD_DIR, and the
+    upload reads that file as it grows, so the whole job takes about as long
+    as the slower of the two instead of their sum. If the streamed upload
+    fails, the finished file is uploaded again the normal way.
+    """
+    key = cache_key(url, format_type, quality, single_file=True)
+    cached = download_cache.lookup(key)
+    CACHE_REQUESTS.inc(cache='download', result='hit' if cached else 'miss')
+    if cached:
+        filename = download_name(cached['filepath'], cached['title'])
+        share_url = cached['shareUrl'] or share_file(url, format_type, quality, cached['filepath'],
+                                                     progress, single_file=True, filename=filename)
+        return {
+            'success': True,
+            'filename': filename,
+            'filepath': cached['filepath'],
+            'path': DOWNLOAD_DIR,
+            'shareUrl': share_url,
+            **file_fields(key),
+            'cached': True,
+            'coalesced': False
+        }
+    
+    result, shared = download_flights.do(
+        key, lambda: _fetch_pipelined(url, format_type, quality, key, progress, processes, priority))
+    return dict(result, coalesced=shared)
+
+def _fetch_pipelined(url, format_type, quality, key, progress=None, processes=None, priority='interactive'):
+    if progress:
+        progress({'phase': 'extract'})
+    info, error = probe(url)
+    if error:
+        return {'success': False, 'error': error}
+    reservation, error = storage.admit(estimate_size(info, format_type, quality), progress)
+    if error:
+        return {'success': False, 'error': error}
+    rate = bandwidth_budget.acquire(priority)
+    try:
+        return _run_pipelined(url, format_type, quality, key, progress, processes, rate)
+    finally:
+        bandwidth_budget.release(priority, rate)
+        storage.release(reservation)
+
+# Fields of a pipelined download's side file
+NAME_FIELDS = ('extractor_key', 'id', 'title')
+
+def _run_pipelined(url, format_type, quality, key, progress=None, processes=None, rate=None):
+    processes = processes or JobProcesses()
+    name_file = os.path.join(DOWNLOAD_DIR, f'.{uuid.uuid4().hex}.title')
+    cmd = [
+        YT_DLP_PATH,
+        '-f', stream_format(format_type, quality),
+        '-o', '-',
+        '--no-playlist',
+        '--progress', '--newline',
+    ]
+    if rate:
+        cmd.extend(['--limit-rate', str(int(rate))])
+    # stdout carries the media, so what the file is stored and offered
+    # under comes through a side file, a line per field
+    for field in NAME_FIELDS:
+        cmd.extend(['--print-to-file', f'before_dl:%({field})s', name_file])
+    for template in PROGRESS_TEMPLATES:
+        cmd.extend(['--progress-template', template])
+    cmd.extend(ytdlp_source(url))
+    
+    state = {'phase': 'download'}
+    state_lock = threading.Lock()
+    
+    def report(update):
+        with state_lock:
+            state.update(update)
+            if progress:
+                progress(dict(state))
+    
+    SPAWNS_TOTAL.inc(kind='pipelined')
+    proc = processes.spawn(cmd, DOWNLOAD_TIMEOUT, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE)
+    
+    errors = deque(maxlen=20)
+    
+    def read_stderr():
+        for line in proc.stderr:
+            line = line.decode(errors='replace').rstrip('\n')
+            update = parse_progress(line)
+            if update is not None:
+                report(update)
+            elif line.strip():
+                errors.append(line)
+    stderr_reader = threading.Thread(target=read_stderr, daemon=True)
+    stderr_reader.start()
+    
+    growing = uploader = None
+    try:
+        first = proc.stdout.read1(STREAM_CHUNK_SIZE)
+        if not first:
+            returncode, _ = processes.wait(proc)
+            stderr_reader.join()
+            return {'success': False, 'error': timeout_error() if returncode is None
+                    else '\n'.join(errors) or 'Download failed'}
+        
+        try:
+            with open(name_file) as f:
+                info = dict(zip(NAME_FIELDS, f.read().splitlines()))
+        except OSError:
+            info = {}
+        tag = storage_tag(format_type, quality, single_file=True)
+        stored = storage_path(info, tag) or storage_path({'id': file_id(key)}, tag)
+        filepath = f'{stored}.{sniff_media_type(first)[1]}'
+        filename = download_name(filepath, info.get('title'))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        storage.note_dir(os.path.dirname(filepath))
+        growing = GrowingFile(filepath + '.part')
+        
+        upload = {'url': None, 'error': None}
+        
+        def on_upload_progress(update):
+            report({'uploadedBytes': update['uploadedBytes'], 'uploadSpeed': update['speed']})
+        
+        def run_upload():
+            try:
+                upload['url'] = upload_backend.upload_stream(filename, growing.chunks(), on_upload_progress)
+            except UploadError as e:
+                upload['error'] = e
+        uploader = threading.Thread(target=run_upload, name='pipelined-upload', daemon=True)
+        uploader.start()
+        
+        chunk = first
+        while chunk:
+            growing.write(chunk)
+            chunk = proc.stdout.read1(STREAM_CHUNK_SIZE)
+        returncode, _ = processes.wait(proc)
+        stderr_reader.join()
+        
+        if returncode != 0:
+            error = timeout_error() if returncode is None else '\n'.join(errors) or 'Download failed'
+            growing.close(error)
+            return {'success': False, 'error': error}
+        
+        growing.close()
+        os.replace(growing.path, filepath)
+        report({'phase': 'upload', 'totalBytes': growing.size})
+        uploader.join()
+        
+        share_url = upload['url']
+        if share_url is None:
+            print(f"⚠️  Streamed upload of {filename} failed ({upload['error']}), uploading the finished file")
+            share_url = upload_file(filepath, progress, filename)
+        
+        download_cache.store(key, filepath, share_url, info.get('title'))
+        return {
+            'success': True,
+            'filename': filename,
+            'filepath': filepath,
+            'path': DOWNLOAD_DIR,
+            'shareUrl': share_url,
+            **file_fields(key),
+            'cached': False,
+            'pipelined': True
+        }
+    except Exception as e:
+        if growing is not None and not growing.closed:
+            growing.close(str(e))
+        return {'success': False, 'error': str(e)}
+    finally:
+        # Whatever stopped the download part way, the upload reading the
+        # partial file is told so and waited for, and the .part file goes
+        if growing is not None and not growing.closed:
+            growing.close('Download interrupted')
+        if uploader is not None:
+            uploader.join()
+        if growing is not None and os.path.exists(growing.path):
+            os.remove(growing.path)
+        if proc.returncode is None:
+            processes.kill(proc)
+            processes.wait(proc)
+        proc.stdout.close()
+        proc.stderr.close()
+        if os.path.exists(name_file):
+            os.remove(name_file)
+
+class Job:
+    """A /download request travelling through the download and upload pools."""
+    
+    def __init__(self, url, format_type, quality, share_link, pipeline=False, client=None, priority=None):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.format_type = format_type
+        self.quality = quality
+        self.share_link = share_link
+        # Only worth it when there is an upload, and the backend can take one
+        # before the file size is known; otherwise download, then upload
+        self.pipeline = bool(pipeline and share_link and upload_backend.supports_streaming)
+        self.status = 'queued'
+        self.key = cache_key(url, format_type, quality, self.pipeline)
+        self.site = site_of(url)
+        self.client = client
+        # Given by the request or a batch, or else settled by the probe
+        self.priority = priority or 'interactive'
+        self.pinned = priority is not None
+        self.cached = False
+        # Whether it holds a download worker slot of the DownloadScheduler
+        self.slot = False
+        self.restarts = 0
+        self.attached = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.filepath = None
+        self.result = None
+        self.progress = None
+        self.listeners = []
+        self.version = 0
+        self.changed = threading.Condition()
+        # Seconds spent per phase: 'queue', then the progress phases
+        self.phase = 'queue'
+        self.phase_started = time.monotonic()
+        self.timings = {}
+        self.processes = JobProcesses(self.id)
+    
+    @classmethod
+    def from_row(cls, row):
+        """Rebuild a job from its JobJournal row."""
+        job = cls(row['url'], row['format'], row['quality'], bool(row['share_link']),
+                  bool(row['pipeline']), row['client'])
+        job.id = row['id']
+        job.apply_row(row)
+        return job
+    
+    def apply_row(self, row):
+        self.status = row['status']
+        self.priority = row['priority'] or 'interactive'
+        self.pinned = bool(row['pinned'])
+        self.share_link = bool(row['share_link'])
+        self.attached = row['attached']
+        self.created_at = row['created_at']
+        self.started_at = row['started_at']
+        self.finished_at = row['finished_at']
+        self.filepath = row['filepath']
+        self.result = row['result']
+        self.progress = row['progress']
+        self.restarts = row['restarts']
+    
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+    
+    def update(self, **fields):
+        """Set job fields and wake up anyone watching the job."""
+        with self.changed:
+            phase = (fields.get('progress') or {}).get('phase')
+            if phase and phase != self.phase:
+                self._enter(phase)
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self.changed.notify_all()
+    
+    def _enter(self, phase):
+        now = time.monotonic()
+        if self.phase:
+            self.timings[self.phase] = self.timings.get(self.phase, 0) + now - self.phase_started
+        self.phase, self.phase_started = phase, now
+    
+    def close_timings(self):
+        """End the current phase and return the time spent in each, in seconds."""
+        with self.changed:
+            self._enter(None)
+            return {phase: round(seconds, 3) for phase, seconds in self.timings.items()}
+    
+    def wait(self, version, timeout):
+        """Block until the job moves past `version`; return the current version."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'url': self.url,
+            'format': self.format_type,
+            'quality': self.quality,
+            'shareLink': self.share_link,
+            'pipeline': self.pipeline,
+            'priority': self.priority,
+            'site': self.site,
+            'attached': self.attached,
+            'createdAt': self.created_at,
+            'startedAt': self.started_at,
+            'finishedAt': self.finished_at,
+            'progress': self.progress,
+            'result': self.result
+        }
+
+def new_job(url, format_type, quality, share_link, pipeline=False, client=None, priority=None):
+    """A Job for a new request, classed by its probe already if the video was probed, e.g. by /info."""
+    job = Job(url, format_type, quality, share_link, pipeline, client, priority)
+    info = None if job.pinned else info_cache.peek(url)
+    if info:
+        job.priority = job_priority(info, format_type, quality)
+    return job
+
+def parse_domain_limits(spec):
+    """'youtube=2,vimeo.com=4' -> {'youtube': 2, 'vimeo.com': 4}"""
+    limits = {}
+    for item in spec.split(','):
+        site, _, limit = item.partition('=')
+        if site.strip() and limit.strip():
+            limits[site.strip()] = int(limit)
+    return limits
+
+class SiteLimiter:
+    """
+    Concurrency cap and token bucket for one site. Both shrink by half when
+    the site throttles us and grow back a little with every clean download
+    (AIMD), so we settle just under whatever rate the site tolerates.
+    """
+    
+    def __init__(self, max_concurrency, rate=DOMAIN_RATE, burst=DOMAIN_BURST):
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        # Downloads started per second; DOMAIN_RATE is per minute
+        self.max_rate = rate / 60
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.running = 0
+    
+    def ready_in(self, now):
+        """Seconds until a download may start here, or None while at the concurrency cap."""
+        if self.running >= int(self.concurrency):
+            return None
+        if not self.max_rate:
+            return max(self.paused_until - now, 0)
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0)
+    
+    def acquire(self):
+        self.tokens -= 1
+        self.running += 1
+    
+    def release(self, throttled):
+        self.running -= 1
+        if throttled:
+            self.concurrency = max(1.0, self.concurrency / 2)
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.paused_until = time.monotonic() + THROTTLE_PAUSE
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+    
+    def to_dict(self):
+        return {
+            'running': self.running,
+            'concurrency': int(self.concurrency),
+            'ratePerMinute': round(self.rate * 60, 1),
+            'paused': max(round(self.paused_until - time.monotonic(), 1), 0)
+        }
+
+class DownloadScheduler:
+    """
+    Stands in for the download queue. Jobs wait in one FIFO per client and
+    the client served least recently goes next, so one heavy user cannot
+    fill every worker. A job
+    only starts while its site is under its concurrency cap and has a token
+    to spend; jobs for other sites go ahead of it in the meantime. Jobs
+    already in the cache skip the site limits, as they never touch the site.
+    
+    Each priority class has its own clients and FIFOs. Interactive jobs
+    start INTERACTIVE_WEIGHT times as often as bulk ones while both wait
+    (stride scheduling), and bulk jobs hold at most BULK_WORKERS workers,
+    so a worker is free for an interactive job even under a bulk backlog.
+    """
+    
+    def __init__(self, default_limit=DOMAIN_CONCURRENCY, limits=None, bulk_slots=BULK_WORKERS,
+                 weight=INTERACTIVE_WEIGHT):
+        self.default_limit = default_limit
+        self.limits = parse_domain_limits(DOMAIN_LIMITS) if limits is None else limits
+        self.sites = {}
+        self.queues = {priority: {} for priority in PRIORITIES}
+        self.last_served = {}
+        self.turn = 0
+        self.cond = threading.Condition()
+        self.size = 0
+        self.bulk_slots = max(bulk_slots, 1)
+        self.strides = {'interactive': 1 / max(weight, 1), 'bulk': 1.0}
+        # How far each class has got; the one furthest behind goes next
+        self.passes = dict.fromkeys(PRIORITIES, 0.0)
+        self.running = dict.fromkeys(PRIORITIES, 0)
+    
+    def _site(self, name):
+        if name not in self.sites:
+            self.sites[name] = SiteLimiter(self.limits.get(name, self.default_limit))
+        return self.sites[name]
+    
+    def put(self, job):
+        job.cached = download_cache.contains(job.key)
+        with self.cond:
+            clients = self.queues[job.priority]
+            waiting = [self.passes[p] for p in PRIORITIES if self.queues[p]]
+            if not clients and waiting:
+                # A class that had nothing queued does not bank turns meanwhile
+                self.passes[job.priority] = max(self.passes[job.priority], min(waiting))
+            clients.setdefault(job.client, deque()).append(job)
+            self.size += 1
+            self.cond.notify()
+    
+    def get(self, timeout):
+        """Next job allowed to start, taking clients in turn; raises queue.Empty after `timeout`."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                job, wait = self._pick(now)
+                if job is not None:
+                    return job
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise queue.Empty
+                self.cond.wait(min(remaining, wait) if wait is not None else remaining)
+    
+    def _classes(self):
+        """Priority classes in the order they should be served now, leaving out bulk at its cap."""
+        classes = sorted(PRIORITIES, key=lambda p: (self.passes[p], PRIORITIES.index(p)))
+        return [p for p in classes if p != 'bulk' or self.running['bulk'] < self.bulk_slots]
+    
+    def _started(self, job):
+        job.slot = True
+        self.running[job.priority] += 1
+        self.passes[job.priority] += self.strides[job.priority]
+    
+    def _pick(self, now):
+        """`(job, None)`, or `(None, seconds until a token frees up)` if nothing can start."""
+        soonest = None
+        for priority in self._classes():
+            clients = self.queues[priority]
+            for client in sorted(clients, key=lambda c: self.last_served.get(c, 0)):
+                jobs = clients[client]
+                for job in jobs:
+                    limiter = None if job.cached else self._site(job.site)
+                    wait = limiter.ready_in(now) if limiter else 0
+                    if wait == 0:
+                        jobs.remove(job)
+                        if not jobs:
+                            del clients[client]
+                        if limiter:
+                            limiter.acquire()
+                        self.size -= 1
+                        self._started(job)
+                        self.turn += 1
+                        self.last_served[client] = self.turn
+                        if len(self.last_served) > 10000:
+                            # Forget the idle clients that were served longest ago
+                            for idle in sorted(self.last_served, key=self.last_served.get)[:5000]:
+                                if not any(idle in self.queues[p] for p in PRIORITIES):
+                                    del self.last_served[idle]
+                        return job, None
+                    if wait is not None:
+                        soonest = wait if soonest is None else min(soonest, wait)
+        return None, soonest
+    
+    def remove(self, job):
+        """Take a job that has not started yet off the queue; False if it is no longer there."""
+        with self.cond:
+            clients = self.queues[job.priority]
+            jobs = clients.get(job.client)
+            if not jobs or job not in jobs:
+                return False
+            jobs.remove(job)
+            if not jobs:
+                del clients[job.client]
+            self.size -= 1
+            return True
+    
+    def reclassify(self, job, priority):
+        """
+        Move a job that just started to another priority class, e.g. once its
+        probe shows a long video. False if that class has no worker to spare:
+        the job then gives up its slots, to be queued again.
+        """
+        with self.cond:
+            self.running[job.priority] -= 1
+            job.priority = priority
+            self.cond.notify_all()
+            if priority == 'bulk' and self.running['bulk'] >= self.bulk_slots:
+                job.slot = False
+                if not job.cached:
+                    # Its site slot, without counting it as a download
+                    self._site(job.site).running -= 1
+                return False
+            self.running[priority] += 1
+            return True
+    
+    def done(self, job, result):
+        """
+        Return the job's worker and site slots, adapting the site's limits to
+        how the download went. Does nothing if they were returned already.
+        """
+        with self.cond:
+            if not job.slot:
+                return
+            job.slot = False
+            self.running[job.priority] -= 1
+            self.cond.notify_all()
+        if job.cached:
+            return
+        throttled = not result['success'] and bool(THROTTLE_PATTERN.search(result.get('error') or ''))
+        with self.cond:
+            limiter = self._site(job.site)
+            limiter.release(throttled)
+            self.cond.notify_all()
+        if throttled:
+            print(f"🐢 {job.site} is throttling us, down to {int(limiter.concurrency)} at a time")
+    
+    def qsize(self):
+        with self.cond:
+            return self.size
+    
+    def stats(self):
+        with self.cond:
+            return {
+                'clients': len({client for p in PRIORITIES for client in self.queues[p]}),
+                'queued': {p: sum(len(jobs) for jobs in self.queues[p].values()) for p in PRIORITIES},
+                'running': dict(self.running),
+                'bulkWorkers': self.bulk_slots,
+                'sites': {name: limiter.to_dict() for name, limiter in self.sites.items()}
+            }
+
+class JobJournal:
+    """
+    SQLite record of every job, written on each status change, so that jobs
+    outlive the process: after a restart JobManager reloads them with
+    recover(). With several replicas on one volume it is also the shared
+    queue; the claim/lease methods below serve SharedJobManager.
+    """
+    
+    COLUMNS = ('id', 'url', 'format', 'quality', 'share_link', 'pipeline', 'client', 'status',
+               'filepath', 'result', 'created_at', 'started_at', 'finished_at', 'restarts',
+               'key', 'site', 'progress', 'attached', 'node', 'lease_until', 'priority', 'pinned')
+    RUNNING = "('downloading', 'uploading')"
+    UNFINISHED = "('queued', 'downloading', 'uploading')"
+    
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        # Other replicas may hold the write lock for a moment
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                format TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                share_link INTEGER NOT NULL,
+                pipeline INTEGER NOT NULL,
+                client TEXT,
+                status TEXT NOT NULL,
+                filepath TEXT,
+                result TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                restarts INTEGER NOT NULL DEFAULT 0,
+                key TEXT,
+                site TEXT,
+                progress TEXT,
+                attached INTEGER NOT NULL DEFAULT 0,
+                node TEXT,
+                lease_until REAL,
+                cancel INTEGER NOT NULL DEFAULT 0,
+                priority TEXT,
+                pinned INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(jobs)')]
+        for column, kind in (('key', 'TEXT'), ('site', 'TEXT'), ('progress', 'TEXT'),
+                             ('attached', 'INTEGER NOT NULL DEFAULT 0'), ('node', 'TEXT'), ('lease_until', 'REAL'),
+                             ('cancel', 'INTEGER NOT NULL DEFAULT 0'), ('priority', 'TEXT'),
+                             ('pinned', 'INTEGER NOT NULL DEFAULT 0')):
+            if column not in columns:
+                self.db.execute(f'ALTER TABLE jobs ADD COLUMN {column} {kind}')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)')
+    
+    def _row(self, values):
+        row = dict(zip(self.COLUMNS, values))
+        row['result'] = json.loads(row['result']) if row['result'] else None
+        row['progress'] = json.loads(row['progress']) if row['progress'] else None
+        return row
+    
+    def _select(self, where='', params=(), tail=''):
+        with self.lock:
+            rows = self.db.execute(f'SELECT {", ".join(self.COLUMNS)} FROM jobs {where} {tail}', params).fetchall()
+        return [self._row(values) for values in rows]
+    
+    def _insert(self, job, replace=False):
+        values = (job.id, job.url, job.format_type, job.quality, int(job.share_link), int(job.pipeline),
+                  job.client, job.status, job.filepath, json.dumps(job.result) if job.result else None,
+                  job.created_at, job.started_at, job.finished_at, job.restarts,
+                  json.dumps(job.key), job.site, json.dumps(job.progress) if job.progress else None,
+                  job.attached, None, None, job.priority, int(job.pinned))
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT'
+        self.db.execute(f'{verb} INTO jobs ({", ".join(self.COLUMNS)}) '
+                        f'VALUES ({", ".join("?" * len(values))})', values)
+    
+    def _transaction(self, fn):
+        """Run `fn` inside one write transaction, which other replicas wait for."""
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn()
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+        return result
+    
+    def save(self, job):
+        with self.lock:
+            self._insert(job, replace=True)
+    
+    def delete(self, job_ids):
+        with self.lock:
+            self.db.executemany('DELETE FROM jobs WHERE id = ?', [(job_id,) for job_id in job_ids])
+    
+    def load(self):
+        """All journalled jobs as dicts, oldest first."""
+        return self._select(tail='ORDER BY created_at')
+    
+    def get(self, job_id):
+        rows = self._select('WHERE id = ?', (job_id,))
+        return rows[0] if rows else None
+    
+    def get_many(self, job_ids):
+        return self._select(f'WHERE id IN ({", ".join("?" * len(job_ids))})', tuple(job_ids))
+    
+    def recent(self, limit):
+        return self._select(tail='ORDER BY created_at DESC LIMIT ?', params=(limit,))[::-1]
+    
+    def status_counts(self):
+        with self.lock:
+            return self.db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+    
+    def queued(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+    
+    def share_link(self, job_id):
+        with self.lock:
+            row = self.db.execute('SELECT share_link FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return bool(row and row[0])
+    
+    def submit(self, job):
+        """
+        Insert `job`, unless an unfinished job for the same download exists:
+        then count one more attached request against it and return its id.
+        """
+        def submit():
+            row = self.db.execute(f'SELECT id FROM jobs WHERE key = ? AND status IN {self.UNFINISHED}',
+                                  (json.dumps(job.key),)).fetchone()
+            if row is None:
+                self._insert(job)
+                return None
+            # A share request can still be honoured until the upload decision
+            self.db.execute("UPDATE jobs SET attached = attached + 1, share_link = CASE "
+                            "WHEN status IN ('queued', 'downloading') THEN MAX(share_link, ?) "
+                            "ELSE share_link END WHERE id = ?", (int(job.share_link), row[0]))
+            return row[0]
+        return self._transaction(submit)
+    
+    def claim(self, node, lease_until, blocked_sites=(), priorities=PRIORITIES):
+        """
+        Take the next queued job for `node`, skipping `blocked_sites`, from
+        the `priorities` classes, the first of them preferred. Then clients
+        with the fewest jobs running anywhere go first, then oldest first.
+        Returns the job's row, or None.
+        """
+        def claim():
+            excluded = f'AND site NOT IN ({", ".join("?" * len(blocked_sites))})' if blocked_sites else ''
+            values = self.db.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM jobs q WHERE status = 'queued' {excluded} "
+                f"AND COALESCE(priority, 'interactive') IN ({', '.join('?' * len(priorities))}) "
+                "ORDER BY COALESCE(priority, 'interactive') != ?, "
+                f"(SELECT COUNT(*) FROM jobs r WHERE r.client IS q.client AND r.status IN {self.RUNNING}), "
+                "created_at LIMIT 1", (*blocked_sites, *priorities, priorities[0])).fetchone()
+            if values is None:
+                return None
+            self.db.execute("UPDATE jobs SET status = 'downloading', node = ?, lease_until = ? WHERE id = ?",
+                            (node, lease_until, values[0]))
+            return self._row(values)
+        return self._transaction(claim)
+    
+    def publish(self, job, node, lease_until):
+        """Write a claimed job's state; False if `node` no longer holds its lease."""
+        with self.lock:
+            cursor = self.db.execute(
+                'UPDATE jobs SET status = ?, filepath = ?, result = ?, progress = ?, started_at = ?, '
+                'finished_at = ?, priority = ?, lease_until = ?, node = CASE WHEN ? THEN NULL ELSE node END '
+                'WHERE id = ? AND node = ?',
+                (job.status, job.filepath, json.dumps(job.result) if job.result else None,
+                 json.dumps(job.progress) if job.progress else None, job.started_at, job.finished_at,
+                 job.priority, lease_until, job.finished, job.id, node))
+        return cursor.rowcount == 1
+    
+    def requeue(self, job, node):
+        """Give back a job `node` claimed but did not start, keeping the class its probe settled."""
+        with self.lock:
+            self.db.execute("UPDATE jobs SET status = 'queued', node = NULL, lease_until = NULL, progress = NULL, "
+                            "started_at = NULL, priority = ?, pinned = ? WHERE id = ? AND node = ?",
+                            (job.priority, int(job.pinned), job.id, node))
+    
+    def renew(self, node, job_ids, lease_until):
+        with self.lock:
+            self.db.executemany('UPDATE jobs SET lease_until = ? WHERE id = ? AND node = ?',
+                                [(lease_until, job_id, node) for job_id in job_ids])
+    
+    def release(self, node=None, expired_before=None):
+        """
+        Put running jobs back in the queue: those of `node` (a replica that
+        restarted) or those whose lease ran out before `expired_before` (a
+        replica that died). Jobs out of restarts fail instead. Returns
+        `(requeued, failed)`.
+        """
+        where = 'node = ?' if node is not None else 'lease_until < ?'
+        params = (node if node is not None else expired_before,)
+        error = json.dumps({'success': False, 'error': f'Gave up after {JOB_MAX_RESTARTS} server restarts'})
+        
+        def release():
+            # A job someone cancelled is not worth another try
+            failed = self.db.execute(
+                f"UPDATE jobs SET status = 'failed', result = ?, finished_at = ?, node = NULL "
+                f"WHERE status IN {self.RUNNING} AND {where} AND cancel = 1",
+                (json.dumps(CANCELLED_RESULT), time.time(), *params)).rowcount
+            failed += self.db.execute(
+                f"UPDATE jobs SET status = 'failed', result = ?, finished_at = ?, node = NULL "
+                f"WHERE status IN {self.RUNNING} AND {where} AND restarts >= ?",
+                (error, time.time(), *params, JOB_MAX_RESTARTS)).rowcount
+            requeued = self.db.execute(
+                f"UPDATE jobs SET status = 'queued', node = NULL, progress = NULL, restarts = restarts + 1 "
+                f"WHERE status IN {self.RUNNING} AND {where}", params).rowcount
+            return requeued, failed
+        return self._transaction(release)
+    
+    def cancel(self, job_id):
+        """
+        Cancel a job wherever it runs: a queued one fails right away, one
+        downloading is flagged for its replica to kill. While other requests
+        are attached to it, one fewer is counted instead, and 'attached' is
+        returned. Otherwise returns the job's status before, or None for an
+        unknown job.
+        """
+        def cancel():
+            row = self.db.execute('SELECT status, attached FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            if row[1] > 0 and row[0] in ('queued', 'downloading'):
+                self.db.execute('UPDATE jobs SET attached = attached - 1 WHERE id = ?', (job_id,))
+                return 'attached'
+            if row[0] == 'queued':
+                self.db.execute("UPDATE jobs SET status = 'failed', result = ?, finished_at = ? WHERE id = ?",
+                                (json.dumps(CANCELLED_RESULT), time.time(), job_id))
+            elif row[0] == 'downloading':
+                self.db.execute('UPDATE jobs SET cancel = 1 WHERE id = ?', (job_id,))
+            return row[0]
+        return self._transaction(cancel)
+    
+    def cancel_requests(self, node):
+        """IDs of the jobs held by `node` that were cancelled through another replica."""
+        with self.lock:
+            rows = self.db.execute('SELECT id FROM jobs WHERE node = ? AND cancel = 1', (node,)).fetchall()
+        return [row[0] for row in rows]
+    
+    def prune(self, keep):
+        """Forget all but the `keep` most recently finished jobs."""
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND id NOT IN ("
+                "SELECT id FROM jobs WHERE status IN ('done', 'failed') ORDER BY finished_at DESC LIMIT ?)",
+                (keep,))
+
+class JobManager:
+    """
+    Queues download jobs and runs them on two bounded thread pools: one for
+    yt-dlp downloads and one for cloud uploads, so slow uploads never hold
+    up a download slot.
+    """
+    
+    def __init__(self, download_workers=DOWNLOAD_WORKERS, upload_workers=UPLOAD_WORKERS, history=JOB_HISTORY,
+                 journal=None):
+        self.download_workers = download_workers
+        self.upload_workers = upload_workers
+        self.history = history
+        self.journal = journal
+        self.jobs = OrderedDict()
+        self.active = {}
+        self.lock = threading.Lock()
+        self.download_queue = DownloadScheduler()
+        self.upload_queue = queue.Queue()
+        self.threads = []
+        self.stopping = threading.Event()
+        self.busy = 0
+        self.idle = threading.Condition(self.lock)
+    
+    def start(self):
+        for i in range(self.download_workers):
+            self._spawn(self._download_worker, f'download-{i}')
+        for i in range(self.upload_workers):
+            self._spawn(self._upload_worker, f'upload-{i}')
+    
+    def recover(self):
+        """
+        Reload the journal after a restart. Finished jobs come back for status
+        polling; unfinished downloads are queued again, and yt-dlp resumes
+        their .part files; jobs whose file was downloaded but not yet
+        uploaded go straight to the upload pool. A job that was running
+        through JOB_MAX_RESTARTS restarts may be what kills the process, so
+        it is failed instead.
+        """
+        requeued = uploads = 0
+        for row in self.journal.load():
+            job = Job.from_row(row)
+            job.progress = None
+            job.restarts += row['status'] in ('downloading', 'uploading')
+            if job.restarts > JOB_MAX_RESTARTS and row['status'] not in ('done', 'failed'):
+                row['status'] = job.status = 'failed'
+                job.finished_at = time.time()
+                job.result = {'success': False, 'error': f'Gave up after {JOB_MAX_RESTARTS} server restarts'}
+                self.journal.save(job)
+            with self.lock:
+                self.jobs[job.id] = job
+                if job.finished:
+                    continue
+                self.active[job.key] = job
+            
+            if row['status'] == 'uploading' and job.filepath and os.path.exists(job.filepath):
+                job.status = 'uploading'
+                job.progress = {'phase': 'upload'}
+                self.journal.save(job)
+                self.upload_queue.put(job)
+                uploads += 1
+            else:
+                job.status = 'queued'
+                job.result = None
+                self.journal.save(job)
+                self.download_queue.put(job)
+                requeued += 1
+        with self.lock:
+            self._prune()
+        if requeued or uploads:
+            print(f"♻️  Recovered {requeued} unfinished downloads and {uploads} pending uploads")
+    
+    def _save(self, job):
+        if self.journal:
+            self.journal.save(job)
+    
+    def _spawn(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+    
+    def drain(self, timeout):
+        """Stop picking up queued work and wait for running jobs to finish."""
+        self.stopping.set()
+        deadline = time.monotonic() + timeout
+        with self.idle:
+            while self.busy and time.monotonic() < deadline:
+                self.idle.wait(deadline - time.monotonic())
+            return self.busy == 0
+    
+    def _next(self, work_queue):
+        # Poll so that workers notice drain() instead of blocking forever
+        while not self.stopping.is_set():
+            try:
+                job = work_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self.lock:
+                self.busy += 1
+            return job
+        return None
+    
+    def _done_with(self, job):
+        with self.idle:
+            self.busy -= 1
+            self.idle.notify_all()
+    
+    def submit(self, url, format_type, quality, share_link, pipeline=False, on_finish=None, client=None,
+               priority=None):
+        """
+        Queue a download and return `(job, attached)`. A request for a video,
+        format and quality that is already queued or running attaches to that
+        job instead of starting another one, so `attached` is True and every
+        caller polls the same job ID. `on_finish(job)` is called once the job
+        is done or failed. `client` identifies the requester for fair queuing.
+        `priority` pins the job's class; without it the class follows the
+        video's length and size once they are known.
+        """
+        job = new_job(url, format_type, quality, share_link, pipeline, client, priority)
+        with self.lock:
+            existing = self.active.get(job.key)
+            if existing is not None:
+                existing.attached += 1
+                if on_finish:
+                    existing.listeners.append(on_finish)
+                # Still before the upload decision, so the job can pick up
+                # the share request of the newcomer
+                if share_link and existing.status in ('queued', 'downloading'):
+                    existing.share_link = True
+                    self._save(existing)
+                return existing, True
+            
+            if on_finish:
+                job.listeners.append(on_finish)
+            self.jobs[job.id] = job
+            self.active[job.key] = job
+            self._prune()
+            self._save(job)
+        self.download_queue.put(job)
+        return job, False
+    
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+    
+    def cancel(self, job_id):
+        """
+        Cancel a job that is queued, downloading or post-processing, killing
+        its processes. A job other requests are attached to goes on for
+        them: only the last one to cancel stops it, the others detach.
+        Returns `(job, status, detached)`, the status 200 if it failed as
+        cancelled right away or was detached from, 202 if it fails once its
+        processes are gone, 404 for an unknown job and 409 for one that is
+        finished or uploading.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None, 404, False
+            if job.finished or job.status == 'uploading':
+                return job, 409, False
+            if job.attached > 0:
+                job.attached -= 1
+                self._save(job)
+                return job, 200, True
+            # Whatever would be started for it from now on is refused
+            job.processes.cancel()
+            dequeued = job.status == 'queued' and self.download_queue.remove(job)
+        if not dequeued:
+            return job, 202, False
+        self._finish(job, CANCELLED_RESULT)
+        return job, 200, False
+    
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+    
+    def stats(self):
+        return {
+            'downloadQueue': self.download_queue.qsize(),
+            'uploadQueue': self.upload_queue.qsize(),
+            'downloadWorkers': self.download_workers,
+            'uploadWorkers': self.upload_workers,
+            'postprocess': postprocessor.stats(),
+            'connections': connection_budget.stats(),
+            'bandwidth': bandwidth_budget.stats(),
+            'scheduler': self.download_queue.stats()
+        }
+    
+    def status_counts(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return [({'status': status}, n) for status, n in counts.items()]
+    
+    def _prune(self):
+        # Forget the oldest finished jobs once we hold more than `history`
+        excess = len(self.jobs) - self.history
+        forgotten = [j.id for j in self.jobs.values() if j.finished][:max(excess, 0)]
+        for job_id in forgotten:
+            del self.jobs[job_id]
+        if forgotten and self.journal:
+            self.journal.delete(forgotten)
+    
+    def _finish(self, job, result):
+        result = dict(result, timings=job.close_timings())
+        if job.processes.spawned:
+            result['resources'] = job.processes.usage()
+        record_job(job, result)
+        with self.lock:
+            job.update(result=result,
+                       status='done' if result['success'] else 'failed',
+                       finished_at=time.time())
+            self.active.pop(job.key, None)
+            self._save(job)
+        for listener in job.listeners:
+            try:
+                listener(job)
+            except Exception as e:
+                print(f"❌ Job listener failed: {e}")
+    
+    def _download_worker(self):
+        while True:
+            job = self._next(self.download_queue)
+            if job is None:
+                return
+            try:
+                self._download(job)
+            except Exception as e:
+                # Whatever went wrong, the worker lives on and the job's slots come back
+                print(f"❌ Download worker failed on job {job.id}: {e}")
+                result = {'success': False, 'error': str(e)}
+                self.download_queue.done(job, result)
+                if not job.finished:
+                    self._finish(job, result)
+            finally:
+                self._done_with(job)
+    
+    def _download(self, job):
+        if job.processes.cancelled:
+            # Cancelled as a worker took it off the queue
+            self.download_queue.done(job, CANCELLED_RESULT)
+            self._finish(job, CANCELLED_RESULT)
+            return
+        job.update(status='downloading', started_at=time.time(), progress={'phase': 'download'})
+        self._save(job)
+        try:
+            if not self._classify(job):
+                # Nothing downloaded yet, and the probe stays cached
+                self._requeue(job)
+                return
+            if job.pipeline:
+                result = pipelined_download_and_share(job.url, job.format_type, job.quality,
+                                                      progress=lambda update: job.update(progress=update),
+                                                      processes=job.processes, priority=job.priority)
+            else:
+                result = download_video(job.url, job.format_type, job.quality,
+                                        progress=lambda update: job.update(progress=update), defer=True,
+                                        processes=job.processes, priority=job.priority)
+        except Exception as e:
+            result = {'success': False, 'error': str(e)}
+        self.download_queue.done(job, result)
+        if job.pipeline:
+            self._finish(job, CANCELLED_RESULT if job.processes.cancelled else result)
+            return
+        
+        if 'pending' in result:
+            # ffmpeg runs on the postprocessor pool while this worker moves on
+            with self.lock:
+                self.busy += 1
+            result['pending'].add_done_callback(lambda pending: self._postprocessed(job, pending, result))
+        else:
+            self._downloaded(job, result)
+    
+    def _classify(self, job):
+        """
+        Settle the priority class of a job that was not given one, from the
+        probe its download begins with. False if that class has no worker to
+        spare and the job gave its slots back.
+        """
+        if job.pinned or job.cached:
+            return True
+        job.update(progress={'phase': 'extract'})
+        info, _ = probe(job.url)
+        if not info:
+            return True
+        job.pinned = True
+        priority = job_priority(info, job.format_type, job.quality)
+        if priority != job.priority and not self.download_queue.reclassify(job, priority):
+            return False
+        self._save(job)
+        return True
+    
+    def _postprocessed(self, job, pending, result):
+        try:
+            result = dict(pending.result(), coalesced=result['coalesced'])
+        except Exception as e:
+            result = {'success': False, 'error': str(e)}
+        try:
+            self._downloaded(job, result)
+        finally:
+            self._done_with(job)
+    
+    def _requeue(self, job):
+        """Put a job that started without downloading anything back in the queue."""
+        job.update(status='queued', started_at=None, progress=None)
+        self._save(job)
+        self.download_queue.put(job)
+    
+    def _downloaded(self, job, result):
+        """Send a downloaded job on to the upload pool, or finish it."""
+        if job.processes.cancelled:
+            result = CANCELLED_RESULT
+        with self.lock:
+            upload = (result['success'] and job.share_link and not result['shareUrl']
+                      and os.path.exists(result['filepath']))
+            if upload:
+                job.update(filepath=result['filepath'], result=result,
+                           status='uploading', progress={'phase': 'upload'})
+                self._save(job)
+        
+        if upload:
+            self.upload_queue.put(job)
+        else:
+            self._finish(job, result)
+    
+    def _upload_worker(self):
+        while True:
+            job = self._next(self.upload_queue)
+            if job is None:
+                return
+            try:
+                self._upload(job)
+            finally:
+                self._done_with(job)
+    
+    def _upload(self, job):
+        try:
+            share_url = share_file(job.url, job.format_type, job.quality, job.filepath,
+                                   progress=lambda update: job.update(progress=update),
+                                   filename=(job.result or {}).get('filename'))
+        except Exception:
+            share_url = None
+        self._finish(job, dict(job.result, shareUrl=share_url))
+
+class RemoteJob(Job):
+    """
+    A job held by another replica, seen through the shared journal. It only
+    changes when refreshed from its row, which wait() does by polling.
+    """
+    
+    def __init__(self, journal, row):
+        super().__init__(row['url'], row['format'], row['quality'], bool(row['share_link']),
+                         bool(row['pipeline']), row['client'])
+        self.id = row['id']
+        self.journal = journal
+        self.apply_row(row)
+    
+    def refresh(self, row=None):
+        """Take the latest state from `row` or the journal; True if anything changed."""
+        row = row or self.journal.get(self.id)
+        if row is None:
+            return False
+        before = self.to_dict()
+        self.apply_row(row)
+        if self.to_dict() == before:
+            return False
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+        return True
+    
+    def wait(self, version, timeout):
+        deadline = time.monotonic() + timeout
+        while self.version == version and not self.finished:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(JOB_POLL_INTERVAL, remaining))
+            self.refresh()
+        return self.version
+
+class LeasedJob(Job):
+    """
+    A job this replica claimed from the shared journal. Status changes are
+    published by SharedJobManager._save(); progress is published here too,
+    at most once a second, so other replicas can show it.
+    """
+    
+    def __init__(self, manager, row):
+        super().__init__(row['url'], row['format'], row['quality'], bool(row['share_link']),
+                         bool(row['pipeline']), row['client'])
+        self.id = row['id']
+        self.manager = manager
+        self.apply_row(row)
+        self.published = 0
+    
+    def update(self, **fields):
+        super().update(**fields)
+        if set(fields) == {'progress'} and time.monotonic() - self.published >= 1:
+            self.manager._save(self)
+    
+    def publish(self):
+        """Write this job to the journal unless it meanwhile belongs to another replica."""
+        self.published = time.monotonic()
+        return self.manager.journal.publish(self, self.manager.node_id, time.time() + JOB_LEASE)
+
+class BrokerQueue(DownloadScheduler):
+    """
+    Download queue of a SharedJobManager: queued jobs live in the shared
+    journal, and get() claims the next one for this replica. Site limits are
+    still applied, per replica, by leaving sites that are not ready out of
+    the claim.
+    """
+    
+    def __init__(self, manager):
+        super().__init__()
+        self.manager = manager
+    
+    def put(self, job):
+        # The journal row is the queue entry; wake a local worker to claim it
+        with self.cond:
+            self.cond.notify()
+    
+    def get(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            with self.cond:
+                blocked = [name for name, limiter in self.sites.items() if limiter.ready_in(now) != 0]
+                classes = self._classes()
+            job = self.manager.claim(blocked, classes) if classes else None
+            if job is not None:
+                job.cached = download_cache.contains(job.key)
+                with self.cond:
+                    self._started(job)
+                    if not job.cached:
+                        self._site(job.site).acquire()
+                return job
+            remaining = deadline - now
+            if remaining <= 0:
+                raise queue.Empty
+            with self.cond:
+                self.cond.wait(min(remaining, JOB_POLL_INTERVAL))
+    
+    def done(self, job, result):
+        # Another replica may have attached a share request meanwhile
+        job.share_link = job.share_link or self.manager.journal.share_link(job.id)
+        super().done(job, result)
+    
+    def qsize(self):
+        return self.manager.journal.queued()
+
+class SharedJobManager(JobManager):
+    """
+    JobManager for running several replicas against one journal on a shared
+    volume. Frontends (ROLE=frontend) only write jobs to the journal; workers
+    (ROLE=worker) claim them under a lease they keep renewing, and a job
+    whose lease runs out, because its replica died, goes back in the queue
+    for another one. ROLE=all does both. Status and dedup go through the
+    journal, so any replica can answer for any job.
+    """
+    
+    def __init__(self, journal, role=ROLE, node_id=NODE_ID, **kwargs):
+        super().__init__(journal=journal, **kwargs)
+        self.role = role
+        self.node_id = node_id
+        self.download_queue = BrokerQueue(self)
+        # Jobs submitted here that run elsewhere, by ID, while someone listens
+        self.watched = {}
+    
+    def start(self):
+        if self.role != 'frontend':
+            super().start()
+        self._spawn(self._maintain, 'journal')
+    
+    def recover(self):
+        """Put back in the queue whatever this replica was running before a restart."""
+        requeued, failed = self.journal.release(node=self.node_id)
+        if requeued or failed:
+            print(f"♻️  Released {requeued} jobs of {self.node_id} back to the queue, {failed} failed")
+    
+    def submit(self, url, format_type, quality, share_link, pipeline=False, on_finish=None, client=None,
+               priority=None):
+        job = new_job(url, format_type, quality, share_link, pipeline, client, priority)
+        existing = self.journal.submit(job)
+        if existing is None:
+            self.download_queue.put(job)
+        job_id = existing or job.id
+        if not on_finish:
+            return self.get(job_id), existing is not None
+        # Listeners are called by _maintain(), wherever the job runs
+        with self.lock:
+            job = self.watched.get(job_id)
+        if job is None:
+            job = RemoteJob(self.journal, self.journal.get(job_id))
+        with self.lock:
+            job = self.watched.setdefault(job_id, job)
+            job.listeners.append(on_finish)
+        return job, existing is not None
+    
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id) or self.watched.get(job_id)
+        if job is not None:
+            return job
+        row = self.journal.get(job_id)
+        return RemoteJob(self.journal, row) if row else None
+    
+    def list(self):
+        with self.lock:
+            local = dict(self.jobs)
+        return [local.get(row['id']) or RemoteJob(self.journal, row) for row in self.journal.recent(self.history)]
+    
+    def status_counts(self):
+        return [({'status': status}, n) for status, n in self.journal.status_counts()]
+    
+    def cancel(self, job_id):
+        # Requests attach through the journal, so only it knows how many there are
+        before = self.journal.cancel(job_id)
+        if before is None:
+            return None, 404, False
+        if before == 'attached':
+            return self.get(job_id), 200, True
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None and before == 'downloading':
+            # Ours: no need to wait for _cancel_requested() to notice
+            job.processes.cancel()
+        statuses = {'queued': 200, 'downloading': 202}
+        return self.get(job_id), statuses.get(before, 409), False
+    
+    def claim(self, blocked_sites, priorities=PRIORITIES):
+        if self.stopping.is_set():
+            return None
+        row = self.journal.claim(self.node_id, time.time() + JOB_LEASE, blocked_sites, priorities)
+        if row is None:
+            return None
+        job = LeasedJob(self, row)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.active[job.key] = job
+        return job
+    
+    def _save(self, job):
+        if isinstance(job, LeasedJob) and not job.publish():
+            print(f"⚠️  Lost the lease on job {job.id}, another replica has taken it over")
+    
+    def _finish(self, job, result):
+        super()._finish(job, result)
+        with self.lock:
+            self.jobs.pop(job.id, None)
+    
+    def _requeue(self, job):
+        with self.lock:
+            self.jobs.pop(job.id, None)
+            self.active.pop(job.key, None)
+        self.journal.requeue(job, self.node_id)
+        self.download_queue.put(job)
+    
+    def _prune(self):
+        # The journal is pruned by _maintain() instead
+        pass
+    
+    def _maintain(self):
+        last_lease = 0
+        while True:
+            time.sleep(1)
+            self._notify_watchers()
+            self._cancel_requested()
+            if time.monotonic() - last_lease < JOB_LEASE / 3:
+                continue
+            last_lease = time.monotonic()
+            try:
+                with self.lock:
+                    running = list(self.jobs)
+                self.journal.renew(self.node_id, running, time.time() + JOB_LEASE)
+                requeued, failed = self.journal.release(expired_before=time.time())
+                if requeued or failed:
+                    print(f"♻️  Requeued {requeued} jobs of unresponsive replicas, {failed} failed")
+                self.journal.prune(self.history)
+            except sqlite3.Error as e:
+                print(f"❌ Job journal maintenance failed: {e}")
+    
+    def _cancel_requested(self):
+        """Kill the local jobs that were cancelled through other replicas."""
+        try:
+            job_ids = self.journal.cancel_requests(self.node_id)
+        except sqlite3.Error as e:
+            print(f"❌ Job journal poll failed: {e}")
+            return
+        for job_id in job_ids:
+            with self.lock:
+                job = self.jobs.get(job_id)
+            if job is not None and not job.processes.cancelled:
+                job.processes.cancel()
+    
+    def _notify_watchers(self):
+        with self.lock:
+            watched = list(self.watched.values())
+        if not watched:
+            return
+        try:
+            rows = {row['id']: row for row in self.journal.get_many([job.id for job in watched])}
+        except sqlite3.Error as e:
+            print(f"❌ Job journal poll failed: {e}")
+            return
+        for job in watched:
+            job.refresh(rows.get(job.id))
+            if not job.finished and job.id in rows:
+                continue
+            with self.lock:
+                self.watched.pop(job.id, None)
+            for listener in job.listeners:
+                try:
+                    listener(job)
+                except Exception as e:
+                    print(f"❌ Job listener failed: {e}")
+
+def make_job_manager():
+    journal = JobJournal(JOB_DB)
+    if CLUSTER:
+        return SharedJobManager(journal)
+    return JobManager(journal=journal)
+
+job_manager = make_job_manager()
+
+def record_job(job, result):
+    """Feed a finished job into the metrics."""
+    status = 'done' if result['success'] else 'failed'
+    JOBS_TOTAL.inc(site=job.site, status=status)
+    JOB_SECONDS.observe(time.time() - job.created_at, status=status, priority=job.priority)
+    for phase, seconds in result['timings'].items():
+        PHASE_SECONDS.observe(seconds, phase=phase)
+    if not result['success']:
+        ERRORS_TOTAL.inc(category=error_category(result.get('error')))
+        return
+    if job.share_link and not result.get('shareUrl'):
+        ERRORS_TOTAL.inc(category='upload')
+    if not result.get('cached') and not result.get('coalesced') and os.path.exists(result.get('filepath') or ''):
+        DOWNLOAD_BYTES.inc(os.path.getsize(result['filepath']), site=job.site)
+        DOWNLOAD_SECONDS.inc(result['timings'].get('download', 0), site=job.site)
+
+def expand_playlist(url):
+    """Video URLs of a playlist (one flat extraction, no per-video requests), or [url]."""
+    info, error = download_engine.extract_info(url, flat_playlist=True)
+    if error:
+        raise RuntimeError(error)
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        return [url]
+    
+    urls = []
+    for entry in info.get('entries') or []:
+        if not entry:
+            continue
+        entry_url = entry.get('webpage_url') or entry.get('url')
+        if entry_url and not entry_url.startswith(('http://', 'https://')) and entry.get('ie_key') == 'Youtube':
+            # Older yt-dlp versions give bare video IDs for flat YouTube entries
+            entry_url = f'https://www.youtube.com/watch?v={entry_url}'
+        if entry_url:
+            urls.append(entry_url)
+    return urls
+
+class Batch:
+    """
+    A list of URLs downloaded as a group. At most `concurrency` of its jobs
+    are queued at a time, so one big playlist cannot crowd everyone else
+    out of the worker pool; the rest wait here until a slot frees up.
+    Batches are not journalled: they live on the replica that created
+    them, and the load balancer must send their requests there.
+    """
+    
+    def __init__(self, urls, format_type, quality, share_link, concurrency, client=None):
+        self.id = uuid.uuid4().hex
+        self.urls = urls
+        self.format_type = format_type
+        self.quality = quality
+        self.share_link = share_link
+        self.concurrency = concurrency
+        self.client = client
+        self.created_at = time.time()
+        self.jobs = [None] * len(urls)
+        self.next_index = 0
+        self.running = 0
+        self.finished = []
+        self.changed = threading.Condition()
+    
+    def start(self):
+        with self.changed:
+            for _ in range(min(self.concurrency, len(self.urls))):
+                self._submit_next()
+    
+    def _submit_next(self):
+        # Called with self.changed held
+        if self.next_index >= len(self.urls):
+            return
+        index = self.next_index
+        self.next_index += 1
+        self.running += 1
+        job, _ = job_manager.submit(self.urls[index], self.format_type, self.quality, self.share_link,
+                                    on_finish=lambda job: self._on_finish(index, job), client=self.client,
+                                    priority='bulk')
+        self.jobs[index] = job
+    
+    def _on_finish(self, index, job):
+        with self.changed:
+            self.jobs[index] = job
+            self.running -= 1
+            self.finished.append(index)
+            self._submit_next()
+            self.changed.notify_all()
+    
+    @property
+    def done(self):
+        return len(self.finished) == len(self.urls)
+    
+    def wait_finished(self, seen, timeout):
+        """Indexes that finished since the first `seen` ones, waiting up to `timeout` for one."""
+        with self.changed:
+            self.changed.wait_for(lambda: len(self.finished) > seen, timeout)
+            return self.finished[seen:]
+    
+    def to_dict(self):
+        counts = {}
+        for job in self.jobs:
+            status = job.status if job else 'pending'
+            counts[status] = counts.get(status, 0) + 1
+        return {
+            'id': self.id,
+            'format': self.format_type,
+            'quality': self.quality,
+            'createdAt': self.created_at,
+            'total': len(self.urls),
+            'counts': counts,
+            'done': self.done,
+            'zipUrl': f'/batches/{self.id}/zip',
+            'items': [
+                {'url': url, 'jobId': job.id if job else None, 'status': job.status if job else 'pending',
+                 'filename': (job.result or {}).get('filename') if job else None}
+                for url, job in zip(self.urls, self.jobs)
+            ]
+        }
+
+batches = OrderedDict()
+batches_lock = threading.Lock()
+
+def submit_batch(urls, format_type, quality, share_link, concurrency, client=None):
+    batch = Batch(urls, format_type, quality, share_link, concurrency, client)
+    with batches_lock:
+        batches[batch.id] = batch
+        while len(batches) > BATCH_HISTORY:
+            batches.popitem(last=False)
+    batch.start()
+    return batch
+
+class ChunkedWriter:
+    """Write-only file object that sends everything as HTTP chunks."""
+    
+    def __init__(self, wfile):
+        self.wfile = wfile
+    
+    def write(self, data):
+        if data:
+            self.wfile.write(b'%X\r\n%s\r\n' % (len(data), bytes(data)))
+        return len(data)
+    
+    def flush(self):
+        self.wfile.flush()
+    
+    def close(self):
+        self.wfile.write(b'0\r\n\r\n')
+
+
+def parse_range(header, size):
+    """
+    `(start, end)` of a single `bytes=` range, inclusive and clamped to the
+    file, or None if it cannot be satisfied. Multi-range requests are served
+    as their first range.
+    """
+    unit, _, ranges = header.partition('=')
+    match = re.fullmatch(r'\s*(\d*)\s*-\s*(\d*)\s*', ranges.split(',')[0])
+    if unit.strip().lower() != 'bytes' or not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        length = min(int(last), size)
+        return (size - length, size - 1) if length else None
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return None
+    return start, end
+
+def not_before(http_date, mtime):
+    """True if `http_date` is a valid date no earlier than `mtime` (HTTP dates have 1s resolution)."""
+    if not http_date:
+        return False
+    try:
+        return email.utils.parsedate_to_datetime(http_date).timestamp() >= int(mtime)
+    except (TypeError, ValueError):
+        return False
+
+def content_disposition(filename):
+    """Attachment header that survives non-ASCII titles (RFC 6266 / 5987)."""
+    fallback = filename.encode('ascii', 'replace').decode().replace('?', '_').replace('"', "'").replace('\\', '_')
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+def parse_trusted_proxies(spec):
+    """'10.0.0.0/8,::1' -> networks whose X-Forwarded-For is believed; '*' trusts every peer."""
+    if spec.strip() == '*':
+        return [ipaddress.ip_network('0.0.0.0/0'), ipaddress.ip_network('::/0')]
+    networks = []
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        try:
+            networks.append(ipaddress.ip_network(item.strip(), strict=False))
+        except ValueError:
+            raise SystemExit(f"Invalid TRUSTED_PROXIES entry {item.strip()!r}, expected an address or network")
+    return networks
+
+trusted_proxies = parse_trusted_proxies(TRUSTED_PROXIES)
+
+def is_trusted_proxy(address):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in trusted_proxies)
+
+class DownloadHandler(SimpleHTTPRequestHandler):
+    timeout = KEEPALIVE_TIMEOUT
+    
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes; without this, Nagle
+        # holds the body back until the client's delayed ACK of the headers
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Only the threaded core can afford to park a thread on an idle
+        # keep-alive connection
+        if getattr(self.server, 'keep_alive', False):
+            self.protocol_version = 'HTTP/1.1'
+    
+    def handle_one_request(self):
+        super().handle_one_request()
+        if getattr(self.server, 'draining', False):
+            self.close_connection = True
+    
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/' or path == '/index.html':
+            self.send_static(INDEX_PAGE)
+        elif path in STATIC_ASSETS:
+            self.send_static(STATIC_ASSETS[path])
+        elif path == '/health':
+            self.send_json({"status": "ok"})
+        elif path == '/metrics':
+            body = render_metrics().encode()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/info':
+            self.send_info(parse_qs(urlparse(self.path).query))
+        elif path == '/stream':
+            self.stream_download(parse_qs(urlparse(self.path).query))
+        elif path.startswith('/files/'):
+            self.send_file(path[len('/files/'):])
+        elif path == '/jobs':
+            self.send_json({
+                'jobs': [job.to_dict() for job in job_manager.list()],
+                'stats': dict(job_manager.stats(), cache=download_cache.stats(), storage=storage.stats())
+            })
+        elif path.startswith('/batches/'):
+            batch_id, _, action = path[len('/batches/'):].partition('/')
+            with batches_lock:
+                batch = batches.get(batch_id)
+            if batch is None or action not in ('', 'zip'):
+                # Batches are pinned to the replica that took them
+                error = 'Unknown batch' + (f' on replica {NODE_ID}' if CLUSTER else '')
+                self.send_json({'success': False, 'error': error}, 404)
+            elif action == 'zip':
+                self.stream_batch_zip(batch)
+            else:
+                self.send_json(batch.to_dict())
+        elif path.startswith('/jobs/') and path.endswith('/events'):
+            job = job_manager.get(path[len('/jobs/'):-len('/events')])
+            if job is None:
+                self.send_json({'success': False, 'error': 'Unknown job'}, 404)
+            else:
+                self.stream_job_events(job)
+        elif path.startswith('/jobs/'):
+            job = job_manager.get(path[len('/jobs/'):])
+            if job is None:
+                self.send_json({'success': False, 'error': 'Unknown job'}, 404)
+            else:
+                self.send_json(job.to_dict())
+        else:
+            self.send_error(404)
+    
+    def do_HEAD(self):
+        path = urlparse(self.path).path
+        if path.startswith('/files/'):
+            self.send_file(path[len('/files/'):], head=True)
+        elif path == '/' or path == '/index.html':
+            self.send_static(INDEX_PAGE, head=True)
+        elif path in STATIC_ASSETS:
+            self.send_static(STATIC_ASSETS[path], head=True)
+        else:
+            self.send_error(405)
+    
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path not in ('/batch', '/download'):
+            # The body was never read, so the connection cannot be reused
+            self.close_connection = True
+            self.send_error(404)
+            return
+        data = self.read_json()
+        if data is None:
+            return
+        if path == '/batch':
+            self.create_batch(data)
+            return
+        
+        url = data.get('url', '')
+        format_type = data.get('format', 'video')
+        quality = data.get('quality', '720')
+        share_link = bool(data.get('shareLink', False))
+        pipeline = bool(data.get('pipeline', PIPELINE_UPLOADS))
+        priority = data.get('priority')
+        error = check_url(url) or check_options(format_type, quality, priority)
+        if error:
+            self.send_json({'success': False, 'error': error}, 400)
+            return
+        
+        job, attached = job_manager.submit(url.strip(), format_type, quality, share_link, pipeline,
+                                           client=self.client_ip(), priority=priority)
+        
+        self.send_json({
+            'success': True,
+            'jobId': job.id,
+            'attached': attached,
+            'status': job.status,
+            'statusUrl': f'/jobs/{job.id}'
+        }, 202)
+    
+    def read_json(self):
+        """
+        The request body as a JSON object, or None after sending the error.
+        The body must announce its length and stay under MAX_BODY_BYTES, and
+        all of it must arrive within BODY_TIMEOUT, so a slow or oversized
+        upload cannot hold the handler thread.
+        """
+        length = self.headers.get('Content-Length')
+        if length is None:
+            self.close_connection = True
+            self.send_json({'success': False, 'error': 'Content-Length required'}, 411)
+            return None
+        if not re.fullmatch(r'[0-9]+', length.strip()):
+            self.close_connection = True
+            self.send_json({'success': False, 'error': 'Invalid Content-Length'}, 400)
+            return None
+        if int(length) > MAX_BODY_BYTES:
+            self.close_connection = True
+            self.send_json({'success': False, 'error': f'Body larger than {MAX_BODY_BYTES} bytes'}, 413)
+            return None
+        
+        remaining = int(length)
+        chunks = []
+        deadline = time.monotonic() + BODY_TIMEOUT
+        try:
+            while remaining:
+                self.connection.settimeout(max(deadline - time.monotonic(), 0.001))
+                chunk = self.rfile.read1(remaining)
+                if not chunk:
+                    self.close_connection = True
+                    return None
+                chunks.append(chunk)
+                remaining -= len(chunk)
+        except socket.timeout:
+            self.close_connection = True
+            self.send_json({'success': False, 'error': 'Timed out reading the request body'}, 408)
+            return None
+        finally:
+            self.connection.settimeout(self.timeout)
+        
+        try:
+            data = json.loads(b''.join(chunks))
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            self.send_json({'success': False, 'error': 'Body must be a JSON object'}, 400)
+            return None
+        return data
+    
+    def do_DELETE(self):
+        if self.headers.get('Content-Length', '0') != '0':
+            # The body is never read, so the connection cannot be reused
+            self.close_connection = True
+        path = urlparse(self.path).path
+        if not path.startswith('/jobs/') or '/' in path[len('/jobs/'):]:
+            self.send_error(404)
+            return
+        job, status, detached = job_manager.cancel(path[len('/jobs/'):])
+        if job is None:
+            self.send_json({'success': False, 'error': 'Unknown job'}, 404)
+        elif status == 409:
+            self.send_json({'success': False, 'error': f'Job is already {job.status}', 'job': job.to_dict()}, 409)
+        else:
+            self.send_json({'success': True, 'detached': detached, 'job': job.to_dict()}, status)
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def stream_job_events(self, job):
+        """Server-Sent Events feed of a job's state until it finishes."""
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        # No length up front, so the end of the stream is the end of the connection
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        
+        version = None
+        try:
+            while True:
+                current = job.wait(version, timeout=15)
+                if current == version:
+                    if getattr(self.server, 'draining', False):
+                        return
+                    self.wfile.write(b': keep-alive\n\n')
+                else:
+                    version = current
+                    event = 'done' if job.finished else 'progress'
+                    self.wfile.write(f'event: {event}\ndata: {json.dumps(job.to_dict())}\n\n'.encode())
+                    if job.finished:
+                        return
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+    
+    def create_batch(self, data):
+        format_type = data.get('format', 'video')
+        quality = data.get('quality', '720')
+        share_link = bool(data.get('shareLink', False))
+        concurrency = data.get('concurrency', BATCH_CONCURRENCY)
+        error = check_options(format_type, quality)
+        if not error and not isinstance(concurrency, int):
+            error = 'concurrency must be a number'
+        if not error and not isinstance(data.get('urls') or [], list):
+            error = 'urls must be a list'
+        if not error and data.get('url'):
+            error = check_url(data['url'])
+        urls = [u.strip() for u in data.get('urls') or [] if isinstance(u, str) and u.strip()]
+        for url in urls:
+            error = error or check_url(url)
+        if error:
+            self.send_json({'success': False, 'error': error}, 400)
+            return
+        concurrency = max(1, min(concurrency, BATCH_CONCURRENCY))
+        
+        if data.get('url'):
+            try:
+                urls.extend(expand_playlist(data['url'].strip()))
+            except Exception as e:
+                self.send_json({'success': False, 'error': str(e)}, 502)
+                return
+        if not urls:
+            self.send_json({'success': False, 'error': 'No URLs given'}, 400)
+            return
+        if len(urls) > MAX_BATCH_ITEMS:
+            self.send_json({'success': False, 'error': f'At most {MAX_BATCH_ITEMS} items per batch'}, 400)
+            return
+        
+        batch = submit_batch(urls, format_type, quality, share_link, concurrency, self.client_ip())
+        self.send_json({
+            'success': True,
+            'batchId': batch.id,
+            'items': len(urls),
+            'statusUrl': f'/batches/{batch.id}',
+            'zipUrl': f'/batches/{batch.id}/zip'
+        }, 202)
+    
+    def stream_batch_zip(self, batch):
+        """
+        Send the batch as a ZIP built on the fly: each file is added as soon
+        as its job finishes, straight from DOWNLOAD_DIR into the response, so
+        no archive is ever staged on disk. Failed items are listed in
+        errors.txt at the end.
+        """
+        self.send_response(200)
+        self.send_header('Content-type', 'application/zip')
+        self.send_header('Content-Disposition', f'attachment; filename="batch-{batch.id[:8]}.zip"')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        chunked = self.request_version == 'HTTP/1.1' and self.protocol_version == 'HTTP/1.1'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            out = ChunkedWriter(self.wfile)
+        else:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+            out = self.wfile
+        self.end_headers()
+        
+        names = set()
+        errors = []
+        seen = 0
+        try:
+            # Media is already compressed; storing keeps this cheap
+            with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as archive:
+                while seen < len(batch.urls):
+                    for index in batch.wait_finished(seen, timeout=15):
+                        seen += 1
+                        job = batch.jobs[index]
+                        result = job.result or {}
+                        if not result.get('success') or not os.path.exists(result.get('filepath', '')):
+                            errors.append(f"{batch.urls[index]}: {result.get('error') or 'file missing'}")
+                            continue
+                        
+                        name = result['filename']
+                        stem, ext = os.path.splitext(name)
+                        copy = 2
+                        while name in names:
+                            name = f'{stem} ({copy}){ext}'
+                            copy += 1
+                        names.add(name)
+                        entry = zipfile.ZipInfo.from_file(result['filepath'], name)
+                        with open(result['filepath'], 'rb') as src, \
+                                archive.open(entry, 'w', force_zip64=True) as dest:
+                            shutil.copyfileobj(src, dest, STREAM_CHUNK_SIZE)
+                        out.flush()
+                if errors:
+                    archive.writestr('errors.txt', '\n'.join(errors) + '\n')
+            if chunked:
+                out.close()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+    
+    def send_info(self, params):
+        url = params.get('url', [''])[0]
+        error = check_url(url)
+        if error:
+            self.send_json({'success': False, 'error': error}, 400)
+            return
+        try:
+            info, cached = info_cache.get(url)
+        except Exception as e:
+            self.send_json({'success': False, 'error': str(e)}, 502)
+            return
+        self.send_json({'success': True, 'cached': cached, 'info': summarize_info(info)})
+    
+    def stream_download(self, params):
+        """
+        Relay yt-dlp's stdout straight to the client with chunked transfer
+        encoding. Nothing touches DOWNLOAD_DIR and the first bytes go out as
+        soon as yt-dlp produces them.
+        """
+        url = params.get('url', [''])[0]
+        format_type = params.get('format', ['video'])[0]
+        quality = params.get('quality', ['720'])[0]
+        error = check_url(url) or check_options(format_type, quality)
+        if error:
+            self.send_json({'success': False, 'error': error}, 400)
+            return
+        if not stream_slots.acquire(blocking=False):
+            self.send_json({'success': False, 'error': 'Too many streams, try again shortly'}, 503)
+            return
+        
+        SPAWNS_TOTAL.inc(kind='stream')
+        processes = JobProcesses()
+        try:
+            proc = processes.spawn([
+                YT_DLP_PATH,
+                '-f', stream_format(format_type, quality),
+                '-o', '-',
+                '--no-playlist',
+                '--quiet', '--no-warnings',
+                *ytdlp_source(url)
+            ], DOWNLOAD_TIMEOUT, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except Exception as e:
+            # e.g. EAGAIN or EMFILE under load; the slot must not leak with it
+            stream_slots.release()
+            self.send_json({'success': False, 'error': f'Could not start the download: {e}'}, 503)
+            return
+        errors = deque(maxlen=20)
+        stderr_reader = threading.Thread(
+            target=lambda: errors.extend(line.decode(errors='replace').rstrip() for line in proc.stderr),
+            daemon=True)
+        stderr_reader.start()
+        
+        try:
+            first = proc.stdout.read1(STREAM_CHUNK_SIZE)
+            if not first:
+                processes.wait(proc)
+                stderr_reader.join()
+                self.send_json({'success': False, 'error': '\n'.join(errors) or 'Download failed'}, 502)
+                return
+            
+            content_type, ext = sniff_media_type(first)
+            chunked = self.request_version == 'HTTP/1.1' and self.protocol_version == 'HTTP/1.1'
+            self.send_response(200)
+            self.send_header('Content-type', content_type)
+            self.send_header('Content-Disposition', f'attachment; filename="download.{ext}"')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            if chunked:
+                self.send_header('Transfer-Encoding', 'chunked')
+            else:
+                self.send_header('Connection', 'close')
+                self.close_connection = True
+            self.end_headers()
+            
+            chunk = first
+            while chunk:
+                if chunked:
+                    self.wfile.write(b'%X\r\n%s\r\n' % (len(chunk), chunk))
+                else:
+                    self.wfile.write(chunk)
+                chunk = proc.stdout.read1(STREAM_CHUNK_SIZE)
+            
+            if processes.wait(proc)[0] != 0:
+                # Too late for an error status; a missing terminating chunk
+                # tells the client the body is incomplete
+                self.log_message('stream of %s failed: %s', url, errors[-1] if errors else proc.returncode)
+                self.close_connection = True
+            elif chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            if proc.returncode is None:
+                processes.kill(proc)
+                processes.wait(proc)
+            proc.stdout.close()
+            proc.stderr.close()
+            stream_slots.release()
+    
+    def send_static(self, asset, head=False):
+        """Serve a StaticAsset in the best encoding the client takes, or 304 if its copy is current."""
+        coding = asset.negotiate(self.headers.get('Accept-Encoding'))
+        etag = asset.etags[coding]
+        if self.not_modified(etag, asset.mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', asset.cache_control)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+        
+        body = asset.bodies[coding]
+        self.send_response(200)
+        self.send_header('Content-type', asset.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if coding != 'identity':
+            self.send_header('Content-Encoding', coding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', asset.cache_control)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+    
+    def send_file(self, fid, head=False):
+        """
+        Serve a cached download from disk. Supports a single byte range (for
+        seeking and resumed downloads), conditional requests against an ETag
+        built from size and mtime, and an optional per-connection rate limit.
+        The body goes out with sendfile(), so it never passes through Python.
+        """
+        found = download_cache.find_file(fid)
+        if found is None:
+            self.send_json({'success': False, 'error': 'Unknown file'}, 404)
+            return
+        filepath = found['filepath']
+        try:
+            f = open(filepath, 'rb')
+        except OSError:
+            # The janitor evicted it since the lookup
+            self.send_json({'success': False, 'error': 'Unknown file'}, 404)
+            return
+        
+        with f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+            last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+            
+            if self.not_modified(etag, st.st_mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                return
+            
+            start, end = 0, size - 1
+            partial = False
+            byte_range = self.headers.get('Range')
+            if byte_range and self.range_applies(etag, st.st_mtime):
+                parsed = parse_range(byte_range, size)
+                if parsed is None:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                (start, end), partial = parsed, True
+            
+            self.send_response(206 if partial else 200)
+            self.send_header('Content-type', mimetypes.guess_type(filepath)[0] or 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            # Files are stored by video ID; the title only shows up here
+            self.send_header('Content-Disposition', content_disposition(download_name(filepath, found['title'])))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Cache-Control', 'private, max-age=0, must-revalidate')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            if partial:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.end_headers()
+            if head or end < start:
+                return
+            
+            try:
+                self.send_range(f, start, end - start + 1)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+    
+    def not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return if_none_match.strip() == '*' or etag in (tag.strip() for tag in if_none_match.split(','))
+        return not_before(self.headers.get('If-Modified-Since'), mtime)
+    
+    def range_applies(self, etag, mtime):
+        """If-Range: only honour Range when the client's copy is still current."""
+        if_range = self.headers.get('If-Range')
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith(('"', 'W/')):
+            return if_range == etag
+        return not_before(if_range, mtime)
+    
+    def send_range(self, f, offset, count):
+        """sendfile() `count` bytes from `offset`, paced to FILE_RATE_LIMIT bytes/s if set."""
+        if not FILE_RATE_LIMIT:
+            self.connection.sendfile(f, offset, count)
+            return
+        # Send in slices of a tenth of a second's worth and sleep off any lead
+        slice_size = max(FILE_RATE_LIMIT // 10, 16 * 1024)
+        started = time.monotonic()
+        sent = 0
+        while sent < count:
+            sent += self.connection.sendfile(f, offset + sent, min(slice_size, count - sent))
+            ahead = sent / FILE_RATE_LIMIT - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    
+    def client_ip(self):
+        """
+        The requesting client. Behind a TRUSTED_PROXIES proxy, the last
+        X-Forwarded-For hop that no trusted proxy added; anyone else could
+        send a new X-Forwarded-For with every request.
+        """
+        peer = self.client_address[0]
+        forwarded = self.headers.get('X-Forwarded-For')
+        if not forwarded or not is_trusted_proxy(peer):
+            return peer
+        hops = [hop.strip() for hop in forwarded.split(',') if hop.strip()]
+        # Earlier entries come from the client and can be anything
+        while len(hops) > 1 and is_trusted_proxy(hops[-1]):
+            hops.pop()
+        return hops[-1] if hops else peer
+    
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_request(self, code='-', size='-'):
+        HTTP_REQUESTS.inc(method=self.command, code=int(code) if isinstance(code, int) else code)
+        super().log_request(code, size)
+    
+    def log_message(self, format, *args):
+        print(f"[{self.log_date_time_string()}] {format % args}")
+
+class SingleThreadedServer(HTTPServer):
+    """The original one-request-at-a-time server, kept for debugging."""
+    
+    keep_alive = False
+    draining = False
+    
+    def drain(self, timeout):
+        return True
+
+class ConcurrentServer(ThreadingHTTPServer):
+    """
+    Thread-per-connection server with HTTP/1.1 keep-alive. At most
+    `max_connections` connections are served at once; anything beyond that
+    gets an immediate 503 instead of waiting in the accept backlog.
+    """
+    
+    keep_alive = True
+    daemon_threads = True
+    request_queue_size = 128
+    
+    def __init__(self, server_address, handler_class, max_connections=MAX_CONNECTIONS):
+        super().__init__(server_address, handler_class)
+        self.max_connections = max_connections
+        self.active = 0
+        self.draining = False
+        self.active_lock = threading.Condition()
+    
+    def process_request(self, request, client_address):
+        with self.active_lock:
+            if self.active >= self.max_connections:
+                self._reject(request)
+                return
+            self.active += 1
+        super().process_request(request, client_address)
+    
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.active_lock:
+                self.active -= 1
+                self.active_lock.notify_all()
+    
+    def _reject(self, request):
+        try:
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\n'
+                            b'Content-Length: 0\r\n'
+                            b'Retry-After: 1\r\n'
+                            b'Connection: close\r\n\r\n')
+        except OSError:
+            pass
+        self.shutdown_request(request)
+    
+    def drain(self, timeout):
+        """Wait for open connections to finish their current request."""
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        with self.active_lock:
+            while self.active and time.monotonic() < deadline:
+                self.active_lock.wait(deadline - time.monotonic())
+            return self.active == 0
+
+SERVER_CLASSES = {
+    'threaded': ConcurrentServer,
+    'single': SingleThreadedServer,
+}
+
+def run_server(port=8888, mode=SERVER_MODE):
+    global job_cgroups
+    if mode not in SERVER_CLASSES:
+        raise SystemExit(f"Unknown SERVER_MODE {mode!r}, expected one of {', '.join(SERVER_CLASSES)}")
+    job_cgroups = JobCgroups.setup()
+    info_cache.purge()
+    if ROLE != 'frontend':
+        # Frontends never download, so the storage is the workers' business
+        storage.start()
+    job_manager.recover()
+    job_manager.start()
+    server = SERVER_CLASSES[mode](('0.0.0.0', port), DownloadHandler)
+    
+    def on_sigterm(signum, frame):
+        # shutdown() blocks until serve_forever() returns, so it cannot run
+        # on the main thread that is inside serve_forever()
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, on_sigterm)
+    
+    print(f"""
+╔══════════════════════════════════════════════════════════════╗
+║                  🎬 YT Downloader Pro                        ║
+╠══════════════════════════════════════════════════════════════╣
+║  Server running at: http://localhost:{port}                   ║
+║  Downloads folder:  {DOWNLOAD_DIR}         ║
+║                                                              ║
+║  Press Ctrl+C to stop                                        ║
+╚══════════════════════════════════════════════════════════════╝
+""")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    
+    print(f"Shutting down, draining for up to {DRAIN_TIMEOUT:.0f}s...")
+    server.server_close()
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    server.drain(DRAIN_TIMEOUT)
+    job_manager.drain(max(deadline - time.monotonic(), 0))
+    print("Bye")
 
 if __name__ == '__main__':
     import sys
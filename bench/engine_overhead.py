@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Per-job overhead of the subprocess and embedded download engines.
+
+Downloads URL once per engine, then requests it again N times. yt-dlp finds
+the file already on disk and skips the transfer, so what is left per job is
+start-up, extraction and bookkeeping: the cost the embedded engine avoids.
+
+    python3 bench/engine_overhead.py https://www.youtube.com/watch?v=... -n 10
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DOWNLOAD_DIR', tempfile.mkdtemp(prefix='engine-bench-'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app
+
+
+def bench(engine, url, runs):
+    spec = app.download_spec('audio', 'best')
+    spec['outtmpl'] = os.path.join(app.DOWNLOAD_DIR, engine.name, '%(id)s.%(ext)s')
+    
+    # The first run pays for the actual transfer (and worker start-up)
+    filepath, error = engine.download(url, spec)
+    if error:
+        raise SystemExit(f'{engine.name}: {error}')
+    
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        _, error = engine.download(url, spec)
+        timings.append(time.perf_counter() - started)
+        if error:
+            raise SystemExit(f'{engine.name}: {error}')
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('url')
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    args = parser.parse_args()
+    
+    engines = [app.SubprocessEngine()]
+    embedded = app.make_engine('embedded')
+    if embedded.name == 'embedded':
+        embedded.size = 1
+        engines.append(embedded)
+    
+    print(f"{'engine':<12} {'mean':>8} {'median':>8} {'min':>8} {'max':>8}")
+    for engine in engines:
+        timings = bench(engine, args.url, args.runs)
+        print(f"{engine.name:<12} {statistics.mean(timings):>7.2f}s {statistics.median(timings):>7.2f}s "
+              f"{min(timings):>7.2f}s {max(timings):>7.2f}s")
+
+
+if __name__ == '__main__':
+    main()
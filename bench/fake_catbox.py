@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the catbox.moe upload API.
+
+Accepts the same multipart `fileToUpload` POST (with Content-Length or
+chunked bodies), stores the file and answers with a URL it serves back.
+Point the app at it with CATBOX_URL=http://127.0.0.1:8899/user/api.php.
+
+    python3 bench/fake_catbox.py --port 8899 --bandwidth 5000000 --fail-rate 0.1
+"""
+
+import argparse
+import mmap
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+READ_SIZE = 64 * 1024
+
+
+class FakeCatboxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def do_POST(self):
+        options = self.server.options
+        with tempfile.TemporaryFile(dir=options.dir) as body:
+            for chunk in self.read_body():
+                body.write(chunk)
+                if options.bandwidth:
+                    time.sleep(len(chunk) / options.bandwidth)
+            
+            if options.latency:
+                time.sleep(options.latency)
+            if random.random() < options.fail_rate:
+                self.reply(503, 'Service temporarily unavailable')
+                return
+            
+            name = self.extract_file(body)
+        if name is None:
+            self.reply(400, 'No fileToUpload in request')
+        else:
+            host = self.headers.get('Host', f'127.0.0.1:{self.server.server_port}')
+            self.reply(200, f'http://{host}/{name}')
+    
+    def do_GET(self):
+        path = os.path.join(self.server.options.dir, os.path.basename(self.path))
+        if not os.path.isfile(path):
+            self.reply(404, 'Not found')
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+    
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining:
+            chunk = self.rfile.read(min(READ_SIZE, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+    
+    def extract_file(self, body):
+        """Copy the fileToUpload part of the multipart body to its own file."""
+        boundary = self.headers.get('Content-Type', '').partition('boundary=')[2].strip('"').encode()
+        if not boundary or body.tell() == 0:
+            return None
+        body.flush()
+        with mmap.mmap(body.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            field = data.find(b'name="fileToUpload"')
+            if field < 0:
+                return None
+            start = data.find(b'\r\n\r\n', field) + 4
+            end = data.find(b'\r\n--' + boundary, start)
+            header = data[field:start].decode(errors='replace')
+            ext = os.path.splitext(header.partition('filename="')[2].partition('"')[0])[1]
+            name = uuid.uuid4().hex[:6] + ext
+            with open(os.path.join(self.server.options.dir, name), 'wb') as out:
+                out.write(data[start:end])
+        return name
+    
+    def reply(self, status, text):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        if not self.server.options.quiet:
+            super().log_message(format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8899)
+    parser.add_argument('--dir', default=None, help='where uploads are kept (default: a temp dir)')
+    parser.add_argument('--bandwidth', type=float, default=0, help='bytes/s accepted per upload, 0 = unlimited')
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before answering')
+    parser.add_argument('--fail-rate', type=float, default=0, help='fraction of uploads answered with 503')
+    parser.add_argument('--quiet', action='store_true')
+    options = parser.parse_args()
+    options.dir = options.dir or tempfile.mkdtemp(prefix='fake-catbox-')
+    
+    server = ThreadingHTTPServer(('127.0.0.1', options.port), FakeCatboxHandler)
+    server.daemon_threads = True
+    server.options = options
+    print(f'Fake catbox on http://127.0.0.1:{options.port}/user/api.php, storing in {options.dir}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
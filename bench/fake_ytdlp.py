@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the yt-dlp executable, for benchmarks that must not touch real
+sites. Point the app at it with YT_DLP_PATH=bench/fake_ytdlp.py.
+
+It understands the options the app passes (-o, -f, -x, --print,
+--print-to-file, --progress-template, -J, --flat-playlist,
+--load-info-json, --limit-rate) and behaves like yt-dlp from the outside: it "extracts"
+for a while, writes a .part file at a given speed while printing progress,
+renames it, "merges" when the format asks for two streams and prints the
+final path. Behaviour is tuned with environment variables:
+
+    FAKE_YTDLP_SIZE        bytes per download (default 5 MB)
+    FAKE_YTDLP_SPEED       bytes/s, 0 = as fast as possible (default 10 MB/s)
+    FAKE_YTDLP_EXTRACT     seconds spent extracting (default 0.5)
+    FAKE_YTDLP_MERGE       seconds spent merging video and audio (default 0.2)
+    FAKE_YTDLP_FAIL_RATE   fraction of runs failing with a generic error
+    FAKE_YTDLP_429_RATE    fraction of runs failing with HTTP Error 429
+    FAKE_YTDLP_PLAYLIST    entries in a playlist URL (default 10)
+
+URLs containing "fail" always fail and ones with "list=" are playlists.
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import time
+
+SIZE = int(os.environ.get('FAKE_YTDLP_SIZE', str(5 * 1000 * 1000)))
+SPEED = float(os.environ.get('FAKE_YTDLP_SPEED', str(10 * 1000 * 1000)))
+EXTRACT = float(os.environ.get('FAKE_YTDLP_EXTRACT', '0.5'))
+MERGE = float(os.environ.get('FAKE_YTDLP_MERGE', '0.2'))
+FAIL_RATE = float(os.environ.get('FAKE_YTDLP_FAIL_RATE', '0'))
+THROTTLE_RATE = float(os.environ.get('FAKE_YTDLP_429_RATE', '0'))
+PLAYLIST = int(os.environ.get('FAKE_YTDLP_PLAYLIST', '10'))
+
+CHUNK = 64 * 1024
+# MP4 signature first so content sniffing sees a video, then filler
+BLOCK = b'\0\0\0\x20ftypisom' + os.urandom(CHUNK - 12)
+
+
+# Options the app may pass that take a value we have no use for
+IGNORED_WITH_VALUE = {'--audio-quality', '-N', '--concurrent-fragments',
+                      '--ffmpeg-location', '--cookies', '-P', '--paths', '--downloader'}
+
+
+def parse_args(args):
+    options = {'output': '%(title)s.%(ext)s', 'format': None, 'audio': None, 'merge': 'mp4',
+               'print': [], 'print_to_file': [], 'templates': {}, 'json': False,
+               'flat': False, 'info_json': None, 'rate': None, 'url': None}
+    args = iter(args)
+    for arg in args:
+        if arg == '-o':
+            options['output'] = next(args)
+        elif arg == '-f':
+            options['format'] = next(args)
+        elif arg == '--audio-format':
+            options['audio'] = next(args)
+        elif arg == '--merge-output-format':
+            options['merge'] = next(args)
+        elif arg == '--print':
+            options['print'].append(next(args))
+        elif arg == '--print-to-file':
+            options['print_to_file'].append((next(args), next(args)))
+        elif arg == '--progress-template':
+            kind, _, template = next(args).partition(':')
+            options['templates'][kind] = template
+        elif arg == '--load-info-json':
+            options['info_json'] = next(args)
+        elif arg in ('-r', '--limit-rate'):
+            options['rate'] = parse_rate(next(args))
+        elif arg in ('-J', '--dump-single-json'):
+            options['json'] = True
+        elif arg == '--flat-playlist':
+            options['flat'] = True
+        elif arg in IGNORED_WITH_VALUE:
+            next(args)
+        elif not arg.startswith('-'):
+            options['url'] = arg
+    return options
+
+
+def parse_rate(value):
+    """yt-dlp's RATE syntax: bytes per second, optionally with a K, M or G suffix."""
+    match = re.fullmatch(r'([\d.]+)([kmg]?)i?b?', value.lower())
+    return float(match.group(1)) * 1024 ** ' kmg'.index(match.group(2) or ' ')
+
+
+def video_id(url):
+    match = re.search(r'(?:v=|youtu\.be/|shorts/)([\w-]{11})', url)
+    return match.group(1) if match else hashlib.sha1(url.encode()).hexdigest()[:11]
+
+
+def make_info(url):
+    vid = video_id(url)
+    return {
+        'id': vid,
+        'title': f'Video {vid}',
+        'webpage_url': url,
+        'extractor': 'youtube',
+        'extractor_key': 'Youtube',
+        'uploader': 'Benchmark',
+        'duration': 300,
+        'ext': 'mp4',
+        'formats': [
+            {'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'filesize': SIZE // 5},
+            {'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'mp4a.40.2', 'height': 360,
+             'filesize': SIZE // 2},
+            {'format_id': '136', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'none', 'height': 720,
+             'filesize': SIZE * 4 // 5},
+            {'format_id': '137', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'none', 'height': 1080,
+             'filesize': SIZE * 8 // 5},
+        ],
+    }
+
+
+def render(template, fields):
+    def field(match):
+        if match.group() == '%%':
+            return '%'
+        value = str(fields.get(match.group(1), 'NA'))
+        return value[:int(match.group(2))] if match.group(2) else value
+    return re.sub(r'%%|%\(([\w.]+)\)(?:\.(\d+))?s', field, template)
+
+
+def fail(message):
+    print(f'ERROR: {message}', file=sys.stderr)
+    sys.exit(1)
+
+
+def progress_line(options, downloaded, elapsed):
+    speed = downloaded / elapsed if elapsed else None
+    eta = (SIZE - downloaded) / speed if speed else None
+    template = options['templates'].get('download')
+    if template:
+        return render(template, {
+            'progress.downloaded_bytes': downloaded,
+            'progress.total_bytes': SIZE,
+            'progress.total_bytes_estimate': SIZE,
+            'progress.speed': speed if speed is not None else 'NA',
+            'progress.eta': int(eta) if eta is not None else 'NA',
+        })
+    return f'[download] {downloaded * 100 / SIZE:5.1f}% of {SIZE / 1024 ** 2:.2f}MiB'
+
+
+def download(options, info, out):
+    """Write SIZE bytes to `out` at SPEED or --limit-rate, reporting progress on stderr like yt-dlp."""
+    speed = min(SPEED or float('inf'), options['rate'] or float('inf'))
+    speed = 0 if speed == float('inf') else speed
+    started = time.monotonic()
+    written = 0
+    last_report = 0
+    while written < SIZE:
+        chunk = BLOCK[:min(CHUNK, SIZE - written)]
+        out.write(chunk)
+        written += len(chunk)
+        if speed:
+            ahead = written / speed - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+        now = time.monotonic()
+        if now - last_report >= 0.1 or written == SIZE:
+            last_report = now
+            print(progress_line(options, written, now - started), file=sys.stderr, flush=True)
+    out.flush()
+
+
+def main():
+    options = parse_args(sys.argv[1:])
+    if options['info_json']:
+        with open(options['info_json']) as f:
+            info = json.load(f)
+        url = info.get('webpage_url', '')
+    else:
+        url = options['url'] or fail('You must provide at least one URL.')
+        time.sleep(EXTRACT)
+        info = make_info(url)
+
+    if 'fail' in url or random.random() < FAIL_RATE:
+        fail(f'[youtube] {info["id"]}: Video unavailable')
+    if random.random() < THROTTLE_RATE:
+        fail(f'[youtube] {info["id"]}: Unable to download webpage: HTTP Error 429: Too Many Requests')
+
+    if options['json']:
+        if 'list=' in url and options['flat']:
+            info = {'_type': 'playlist', 'id': 'PLbench', 'title': 'Benchmark playlist', 'entries': [
+                {'_type': 'url', 'ie_key': 'Youtube', 'url': f'https://www.youtube.com/watch?v=bench{i:06d}'}
+                for i in range(PLAYLIST)]}
+        print(json.dumps(info))
+        return
+
+    merged = bool(options['format'] and '+' in options['format'])
+    # A bare format ID, as for a stream fetched on its own, keeps that format's extension
+    chosen = next((f for f in info.get('formats') or [] if f['format_id'] == options['format']), None)
+    ext = options['audio'] or (options['merge'] if merged else chosen['ext'] if chosen else 'mp4')
+    fields = dict(info, ext=ext, format_id=chosen['format_id'] if chosen else options['format'] or '18')
+    for template, path in options['print_to_file']:
+        with open(path, 'a') as f:
+            f.write(render(template.partition(':')[2], fields) + '\n')
+
+    if options['output'] == '-':
+        download(options, info, sys.stdout.buffer)
+        return
+
+    filepath = render(options['output'], fields)
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    with open(filepath + '.part', 'wb') as out:
+        download(options, info, out)
+    os.replace(filepath + '.part', filepath)
+
+    if merged or options['audio']:
+        template = options['templates'].get('postprocess')
+        if template:
+            print(render(template, {'progress.status': 'started',
+                                    'progress.postprocessor': 'ExtractAudio' if options['audio'] else 'Merger'}),
+                  file=sys.stderr, flush=True)
+        time.sleep(MERGE)
+
+    for template in options['print']:
+        print(render(template.partition(':')[2], dict(fields, filepath=os.path.abspath(filepath))), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Load generator for the app's HTTP API.
+
+Runs N requests from C concurrent clients against one endpoint and reports
+latency percentiles, throughput and the server's peak memory and open file
+descriptors (with --pid, or --spawn, on Linux). For /download and /batch
+the latency runs from the POST until the job or batch has finished.
+
+With --spawn it starts the app itself on a free port, wired to
+bench/fake_ytdlp.py and bench/fake_catbox.py, so runs are offline and
+repeatable; FAKE_YTDLP_* and app settings can be given with --env.
+
+    python3 bench/loadgen.py --spawn -c 16 -n 200 --unique 50
+    python3 bench/loadgen.py --spawn --env DOWNLOAD_WORKERS=8 --env FAKE_YTDLP_SPEED=0 -c 32 -n 500
+    python3 bench/loadgen.py --base http://127.0.0.1:8888 --pid $(pgrep -f app.py) --endpoint info
+"""
+
+import argparse
+import http.client
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode, urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = ('download', 'info', 'stream', 'files', 'batch', 'health')
+
+
+class Client:
+    """One keep-alive connection, reopened after errors."""
+
+    def __init__(self, base, timeout):
+        self.base = urlparse(base)
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        """Return `(status, body bytes)`; raises on connection errors."""
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.base.hostname, self.base.port, timeout=self.timeout)
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        try:
+            self.conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except Exception:
+            self.conn.close()
+            self.conn = None
+            raise
+        if response.will_close:
+            self.conn.close()
+            self.conn = None
+        return response.status, data
+
+    def get_json(self, path):
+        status, data = self.request('GET', path)
+        return status, json.loads(data) if data else None
+
+    def wait(self, path, finished, deadline):
+        """Poll a job or batch until `finished(payload)`; returns the payload."""
+        while time.monotonic() < deadline:
+            status, payload = self.get_json(path)
+            if status != 200 or finished(payload):
+                return payload
+            time.sleep(0.05)
+        raise TimeoutError(path)
+
+
+def video_url(i, options):
+    # The fake yt-dlp takes any 11-character id
+    return f'https://www.youtube.com/watch?v=bench{i % options.unique:06d}'
+
+
+def run_one(client, i, options):
+    """One unit of work; returns `(ok, bytes received)`."""
+    url = video_url(i, options)
+    deadline = time.monotonic() + options.timeout
+    if options.endpoint == 'health':
+        status, data = client.request('GET', '/health')
+        return status == 200, len(data)
+    if options.endpoint == 'info':
+        status, data = client.request('GET', '/info?' + urlencode({'url': url}))
+        return status == 200, len(data)
+    if options.endpoint == 'stream':
+        status, data = client.request('GET', '/stream?' + urlencode({'url': url, 'quality': options.quality}))
+        return status == 200, len(data)
+    if options.endpoint == 'batch':
+        status, data = client.request('POST', '/batch', {
+            'urls': [video_url(i * options.batch_size + k, options) for k in range(options.batch_size)],
+            'format': options.format, 'quality': options.quality, 'shareLink': options.share})
+        if status != 202:
+            return False, len(data)
+        batch = client.wait(json.loads(data)['statusUrl'], lambda b: b['done'], deadline)
+        return not batch['counts'].get('failed'), 0
+
+    status, data = client.request('POST', '/download', {
+        'url': url, 'format': options.format, 'quality': options.quality,
+        'shareLink': options.share, 'pipeline': options.pipeline})
+    if status != 202:
+        return False, len(data)
+    job = client.wait(json.loads(data)['statusUrl'], lambda j: j['status'] in ('done', 'failed'), deadline)
+    ok = job['status'] == 'done' and job['result']['success']
+    if options.endpoint == 'files' and ok:
+        status, body = client.request('GET', job['result']['fileUrl'])
+        return status == 200, len(body)
+    return ok, 0
+
+
+def process_tree(pid):
+    """`pid` and all of its descendants, from /proc."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name is in parentheses and may contain spaces
+                ppid = int(f.read().rpartition(')')[2].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, todo = [], [pid]
+    while todo:
+        current = todo.pop()
+        tree.append(current)
+        todo.extend(children.get(current, []))
+    return tree
+
+
+def sample_process(pid):
+    """`(server RSS, server FDs, RSS of server plus children, process count)`."""
+    def rss(p):
+        with open(f'/proc/{p}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    server_rss = rss(pid)
+    fds = len(os.listdir(f'/proc/{pid}/fd'))
+    tree = process_tree(pid)
+    total = 0
+    for p in tree:
+        try:
+            total += rss(p)
+        except OSError:
+            pass
+    return server_rss, fds, total, len(tree)
+
+
+class Sampler(threading.Thread):
+    """Polls the server's memory and descriptors and keeps the peaks."""
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.peak = {'rss': 0, 'fds': 0, 'treeRss': 0, 'processes': 0}
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                values = sample_process(self.pid)
+            except OSError:
+                return
+            for name, value in zip(('rss', 'fds', 'treeRss', 'processes'), values):
+                self.peak[name] = max(self.peak[name], value)
+            self.stopped.wait(self.interval)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(port, proc, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f'{proc.args[1]} exited with {proc.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit(f'Nothing listening on port {port}')
+
+
+def spawn(options):
+    """Start fake catbox and the app on free ports; returns `(base URL, processes)`."""
+    workdir = tempfile.mkdtemp(prefix='loadgen-')
+    catbox_port, app_port = free_port(), free_port()
+    os.makedirs(os.path.join(workdir, 'uploads'))
+    catbox = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fake_catbox.py'),
+                               '--port', str(catbox_port), '--dir', os.path.join(workdir, 'uploads'),
+                               '--quiet'])
+    env = dict(os.environ,
+               DOWNLOAD_DIR=os.path.join(workdir, 'downloads'),
+               YT_DLP_PATH=os.path.join(BENCH_DIR, 'fake_ytdlp.py'),
+               CATBOX_URL=f'http://127.0.0.1:{catbox_port}/user/api.php',
+               # fake_catbox.py reads chunked bodies, so --pipeline can stream
+               CATBOX_STREAMING='1')
+    env.update(item.split('=', 1) for item in options.env)
+    log = open(os.path.join(workdir, 'app.log'), 'w')
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, '..', 'app.py'), str(app_port)],
+                              env=env, stdout=log, stderr=subprocess.STDOUT)
+    wait_for(catbox_port, catbox)
+    wait_for(app_port, server)
+    print(f'Spawned app (pid {server.pid}) in {workdir}', file=sys.stderr)
+    return f'http://127.0.0.1:{app_port}', [server, catbox]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--base', default='http://127.0.0.1:8888', help='app URL (ignored with --spawn)')
+    parser.add_argument('--spawn', action='store_true', help='start the app and fake services for the run')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='environment for the spawned app, e.g. DOWNLOAD_WORKERS=8')
+    parser.add_argument('--pid', type=int, help='server process to sample RSS and FDs from')
+    parser.add_argument('--endpoint', choices=ENDPOINTS, default='download')
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('-n', '--requests', type=int, default=100)
+    parser.add_argument('--unique', type=int, default=1000000,
+                        help='distinct videos to cycle through; fewer means more cache hits')
+    parser.add_argument('--format', default='video')
+    parser.add_argument('--quality', default='720')
+    parser.add_argument('--share', action='store_true', help='ask for share links (uploads to fake catbox)')
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=600, help='seconds allowed per request')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    options = parser.parse_args()
+
+    # Make `timeout` and Ctrl-C alike take down the spawned processes too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    processes = []
+    if options.spawn:
+        options.base, processes = spawn(options)
+        options.pid = processes[0].pid
+    sampler = Sampler(options.pid) if options.pid else None
+    if sampler:
+        sampler.start()
+
+    latencies, failures, received = [], [], [0]
+    lock = threading.Lock()
+    counter = iter(range(options.requests))
+
+    def worker():
+        client = Client(options.base, options.timeout)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            started = time.monotonic()
+            try:
+                ok, size = run_one(client, i, options)
+                error = None if ok else 'failed'
+            except Exception as e:
+                ok, size, error = False, 0, f'{type(e).__name__}: {e}'
+            elapsed = time.monotonic() - started
+            with lock:
+                received[0] += size
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    failures.append(error)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker) for _ in range(options.concurrency)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        wall = time.monotonic() - started
+        if sampler:
+            sampler.stopped.set()
+        for proc in processes:
+            proc.terminate()
+            proc.wait()
+
+    report = {
+        'endpoint': options.endpoint,
+        'concurrency': options.concurrency,
+        'requests': options.requests,
+        'ok': len(latencies),
+        'failed': len(failures),
+        'seconds': round(wall, 3),
+        'throughput': round(len(latencies) / wall, 2) if wall else None,
+        'receivedBytes': received[0],
+    }
+    if latencies:
+        report['latency'] = {
+            'mean': round(statistics.mean(latencies), 4),
+            'p50': round(percentile(latencies, 0.50), 4),
+            'p95': round(percentile(latencies, 0.95), 4),
+            'p99': round(percentile(latencies, 0.99), 4),
+            'max': round(max(latencies), 4),
+        }
+    if sampler:
+        report['peak'] = sampler.peak
+    if failures:
+        report['errors'] = sorted(set(failures))[:10]
+
+    if options.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['endpoint']}: {report['ok']}/{report['requests']} ok in {report['seconds']}s "
+          f"at concurrency {report['concurrency']} ({report['throughput']} req/s)")
+    if latencies:
+        print('latency  ' + '  '.join(f'{k} {v * 1000:.0f}ms' for k, v in report['latency'].items()))
+    if received[0]:
+        print(f'received {received[0] / 1024 ** 2:.1f} MiB')
+    if sampler:
+        peak = report['peak']
+        print(f"peak     server RSS {peak['rss'] / 1024 ** 2:.1f} MiB, {peak['fds']} fds; "
+              f"with children {peak['treeRss'] / 1024 ** 2:.1f} MiB in {peak['processes']} processes")
+    for error in report.get('errors', []):
+        print(f'error    {error}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+import contextlib
+import http.client
+import io
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+import zipfile
+
+# app.py creates its cache and job database under DOWNLOAD_DIR on import
+os.environ.setdefault('DOWNLOAD_DIR', tempfile.mkdtemp())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+def test_video_key_spellings():
+    for url in ('https://www.youtube.com/watch?v=dQw4w9WgXcQ&si=abc',
+                'https://youtube.com/watch?feature=share&v=dQw4w9WgXcQ',
+                'https://m.youtube.com/shorts/dQw4w9WgXcQ',
+                'https://youtu.be/dQw4w9WgXcQ?si=abc'):
+        assert app.video_key(url) == 'youtube:dQw4w9WgXcQ'
+    assert app.video_key('https://player.vimeo.com/video/123') == 'vimeo:123'
+
+
+def test_video_key_needs_the_site_host():
+    for url in ('https://evil.example/youtube.com/watch?v=dQw4w9WgXcQ',
+                'https://evil.example/?next=https://youtu.be/dQw4w9WgXcQ',
+                'https://notyoutube.com/watch?v=dQw4w9WgXcQ'):
+        assert app.video_key(url).startswith('url:')
+        assert app.site_of(url) != 'youtube'
+
+
+def test_failed_probes_are_remembered(monkeypatch, tmp_path):
+    calls = []
+
+    class Engine:
+        def extract_info(self, url):
+            calls.append(url)
+            return None, 'ERROR: Unsupported URL'
+
+    monkeypatch.setattr(app, 'download_engine', Engine())
+    cache = app.InfoCache(str(tmp_path), error_ttl=60)
+    for _ in range(3):
+        try:
+            cache.get('https://example.com/watch/1')
+        except RuntimeError as e:
+            assert 'Unsupported URL' in str(e)
+        else:
+            raise AssertionError('probe should have failed')
+    assert len(calls) == 1
+
+
+def forwarded_client(peer, forwarded):
+    handler = app.DownloadHandler.__new__(app.DownloadHandler)
+    handler.client_address = (peer, 40000)
+    handler.headers = {'X-Forwarded-For': forwarded}
+    return handler.client_ip()
+
+
+def test_forwarded_for_needs_a_trusted_proxy(monkeypatch):
+    monkeypatch.setattr(app, 'trusted_proxies', [])
+    assert forwarded_client('203.0.113.7', '198.51.100.1') == '203.0.113.7'
+    monkeypatch.setattr(app, 'trusted_proxies', app.parse_trusted_proxies('10.0.0.0/8'))
+    assert forwarded_client('203.0.113.7', '198.51.100.1') == '203.0.113.7'
+    assert forwarded_client('10.0.0.2', 'spoofed, 198.51.100.1') == '198.51.100.1'
+    assert forwarded_client('10.0.0.2', 'spoofed, 198.51.100.1, 10.0.0.3') == '198.51.100.1'
+
+
+def test_quality_must_be_ascii_digits():
+    assert app.check_options('video', '720') is None
+    assert app.check_options('video', 'best') is None
+    for quality in ('²', '7²0', '٧٢٠', '', '12345', '720\n'):
+        assert app.check_options('video', quality) is not None
+
+
+
+@contextlib.contextmanager
+def running_server():
+    server = app.ConcurrentServer(('127.0.0.1', 0), app.DownloadHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield server.server_address
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_bad_content_length_is_rejected():
+    with running_server() as address:
+        for length in ('²', '-1', '1e3'):
+            with socket.create_connection(address, timeout=5) as conn:
+                conn.sendall(b'POST /download HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: ' + length.encode('latin-1') + b'\r\n\r\n{}')
+                assert conn.recv(1024).startswith(b'HTTP/1.1 400 ')
+
+
+def test_post_routes_ignore_the_query_string():
+    with running_server() as address:
+        conn = http.client.HTTPConnection(*address, timeout=5)
+        conn.request('POST', '/download?x=1', body='{"url": "ftp://example.com/a"}',
+                     headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        assert response.status == 400
+        assert b'http and https' in response.read()
+        conn.close()
+
+
+def test_cancel_detaches_until_the_last_requester(tmp_path):
+    manager = app.JobManager(journal=app.JobJournal(str(tmp_path / 'jobs.db')))
+    url = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+    job, _ = manager.submit(url, 'video', '720', False, client='alice')
+    assert manager.submit(url, 'video', '720', False, client='bob') == (job, True)
+
+    assert manager.cancel(job.id) == (job, 200, True)
+    assert job.status == 'queued' and not job.processes.cancelled
+    assert manager.download_queue.qsize() == 1
+
+    assert manager.cancel(job.id) == (job, 200, False)
+    assert job.status == 'failed' and job.result['cancelled']
+    assert manager.download_queue.qsize() == 0
+
+
+def test_shared_cancel_detaches_until_the_last_requester(tmp_path):
+    manager = app.SharedJobManager(journal=app.JobJournal(str(tmp_path / 'jobs.db')))
+    url = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+    job, _ = manager.submit(url, 'video', '720', False, client='alice')
+    assert manager.submit(url, 'video', '720', False, client='bob')[1]
+
+    job, status, detached = manager.cancel(job.id)
+    assert (status, detached, job.status) == (200, True, 'queued')
+    job, status, detached = manager.cancel(job.id)
+    assert (status, detached, job.status) == (200, False, 'failed')
+
+
+def test_download_worker_survives_a_failing_job(monkeypatch):
+    def broken_priority(info, format_type, quality):
+        raise ValueError('bad quality')
+
+    monkeypatch.setattr(app, 'probe', lambda url: ({'duration': 60, 'formats': []}, None))
+    monkeypatch.setattr(app, 'job_priority', broken_priority)
+    manager = app.JobManager(download_workers=1, upload_workers=0)
+    job, _ = manager.submit('https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'video', '720', False)
+    manager.start()
+    try:
+        deadline = time.monotonic() + 10
+        while not job.finished and time.monotonic() < deadline:
+            job.wait(job.version, 1)
+        assert job.status == 'failed' and 'bad quality' in job.result['error']
+        assert manager.download_queue.stats()['running'] == {'interactive': 0, 'bulk': 0}
+        assert manager.threads[0].is_alive()
+    finally:
+        manager.drain(1)
+
+
+def test_bandwidth_grants_never_exceed_the_budget():
+    budget = app.BandwidthBudget(total=1000, bulk_share=0.5, bulk_slots=2, slots=4)
+    held = [('bulk', budget.acquire('bulk'))]
+    held += [('interactive', budget.acquire('interactive')) for _ in range(3)]
+    assert held[0][1] == 250
+    assert sum(rate for _, rate in held) <= 1000 + 1e-6
+    assert all(rate > 0 for _, rate in held)
+
+    # Interactive downloads started one after another do not add up past the budget
+    budget.release(*held.pop(1))
+    held.append(('interactive', budget.acquire('interactive')))
+    assert sum(rate for _, rate in held) <= 1000 + 1e-6
+    # The other bulk slot still gets its slice
+    budget.release(*held.pop(1))
+    held.append(('bulk', budget.acquire('bulk')))
+    assert held[-1][1] == 250
+    assert sum(rate for _, rate in held) <= 1000 + 1e-6
+
+
+class FakeJobManager:
+    """Stands in for job_manager: jobs finish when the test says so."""
+
+    def __init__(self):
+        self.jobs = {}
+
+    def submit(self, url, format_type, quality, share_link, on_finish=None, client=None, priority=None):
+        job = types.SimpleNamespace(id=url, status='queued', result=None)
+        self.jobs[url] = (job, on_finish)
+        return job, False
+
+    def finish(self, url, **result):
+        job, on_finish = self.jobs[url]
+        job.result = result
+        job.status = 'done' if result['success'] else 'failed'
+        on_finish(job)
+
+
+def test_batch_zip_streams_entries_as_jobs_finish(monkeypatch, tmp_path):
+    manager = FakeJobManager()
+    monkeypatch.setattr(app, 'job_manager', manager)
+    first, second = tmp_path / 'a.mp4', tmp_path / 'b.mp4'
+    first.write_bytes(b'first' * 1000)
+    second.write_bytes(b'second' * 1000)
+    batch = app.submit_batch(['https://a.example/1', 'https://a.example/2', 'https://a.example/3'],
+                             'video', '720', False, concurrency=3)
+    manager.finish('https://a.example/1', success=True, filepath=str(first), filename='clip.mp4')
+
+    with running_server() as address:
+        conn = http.client.HTTPConnection(*address, timeout=5)
+        conn.request('GET', f'/batches/{batch.id}/zip')
+        response = conn.getresponse()
+        assert response.status == 200
+        # The finished item goes out while the others are still running
+        body = b''
+        while first.read_bytes() not in body:
+            body += response.read1(65536)
+        assert body.startswith(b'PK\x03\x04')
+
+        manager.finish('https://a.example/2', success=True, filepath=str(second), filename='clip.mp4')
+        manager.finish('https://a.example/3', success=False, error='Video unavailable')
+        body += response.read()
+        conn.close()
+
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ['clip.mp4', 'clip (2).mp4', 'errors.txt']
+        assert archive.read('clip.mp4') == first.read_bytes()
+        assert archive.read('clip (2).mp4') == second.read_bytes()
+        assert archive.read('errors.txt') == b'https://a.example/3: Video unavailable\n'
+
+
+def test_parse_range():
+    assert app.parse_range('bytes=0-99', 1000) == (0, 99)
+    assert app.parse_range('bytes=900-', 1000) == (900, 999)
+    assert app.parse_range('bytes=900-5000', 1000) == (900, 999)
+    assert app.parse_range('bytes=-100', 1000) == (900, 999)
+    assert app.parse_range('bytes=-5000', 1000) == (0, 999)
+    assert app.parse_range('bytes=10-20, 30-40', 1000) == (10, 20)
+    for header in ('bytes=1000-', 'bytes=5-1', 'bytes=-0', 'bytes=-', 'items=0-1', 'bytes=a-b'):
+        assert app.parse_range(header, 1000) is None
+
+
+def get_file(address, fid, **headers):
+    conn = http.client.HTTPConnection(*address, timeout=5)
+    conn.request('GET', f'/files/{fid}', headers={k.replace('_', '-'): v for k, v in headers.items()})
+    response = conn.getresponse()
+    result = response.status, dict(response.getheaders()), response.read()
+    conn.close()
+    return result
+
+
+def test_files_honour_validators_and_if_range(tmp_path):
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(bytes(range(256)) * 4)
+    key = ('test:files', 'video', '720')
+    app.download_cache.store(key, str(path), title='Clip')
+    fid = app.file_id(key)
+
+    with running_server() as address:
+        status, headers, body = get_file(address, fid)
+        assert (status, body) == (200, path.read_bytes())
+        etag, modified = headers['ETag'], headers['Last-Modified']
+
+        assert get_file(address, fid, If_None_Match=etag)[0] == 304
+        assert get_file(address, fid, If_None_Match=f'"other", {etag}')[0] == 304
+        assert get_file(address, fid, If_Modified_Since=modified)[0] == 304
+        # If-None-Match wins over If-Modified-Since
+        assert get_file(address, fid, If_None_Match='"other"', If_Modified_Since=modified)[0] == 200
+
+        status, headers, body = get_file(address, fid, Range='bytes=2-5')
+        assert (status, body, headers['Content-Range']) == (206, bytes([2, 3, 4, 5]), 'bytes 2-5/1024')
+        assert get_file(address, fid, Range='bytes=2-5', If_Range=etag)[0] == 206
+        assert get_file(address, fid, Range='bytes=2-5', If_Range=modified)[0] == 206
+        # A stale If-Range gets the whole file instead of a piece of the new one
+        status, _, body = get_file(address, fid, Range='bytes=2-5', If_Range='"stale"')
+        assert (status, len(body)) == (200, 1024)
+        status, _, body = get_file(address, fid, Range='bytes=2-5', If_Range='Thu, 01 Jan 1970 00:00:00 GMT')
+        assert (status, len(body)) == (200, 1024)
+
+        status, headers, _ = get_file(address, fid, Range='bytes=5000-')
+        assert (status, headers['Content-Range']) == (416, 'bytes */1024')
+
+
+def filled_storage(tmp_path, files, budget=1000):
+    """A StorageManager over a cache of `files` 100-byte files, oldest use first."""
+    cache = app.DownloadCache(str(tmp_path / 'cache.db'))
+    for n in range(files):
+        path = tmp_path / f'{n}.mp4'
+        path.write_bytes(b'x' * 100)
+        cache.store((f'test:{n}', 'video', '720'), str(path))
+        time.sleep(0.001)
+    return app.StorageManager(cache, str(tmp_path), budget=budget, high=0.9, low=0.5, min_free=0)
+
+
+def test_janitor_evicts_from_high_to_low_watermark(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'EVICT_BATCH', 1)
+    storage = filled_storage(tmp_path, 9)
+    storage.collect()
+    assert storage.evicted == 0
+
+    storage.cache.find_file(app.file_id(('test:0', 'video', '720')))
+    (tmp_path / '9.mp4').write_bytes(b'x' * 100)
+    storage.cache.store(('test:9', 'video', '720'), str(tmp_path / '9.mp4'))
+    storage.collect()
+    assert storage.stats()['usedBytes'] == 500
+    # Least recently used go first; the one just looked up stays
+    assert sorted(p.name for p in tmp_path.glob('*.mp4')) == ['0.mp4', '6.mp4', '7.mp4', '8.mp4', '9.mp4']
+
+
+def test_admission_waits_for_room_or_gives_up(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'ADMISSION_WAIT', 0.2)
+    storage = filled_storage(tmp_path, 8)
+    reservation, error = storage.admit(50)
+    assert (reservation, error) == (50, None)
+    storage.release(reservation)
+    assert 'too large' in storage.admit(950)[1]
+
+    # No janitor to make room: the download is turned away after ADMISSION_WAIT
+    assert storage.admit(200) == (0, 'Not enough storage space, try again later')
+    assert storage.stats()['reservedBytes'] == 0
+
+    # With one, the waiting download gets in once old files are evicted
+    monkeypatch.setattr(app, 'ADMISSION_WAIT', 10)
+    storage.start()
+    assert storage.admit(200) == (200, None)
+    assert storage.stats()['usedBytes'] <= 500
+
+
+def queued_job(client, n, site='example', priority='interactive'):
+    return types.SimpleNamespace(key=('test:sched', client, str(n)), client=client, site=site,
+                                 priority=priority, slot=False, cached=False, name=f'{client}{n}')
+
+
+def test_scheduler_takes_clients_in_turn():
+    scheduler = app.DownloadScheduler(default_limit=100, limits={})
+    scheduler.sites['example'] = app.SiteLimiter(100, rate=0)
+    for n in range(1, 5):
+        scheduler.put(queued_job('alice', n))
+    for n in range(1, 3):
+        scheduler.put(queued_job('bob', n))
+    order = [scheduler.get(0).name for _ in range(6)]
+    # Bob's jobs do not wait behind all of Alice's
+    assert order == ['alice1', 'bob1', 'alice2', 'bob2', 'alice3', 'alice4']
+    assert scheduler.qsize() == 0
+
+
+def test_site_limits_halve_when_throttled_and_recover(monkeypatch):
+    monkeypatch.setattr(app, 'THROTTLE_PAUSE', 30)
+    scheduler = app.DownloadScheduler(default_limit=8, limits={})
+    limiter = scheduler.sites['example'] = app.SiteLimiter(8, rate=60, burst=100)
+    for n in range(2):
+        scheduler.put(queued_job('alice', n))
+    first, second = scheduler.get(0), scheduler.get(0)
+
+    scheduler.done(first, {'success': False, 'error': 'ERROR: HTTP Error 429: Too Many Requests'})
+    assert (limiter.concurrency, limiter.rate) == (4, 0.5)
+    # The site gets a break before anything else starts there
+    scheduler.put(queued_job('alice', 2))
+    assert limiter.ready_in(time.monotonic()) > 25
+    try:
+        scheduler.get(0)
+    except app.queue.Empty:
+        pass
+    else:
+        raise AssertionError('a throttled site should pause')
+
+    scheduler.done(second, {'success': True})
+    assert 4 < limiter.concurrency < 5 and limiter.rate == 0.6
+    for _ in range(100):
+        limiter.release(False)
+    assert (limiter.concurrency, limiter.rate) == (8, 1)
+
+
+def test_recover_requeues_resumes_uploads_and_gives_up_on_crash_loops(monkeypatch, tmp_path):
+    journal = app.JobJournal(str(tmp_path / 'jobs.db'))
+    before = app.JobManager(journal=journal)
+    downloaded = tmp_path / 'clip.mp4'
+    downloaded.write_bytes(b'clip')
+
+    def journalled(video_id, status, **fields):
+        job, _ = before.submit(f'https://www.youtube.com/watch?v={video_id}', 'video', '720', True)
+        job.status = status
+        for name, value in fields.items():
+            setattr(job, name, value)
+        journal.save(job)
+        return job
+
+    queued = journalled('aaaaaaaaaa1', 'queued')
+    running = journalled('aaaaaaaaaa2', 'downloading')
+    uploading = journalled('aaaaaaaaaa3', 'uploading', filepath=str(downloaded),
+                           result={'success': True, 'filename': 'clip.mp4', 'filepath': str(downloaded)})
+    lost_file = journalled('aaaaaaaaaa4', 'uploading', filepath=str(tmp_path / 'gone.mp4'),
+                           result={'success': True, 'filename': 'gone.mp4'})
+    crashing = journalled('aaaaaaaaaa5', 'downloading', restarts=app.JOB_MAX_RESTARTS)
+    finished = journalled('aaaaaaaaaa6', 'done', result={'success': True, 'filename': 'done.mp4'})
+
+    monkeypatch.setattr(app, 'share_file', lambda *args, **kwargs: 'https://share.example/clip')
+    manager = app.JobManager(download_workers=0, upload_workers=1, journal=journal)
+    manager.recover()
+
+    assert manager.download_queue.qsize() == 3
+    for job_id in (queued.id, running.id, lost_file.id):
+        assert manager.get(job_id).status == 'queued'
+    assert manager.get(running.id).restarts == 1
+    assert manager.get(queued.id).restarts == 0
+    assert manager.get(finished.id).status == 'done'
+    gave_up = manager.get(crashing.id)
+    assert gave_up.status == 'failed' and 'Gave up' in gave_up.result['error']
+    assert journal.get(crashing.id)['status'] == 'failed'
+
+    # The downloaded file is uploaded without downloading it again
+    resumed = manager.get(uploading.id)
+    manager.start()
+    try:
+        deadline = time.monotonic() + 10
+        while not resumed.finished and time.monotonic() < deadline:
+            resumed.wait(resumed.version, 1)
+        assert resumed.status == 'done'
+        assert resumed.result['shareUrl'] == 'https://share.example/clip'
+    finally:
+        manager.drain(1)
+
+
+def test_hosts_resolving_to_private_addresses_are_refused(monkeypatch):
+    answers = {'intranet.example.com': ['10.1.2.3'], 'metadata.example.com': ['93.184.216.34', '169.254.169.254'],
+               'mapped.example.com': ['::ffff:127.0.0.1'], 'public.example.com': ['93.184.216.34', '2606:2800::1']}
+
+    def getaddrinfo(host, port, proto=0):
+        if host not in answers:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return [(socket.AF_INET, socket.SOCK_STREAM, proto, '', (address, 0)) for address in answers[host]]
+
+    monkeypatch.setattr(app.socket, 'getaddrinfo', getaddrinfo)
+    monkeypatch.setattr(app, 'extractor_table', None)
+    for host in ('intranet.example.com', 'metadata.example.com', 'mapped.example.com'):
+        assert app.check_url(f'https://{host}/video') == 'URL points to a private network'
+    assert app.check_url('https://public.example.com/video') is None
+    assert app.check_url('https://unresolved.example.com/video') is None
+    assert app.check_url('http://127.0.0.1/video') == 'URL points to a private network'
+
+
+def test_job_processes_are_limited_before_they_run(monkeypatch, tmp_path):
+    cgroup = tmp_path / 'job-test'
+    cgroup.mkdir()
+    monkeypatch.setattr(app, 'job_cgroups', types.SimpleNamespace(
+        create=lambda name: str(cgroup), remove=lambda path: 0, kill=lambda path: None))
+    processes = app.JobProcesses()
+    returncode, stdout, _ = processes.run(
+        ['sh', '-c', 'echo $$; cat /proc/self/limits; cut -d " " -f 19 /proc/self/stat'], 10)
+    assert returncode == 0
+    pid, *limits, nice = stdout.splitlines()
+    # The command itself joined the job's cgroup, not a wrapper around it
+    assert (cgroup / 'cgroup.procs').read_text().strip() == pid
+    names = {app.resource.RLIMIT_DATA: 'Max data size', app.resource.RLIMIT_CPU: 'Max cpu time',
+             app.resource.RLIMIT_NOFILE: 'Max open files'}
+    for limit, value in app.process_limits():
+        line = next(line for line in limits if line.startswith(names[limit]))
+        assert line.split()[3:5] == [str(value), str(value)]
+    if app.JOB_NICE:
+        assert int(nice) == min(os.getpriority(os.PRIO_PROCESS, 0) + app.JOB_NICE, 19)